@@ -0,0 +1,277 @@
+#!/usr/bin/env python2.7
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+"""
+Load tests the TTS server with the synthetic tone voice and writes the
+throughput, latency, time to first byte and peak RSS as JSON.
+
+    python bench/run_bench.py --concurrency 8 --requests 400 --hit-ratio 0.5
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import requests
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CWD, '..'))
+
+logger = logging.getLogger('hr.ttsserver.bench')
+
+WORDS = ('hello robot how are you today the weather is fine I like to talk '
+         'about music and movies what about you').split()
+# Number of distinct texts the cache hits are drawn from
+WARM_TEXTS = 16
+EMOTIONS = ['happy', 'sad', 'afraid']
+SERVER_START_TIMEOUT = 30
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q*len(values)), len(values)-1)]
+
+def summarize(values):
+    return {
+        'mean': sum(values)/len(values) if values else None,
+        'p50': percentile(values, 0.5),
+        'p90': percentile(values, 0.9),
+        'p99': percentile(values, 0.99),
+        'max': max(values) if values else None,
+    }
+
+def make_text(rand, length, index=None):
+    words = [rand.choice(WORDS) for _ in range(length)]
+    if index is not None:
+        # makes the text distinct
+        words.append('number {}'.format(index))
+    return ' '.join(words)
+
+def make_requests(options):
+    """Returns the request params of the mix, the warm-up ones first"""
+    rand = random.Random(options.seed)
+    warm = [make_text(rand, options.text_length) for _ in range(WARM_TEXTS)]
+    items = []
+    for i in range(options.requests):
+        if rand.random() < options.hit_ratio:
+            text = rand.choice(warm)
+        else:
+            text = make_text(rand, options.text_length, i)
+        params = {'vendor': 'bench', 'voice': 'tone', 'text': text}
+        if rand.random() < options.emotion_share:
+            params['emotion'] = rand.choice(EMOTIONS)
+        items.append(params)
+    warm_up = [{'vendor': 'bench', 'voice': 'tone', 'text': text} for text in warm]
+    return warm_up, items
+
+def start_server(options):
+    """Runs the server app in this process and returns its URL"""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import ttsserver.server as server
+
+    class Handler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server.load_voices(os.path.join(CWD, 'voices'))
+    options.output_dir = tempfile.mkdtemp()
+    for name, engine in server.VOICES.items():
+        for voice_name, voice in engine.items():
+            voice.set_name(name, voice_name)
+            voice.set_output_dir(os.path.join(options.output_dir, name))
+    server.response_cache.enabled = not options.no_cache
+    server.archive.max_bytes = 0
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True,
+                        request_handler=Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd, 'http://127.0.0.1:{}/v1.0'.format(httpd.server_port)
+
+def start_workers(options):
+    """Runs the server with the worker processes and returns its URL"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    options.output_dir = tempfile.mkdtemp()
+    cmd = [sys.executable, os.path.join(CWD, '../ttsserver/server.py'),
+           '-p, --port', str(port), '--workers', str(options.workers),
+           '--voice_path', os.path.join(CWD, 'voices'),
+           '--tts-output-dir', options.output_dir, '--archive-size', '0']
+    if options.no_cache:
+        cmd.append('--no-response-cache')
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+    url = 'http://127.0.0.1:{}/v1.0'.format(port)
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            if requests.get(url+'/ping', timeout=1).status_code == 200:
+                return proc, url
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    proc.kill()
+    proc.wait()
+    raise Exception("Server didn't start")
+
+def send(session, url, params):
+    """Returns the latency and the time to first byte of the request"""
+    start = time.time()
+    r = session.get(url, params=params, stream=True)
+    ttfb = None
+    chunks = []
+    for chunk in r.iter_content(chunk_size=64*1024):
+        if ttfb is None:
+            ttfb = time.time() - start
+        chunks.append(chunk)
+    latency = time.time() - start
+    if r.status_code != 200:
+        raise Exception("Request failed {}".format(r.status_code))
+    if r.headers.get('Content-Type') == 'application/json':
+        body = json.loads(''.join(chunks))
+        if 'error' in body or 'error' in body.get('response', {}):
+            raise Exception("Request failed {}".format(body))
+    return latency, ttfb or latency
+
+def run(options):
+    """Runs the benchmark and returns the results"""
+    httpd = None
+    proc = None
+    url = options.url
+    if url is None and options.workers:
+        proc, url = start_workers(options)
+    elif url is None:
+        httpd, url = start_server(options)
+    url = '{}/{}'.format(url, options.endpoint)
+    warm_up, items = make_requests(options)
+    session = requests.Session()
+    try:
+        for params in warm_up:
+            send(session, url, params)
+        latencies = []
+        ttfbs = []
+        errors = [0]
+        lock = threading.Lock()
+        pending = list(reversed(items))
+
+        def worker():
+            session = requests.Session()
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    params = pending.pop()
+                try:
+                    latency, ttfb = send(session, url, params)
+                    with lock:
+                        latencies.append(latency)
+                        ttfbs.append(ttfb)
+                except Exception as ex:
+                    logger.error(ex)
+                    with lock:
+                        errors[0] += 1
+
+        start = time.time()
+        threads = [threading.Thread(target=worker) for _ in range(options.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        if httpd is not None or proc is not None:
+            shutil.rmtree(options.output_dir, ignore_errors=True)
+    if options.url:
+        peak_rss = None
+    elif proc is not None:
+        # the largest of the server processes
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    else:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'config': {
+            'endpoint': options.endpoint,
+            'concurrency': options.concurrency,
+            'requests': options.requests,
+            'hit_ratio': options.hit_ratio,
+            'emotion_share': options.emotion_share,
+            'text_length': options.text_length,
+            'response_cache': not options.no_cache,
+            'workers': options.workers,
+            'seed': options.seed,
+        },
+        'build': get_build(),
+        'timestamp': time.time(),
+        'requests': len(latencies),
+        'errors': errors[0],
+        'duration': duration,
+        'throughput': len(latencies)/duration if duration else None,
+        'latency': summarize(latencies),
+        'ttfb': summarize(ttfbs),
+        'peak_rss_kb': peak_rss,
+    }
+
+def get_build():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=CWD,
+            stderr=subprocess.STDOUT).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def get_parser():
+    parser = argparse.ArgumentParser('TTS Server Benchmark')
+    parser.add_argument('--url', default=None,
+                        help='URL of a running server, e.g. http://host:10001/v1.0. '
+                             'By default the server runs in this process with the tone voice')
+    parser.add_argument('--endpoint', default='tts',
+                        choices=['tts', 'tts/audio', 'tts/multipart', 'tts/stream'])
+    parser.add_argument('--concurrency', default=4, type=int,
+                        help='Number of concurrent clients')
+    parser.add_argument('--requests', default=200, type=int,
+                        help='Number of timed requests')
+    parser.add_argument('--hit-ratio', dest='hit_ratio', default=0.5, type=float,
+                        help='Share of the requests for the warmed up texts')
+    parser.add_argument('--emotion-share', dest='emotion_share', default=0.0, type=float,
+                        help='Share of the requests with an emotion')
+    parser.add_argument('--text-length', dest='text_length', default=12, type=int,
+                        help='Number of words of the texts')
+    parser.add_argument('--no-response-cache', dest='no_cache', action='store_true',
+                        help='Disable the response cache of the server')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='Run the server with this number of processes instead '
+                             'of in this process')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write the results to')
+    return parser
+
+def main():
+    logging.basicConfig(level=logging.WARN)
+    options = get_parser().parse_args()
+    results = run(options)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()
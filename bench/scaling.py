@@ -0,0 +1,61 @@
+#!/usr/bin/env python2.7
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+"""
+Runs the benchmark with 1, 2, 4... server processes up to the number of
+cores. The tone voice has no simulated latency by default here, so the
+rendering is CPU bound and the throughput shows how the server scales.
+
+    python bench/scaling.py --requests 400 --output scaling.json
+"""
+import os
+import sys
+import json
+import logging
+import multiprocessing
+
+# the rendering is CPU bound unless the latency is set
+os.environ.setdefault('BENCH_TTS_LATENCY', '0')
+os.environ.setdefault('BENCH_TTS_CHAR_LATENCY', '0')
+
+import run_bench
+
+def get_workers(max_workers):
+    workers = [1]
+    while workers[-1]*2 <= max_workers:
+        workers.append(workers[-1]*2)
+    if workers[-1] != max_workers:
+        workers.append(max_workers)
+    return workers
+
+def main():
+    logging.basicConfig(level=logging.WARN)
+    parser = run_bench.get_parser()
+    parser.add_argument('--max-workers', dest='max_workers',
+                        default=multiprocessing.cpu_count(), type=int)
+    parser.set_defaults(hit_ratio=0.0, text_length=40)
+    options = parser.parse_args()
+    runs = []
+    for workers in get_workers(options.max_workers):
+        options.workers = workers
+        options.concurrency = max(options.concurrency, workers*2)
+        results = run_bench.run(options)
+        runs.append(results)
+        print '{:>3} workers {:8.1f} req/s  p50 {:.3f}s  p99 {:.3f}s  {} errors'.format(
+            workers, results['throughput'], results['latency']['p50'],
+            results['latency']['p99'], results['errors'])
+        sys.stdout.flush()
+    base = runs[0]['throughput']
+    results = {
+        'cores': multiprocessing.cpu_count(),
+        'runs': runs,
+        'speedup': [run['throughput']/base if base else None for run in runs],
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+"""
+Deterministic stand-in voice for the benchmarks. It renders a tone per
+character with synthetic phoneme timing, so no vendor is needed.
+"""
+import os
+import math
+import time
+import wave
+import struct
+import logging
+from collections import defaultdict
+
+from ttsserver.ttsbase import TTSBase, BaseVisemes
+
+logger = logging.getLogger('hr.ttsserver.bench.tone')
+
+SAMPLE_RATE = 16000
+# Seconds of audio per character
+CHAR_DURATION = 0.06
+# Simulated vendor latency, fixed plus per character seconds
+LATENCY = float(os.environ.get('BENCH_TTS_LATENCY', 0.05))
+CHAR_LATENCY = float(os.environ.get('BENCH_TTS_CHAR_LATENCY', 0.001))
+PHONEMES = {
+    'a': 'aa', 'e': 'eh', 'i': 'iy', 'o': 'ow', 'u': 'uw',
+    'm': 'm', 'b': 'b', 'p': 'p', 'f': 'f', 'v': 'v', 'w': 'w', 'l': 'l',
+}
+
+class ToneVisemes(BaseVisemes):
+    default_visemes_map = {
+        'A-I': ['aa', 'iy'],
+        'E': ['eh'],
+        'O': ['ow'],
+        'U': ['uw'],
+        'M': ['m', 'b', 'p'],
+        'F-V': ['f', 'v'],
+        'Q-W': ['w'],
+        'L': ['l', 't'],
+        'Sil': ['pau'],
+    }
+
+def render_tone(text, fname):
+    """Writes a tone per character of the text and returns the phonemes"""
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    phonemes = []
+    frames = []
+    samples = int(CHAR_DURATION*SAMPLE_RATE)
+    for i, ch in enumerate(text):
+        if ch.isspace():
+            name = 'pau'
+            frames.append(struct.pack('<{}h'.format(samples), *([0]*samples)))
+        else:
+            name = PHONEMES.get(ch.lower(), 't')
+            freq = 200 + (ord(ch) % 64)*10
+            frames.append(struct.pack('<{}h'.format(samples), *[
+                int(8000*math.sin(2*math.pi*freq*n/SAMPLE_RATE))
+                for n in range(samples)]))
+        phonemes.append({'type': 'phoneme', 'name': name,
+                         'start': i*CHAR_DURATION, 'end': (i+1)*CHAR_DURATION})
+    f = wave.open(fname, 'wb')
+    f.setparams((1, 2, SAMPLE_RATE, 0, 'NONE', 'not compressed'))
+    f.writeframes(''.join(frames))
+    f.close()
+    return phonemes
+
+class ToneTTS(TTSBase):
+
+    def do_tts(self, tts_data):
+        time.sleep(LATENCY + CHAR_LATENCY*len(tts_data.text))
+        tts_data.phonemes = render_tone(tts_data.text, tts_data.wavout)
+
+def create_voice():
+    api = ToneTTS()
+    api.set_viseme_mapping(ToneVisemes())
+    return api
+
+voices = defaultdict(dict)
+voices['bench']['tone'] = create_voice()
@@ -0,0 +1,114 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.archive import AudioArchive
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+        shutil.rmtree(self.output_dir)
+
+    def make_audio(self, name, data):
+        fname = os.path.join(self.output_dir, name)
+        with open(fname, 'wb') as f:
+            f.write(data)
+        return fname
+
+    def get_entries(self):
+        return sorted(f for f in os.listdir(self.archive_dir) if f.endswith('.wav'))
+
+    def test_dedup(self):
+        archive = AudioArchive(self.archive_dir)
+        archive.submit('0001', 'hello *world*', self.make_audio('a.wav', 'x'*100), owned=True)
+        archive.submit('0002', 'hello', self.make_audio('b.wav', 'x'*100), owned=True)
+        archive.flush()
+        self.assertEqual(self.get_entries(), ['0001 - hello world.wav', '0002 - hello.wav'])
+        self.assertEqual(len(os.listdir(archive.objects_dir)), 1)
+        self.assertEqual(archive.size, 100)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_not_owned(self):
+        archive = AudioArchive(self.archive_dir)
+        fname = self.make_audio('a.wav', 'x'*100)
+        archive.submit('0001', 'hello', fname)
+        archive.flush()
+        self.assertTrue(os.path.isfile(fname))
+        self.assertEqual(self.get_entries(), ['0001 - hello.wav'])
+
+    def test_data(self):
+        archive = AudioArchive(self.archive_dir)
+        archive.submit('0001', 'hello', data='x'*100)
+        archive.flush()
+        self.assertEqual(self.get_entries(), ['0001 - hello.wav'])
+        with open(os.path.join(self.archive_dir, '0001 - hello.wav')) as f:
+            self.assertEqual(f.read(), 'x'*100)
+
+    def test_max_bytes(self):
+        archive = AudioArchive(self.archive_dir, max_bytes=250)
+        for i in range(5):
+            archive.submit(str(i), 'hello', self.make_audio('{}.wav'.format(i), str(i)*100), owned=True)
+        archive.flush()
+        self.assertEqual(self.get_entries(), ['3 - hello.wav', '4 - hello.wav'])
+        self.assertEqual(len(os.listdir(archive.objects_dir)), 2)
+
+    def test_reload(self):
+        archive = AudioArchive(self.archive_dir)
+        archive.submit('0001', 'hello', self.make_audio('a.wav', 'x'*100), owned=True)
+        archive.flush()
+        archive = AudioArchive(self.archive_dir, max_bytes=50)
+        archive.start()
+        archive.flush()
+        self.assertEqual(self.get_entries(), [])
+        self.assertEqual(archive.size, 0)
+
+    def test_shared(self):
+        # the archives of two server processes
+        first = AudioArchive(self.archive_dir, max_bytes=150)
+        second = AudioArchive(self.archive_dir, max_bytes=150)
+        first.submit('1', 'hello', data='x'*100)
+        first.flush()
+        second.submit('2', 'hello', data='y'*100)
+        second.flush()
+        # the second evicted the object of the first
+        self.assertEqual(self.get_entries(), ['2 - hello.wav'])
+        first.submit('3', 'hello', data='x'*100)
+        first.flush()
+        self.assertEqual(self.get_entries(), ['3 - hello.wav'])
+        self.assertEqual(first.size, 100)
+        self.assertEqual(second.size, 100)
+
+    def test_import(self):
+        # archived before the index and the objects/ layout
+        for name, data in [('1', 'x'), ('2', 'x'), ('3', 'y')]:
+            self.make_audio(name, data*100)
+            shutil.move(os.path.join(self.output_dir, name),
+                        os.path.join(self.archive_dir, '{} - hello.wav'.format(name)))
+        archive = AudioArchive(self.archive_dir)
+        archive.start()
+        archive.flush()
+        self.assertEqual(len(self.get_entries()), 3)
+        self.assertEqual(len(os.listdir(archive.objects_dir)), 2)
+        self.assertEqual(archive.size, 200)
+
+    def test_disabled(self):
+        archive = AudioArchive(self.archive_dir, max_bytes=0)
+        fname = self.make_audio('a.wav', 'x')
+        self.assertFalse(archive.submit('0001', 'hello', fname, owned=True))
+        self.assertFalse(os.path.isfile(fname))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import time
+import wave
+import shutil
+import hashlib
+import tempfile
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.audio_cache import AudioCache, make_key
+from ttsserver.ttsbase import OnlineTTS
+from ttsserver.visemes import BaseVisemes
+
+
+class HVisemes(BaseVisemes):
+    default_visemes_map = {'C-D-G-K-N-S-TH': ['h']}
+
+
+class CountingTTS(OnlineTTS):
+
+    def __init__(self):
+        super(CountingTTS, self).__init__()
+        self.calls = 0
+
+    def online_tts(self, tts_data):
+        self.calls += 1
+        f = wave.open(tts_data.wavout, 'wb')
+        f.setparams((1, 1, 16000, 0, 'NONE', 'not compressed'))
+        f.writeframes(tts_data.text)
+        f.close()
+        tts_data.phonemes = [{'type': 'phoneme', 'name': 'h', 'start': 0.1, 'end': 0.2}]
+
+
+class TestAudioCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.output_dir)
+
+    def test_key(self):
+        self.assertEqual(make_key('a', {'x': 1, 'y': 2}), make_key(u'a', {'y': 2, 'x': 1}))
+        self.assertNotEqual(make_key('ab', 'c'), make_key('a', 'bc'))
+        self.assertEqual(len(make_key('a'*1000)), 40)
+
+    def test_put_get(self):
+        cache = AudioCache(self.cache_dir)
+        self.assertIsNone(cache.get('aa'))
+        fname = os.path.join(self.output_dir, 'a.wav')
+        with open(fname, 'wb') as f:
+            f.write('x'*10)
+        path = cache.put('aa', fname)
+        # hardlinked, not copied
+        self.assertEqual(os.stat(path).st_ino, os.stat(fname).st_ino)
+        self.assertEqual(cache.get('aa'), path)
+        self.assertEqual(cache.put('bb', data='y'*5), cache.get('bb'))
+        self.assertEqual([f for f in os.listdir(os.path.dirname(path)) if f.endswith('.tmp')], [])
+        # the index is shared
+        self.assertEqual(AudioCache(self.cache_dir).get_stats()['size'], 15)
+        os.remove(cache.get_path('bb'))
+        self.assertIsNone(cache.get('bb'))
+        self.assertEqual(cache.get_stats()['entries'], 1)
+
+    def test_evict(self):
+        cache = AudioCache(self.cache_dir, max_bytes=30)
+        cache.put('aa', data='a'*10)
+        cache.put('bb', data='b'*10)
+        cache.pin('aa')
+        cache.put('cc', data='c'*10)
+        time.sleep(0.01)
+        cache.get('bb')
+        cache.put('dd', data='d'*10)
+        # the pinned entry stays, cc is the least recently used
+        self.assertIsNotNone(cache.get('aa'))
+        self.assertIsNone(cache.get('cc'))
+        self.assertFalse(os.path.isfile(cache.get_path('cc')))
+        self.assertEqual(cache.get_stats(), {
+            'entries': 3, 'size': 30, 'pinned': 1, 'max_bytes': 30})
+        self.assertFalse(cache.pin('cc'))
+
+    def test_online_tts(self):
+        api = CountingTTS()
+        api.set_name('test', 'counting')
+        api.set_output_dir(self.output_dir)
+        for _ in range(2):
+            tts_data = api.tts('hello', speed='1')
+            self.assertEqual(tts_data.get_duration(), 5/16000.0)
+        self.assertEqual(api.calls, 1)
+        api.tts('hello', speed='2')
+        self.assertEqual(api.calls, 2)
+        self.assertTrue(api.pin('hello', {'speed': '2'}))
+        self.assertEqual(api.cache.get_stats()['pinned'], 1)
+
+    def write_legacy(self, api, params):
+        # the file of 'a/b' named by the text and the params before the
+        # cache was indexed
+        legacy = os.path.join(api.cache_dir, 'a_b-{}.wav'.format(
+            hashlib.sha1('a/b'+str(params)).hexdigest()[:6]))
+        f = wave.open(legacy, 'wb')
+        f.setparams((1, 1, 16000, 0, 'NONE', 'not compressed'))
+        f.writeframes('legacy')
+        f.close()
+        return legacy
+
+    def test_legacy(self):
+        api = CountingTTS()
+        api.set_name('test', 'counting')
+        api.set_output_dir(self.output_dir)
+        # the params don't tell which voice of the vendor it was
+        self.write_legacy(api, {'speed': '1'})
+        api.tts('a/b', speed='1')
+        self.assertEqual(api.calls, 1)
+        legacy = self.write_legacy(api, {'voice': 'counting'})
+        tts_data = api.tts('a/b', voice='counting')
+        self.assertEqual(api.calls, 1)
+        self.assertEqual(tts_data.get_duration(), 6/16000.0)
+        # linked, it is left for the other callers of the text
+        self.assertTrue(os.path.isfile(legacy))
+        self.assertEqual(api.cache.get_stats()['entries'], 2)
+
+    def test_sidecar(self):
+        api = CountingTTS()
+        api.set_name('test', 'counting')
+        api.set_output_dir(self.output_dir)
+        api.set_viseme_mapping(HVisemes())
+        first = api.tts('hello')
+        self.assertFalse(first.from_cache)
+        self.assertEqual(len(first.visemes), 1)
+        second = api.tts('hello')
+        self.assertEqual(api.calls, 1)
+        self.assertTrue(second.from_cache)
+        self.assertEqual(second.phonemes, first.phonemes)
+        self.assertEqual(second.visemes, first.visemes)
+        self.assertEqual(second.duration, first.get_duration())
+
+    def test_emotive_cache(self):
+        api = CountingTTS()
+        api.set_name('test', 'counting')
+        api.set_output_dir(self.output_dir)
+        tts_data = api.tts('hello')
+        key = api.get_emo_cache_id(tts_data, 'happy', {'emotion': 'happy'})
+        # the preset is resolved and the voice is part of the key
+        self.assertEqual(key, api.get_emo_cache_id(
+            tts_data, 'happy', {'emotion': 'happy', 'tempo': '1.1', 'voice': 'x'}))
+        self.assertNotEqual(key, api.get_emo_cache_id(
+            tts_data, 'happy', {'emotion': 'happy', 'tempo': '1.2'}))
+        api.set_name('test', 'other')
+        self.assertNotEqual(key, api.get_emo_cache_id(tts_data, 'happy', {'emotion': 'happy'}))
+        api.set_name('test', 'counting')
+
+        # the timeline of another markup of the text is not used
+        tts_data.phonemes[0]['name'] = 'x'
+        meta = dict(tts_data.get_sidecar(), duration=1.5, ratio=2.0)
+        api.emo_cache.put(key, data=tts_data.get_audio(), meta=meta)
+        tts_data = api.tts('hello', emotion='happy')
+        self.assertEqual(tts_data.get_duration(), 1.5)
+        self.assertEqual(tts_data.phonemes[0]['name'], 'h')
+        self.assertEqual(tts_data.phonemes[0]['end'], 0.4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+sys.path.append(os.path.join(cwd, '../bench'))
+
+os.environ['BENCH_TTS_LATENCY'] = '0'
+os.environ['BENCH_TTS_CHAR_LATENCY'] = '0'
+
+import run_bench
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        options = run_bench.get_parser().parse_args([
+            '--concurrency', '2', '--requests', '10', '--text-length', '3',
+            '--hit-ratio', '0.5'])
+        results = run_bench.run(options)
+        self.assertEqual(results['requests'], 10)
+        self.assertEqual(results['errors'], 0)
+        self.assertGreater(results['throughput'], 0)
+        self.assertLessEqual(results['ttfb']['p50'], results['latency']['p50'])
+        self.assertLessEqual(results['latency']['p50'], results['latency']['p99'])
+        self.assertGreater(results['peak_rss_kb'], 0)
+        self.assertEqual(results['config']['hit_ratio'], 0.5)
+
+    def test_requests_mix(self):
+        options = run_bench.get_parser().parse_args([
+            '--requests', '200', '--hit-ratio', '1', '--emotion-share', '0'])
+        warm_up, items = run_bench.make_requests(options)
+        texts = set(params['text'] for params in warm_up)
+        self.assertTrue(all(params['text'] in texts for params in items))
+        self.assertFalse(any('emotion' in params for params in items))
+        options.hit_ratio = 0
+        _, items = run_bench.make_requests(options)
+        self.assertEqual(len(set(params['text'] for params in items)), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.audio_cache import AudioCache, make_key
+from ttsserver.cache_archive import CacheArchive, ArchiveError, write_archive
+
+
+class TestCacheArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.archive_file = os.path.join(tempfile.mkdtemp(), 'cache.pack')
+        self.vendor_cache = AudioCache(os.path.join(self.root, 'festival', 'cache'))
+        self.emo_cache = AudioCache(os.path.join(self.root, 'festival', 'emo_cache'))
+
+    def tearDown(self):
+        AudioCache.archive = None
+        shutil.rmtree(self.root)
+        shutil.rmtree(os.path.dirname(self.archive_file))
+
+    def test_pack(self):
+        keys = [make_key('text', i) for i in range(20)]
+        for i, key in enumerate(keys):
+            self.vendor_cache.put(key, data='audio{}'.format(i), meta={'duration': i})
+        self.emo_cache.put(keys[0], data='emotive')
+        write_archive(self.root, self.archive_file)
+        archive = CacheArchive(self.archive_file, self.root)
+        self.assertEqual(archive.count, 21)
+        for i, key in enumerate(keys):
+            self.assertEqual(archive.get(self.vendor_cache.cache_dir, key),
+                             ('audio{}'.format(i), {'duration': i}))
+        self.assertEqual(archive.get(self.emo_cache.cache_dir, keys[0]), ('emotive', {}))
+        self.assertIsNone(archive.get(self.emo_cache.cache_dir, keys[1]))
+        self.assertIsNone(archive.get(os.path.join(self.root, 'other'), keys[0]))
+        # the namespaces are resolved once per cache directory
+        self.assertEqual(archive.cache_dirs[self.vendor_cache.cache_dir], 'festival/cache')
+
+        # the hits are served from the archive
+        AudioCache.archive = archive
+        self.vendor_cache.remove(keys[1])
+        self.assertEqual(self.vendor_cache.load(keys[1]), ('audio1', {'duration': 1}))
+        archive.close()
+
+    def test_compact(self):
+        old, new = make_key('old'), make_key('new')
+        self.vendor_cache.put(old, data='old')
+        write_archive(self.root, self.archive_file)
+        self.vendor_cache.remove(old)
+        self.vendor_cache.put(new, data='new')
+        base = CacheArchive(self.archive_file, self.root)
+        packed = write_archive(self.root, self.archive_file, base)
+        base.close()
+        self.assertEqual([key for _, key in packed], [new])
+        archive = CacheArchive(self.archive_file, self.root)
+        self.assertEqual(archive.get(self.vendor_cache.cache_dir, old), ('old', {}))
+        self.assertEqual(archive.get(self.vendor_cache.cache_dir, new), ('new', {}))
+        archive.close()
+
+    def test_bad_archive(self):
+        with open(self.archive_file, 'wb') as f:
+            f.write('HRCA\x01' + '\xff'*20)
+        with self.assertRaises(ArchiveError):
+            CacheArchive(self.archive_file, self.root)
+        open(self.archive_file, 'wb').close()
+        with self.assertRaises(ArchiveError):
+            CacheArchive(self.archive_file, self.root)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import requests
+from werkzeug.serving import make_server, WSGIRequestHandler
+from werkzeug.wrappers import Request, Response
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.client import Client, DiskCache
+
+
+class Handler(WSGIRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+
+    def setup(self):
+        Handler.connections += 1
+        WSGIRequestHandler.setup(self)
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.failures = 0
+        self.requests = 0
+        self.not_modified = 0
+        self.cache_dir = tempfile.mkdtemp()
+        Handler.connections = 0
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True,
+                                  request_handler=Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = Client('127.0.0.1', self.server.server_port, backoff=0.01)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    @Request.application
+    def app(self, request):
+        self.requests += 1
+        if self.failures > 0:
+            self.failures -= 1
+            return Response('busy', status=503)
+        body = {'message': 'pong', 'duration': 0.1, 'data': ''}
+        response = Response(json.dumps({'response': body}), mimetype='application/json')
+        if request.path.endswith('/tts'):
+            response.set_etag('v1')
+            response.make_conditional(request)
+            if response.status_code == 304:
+                self.not_modified += 1
+        return response
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            self.assertTrue(self.client.ping())
+        self.assertEqual(Handler.connections, 1)
+
+    def test_concurrent(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.client.ping()))
+                   for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True]*16)
+
+    def test_retry(self):
+        self.failures = 2
+        self.assertEqual(self.client.tts('hello').get_duration(), 0.1)
+        self.assertEqual(self.requests, 3)
+        self.failures = 3
+        self.assertIsNone(self.client.tts('hello').response)
+        self.assertEqual(self.requests, 6)
+
+    def test_no_retry_post(self):
+        self.failures = 1
+        r = self.client.request('POST', 'jobs', json={})
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(self.requests, 1)
+
+    def test_deadline(self):
+        self.client.deadline = 0.5
+        self.client.retries = 100
+        self.failures = 1000
+        start = time.time()
+        r = self.client.request('GET', 'tts')
+        self.assertEqual(r.status_code, 503)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_timeout(self):
+        # the timeout of the call is its deadline
+        self.client.retries = 100
+        self.failures = 1000
+        start = time.time()
+        r = self.client.request('GET', 'tts', timeout=0.3)
+        self.assertEqual(r.status_code, 503)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertGreater(self.requests, 1)
+
+    def test_connection_error(self):
+        client = Client('127.0.0.1', 1, backoff=0.01)
+        self.assertRaises(requests.ConnectionError, client.request, 'GET', 'ping')
+        self.assertFalse(client.ping())
+
+    def test_disk_cache(self):
+        client = Client('127.0.0.1', self.server.server_port, cache_dir=self.cache_dir)
+        self.assertEqual(client.tts('hello', voice='a').get_duration(), 0.1)
+        self.assertEqual(client.tts('hello', voice='a').get_duration(), 0.1)
+        self.assertEqual(self.not_modified, 1)
+        # a restarted client uses the cache on disk
+        client = Client('127.0.0.1', self.server.server_port, cache_dir=self.cache_dir)
+        self.assertEqual(client.tts('hello', voice='a').get_duration(), 0.1)
+        self.assertEqual(self.not_modified, 2)
+        # and when the server is down
+        client.root_url = 'http://127.0.0.1:1/v1.0'
+        client.backoff = 0.01
+        self.assertEqual(client.tts('hello', voice='a').get_duration(), 0.1)
+        self.assertIsNone(client.tts('hello', voice='b').response)
+
+    def test_disk_cache_eviction(self):
+        cache = DiskCache(self.cache_dir, 100)
+        cache.put('a', '"1"', 'x'*40)
+        cache.put('b', '"2"', 'x'*40)
+        self.assertEqual(cache.get('a'), ('"1"', 'x'*40))
+        cache.put('c', '"3"', 'x'*40)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['a', 'c'])
+        self.assertEqual(DiskCache(self.cache_dir, 100).size, 88)
+
+
+if __name__ == '__main__':
+    unittest.main()
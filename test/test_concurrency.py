@@ -0,0 +1,85 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import time
+import wave
+import shutil
+import tempfile
+import threading
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.ttsbase import TTSBase
+
+NUM_THREADS = 16
+NUM_REQUESTS = 20
+
+
+class ScratchTTS(TTSBase):
+    """Round trips the text and params through scratch files like Festival"""
+
+    def do_tts(self, tts_data):
+        script = tts_data.context.get_scratch_file('tts.scm')
+        with open(script, 'w') as f:
+            f.write(tts_data.text)
+        time.sleep(0.001)
+        with open(script) as f:
+            text = f.read()
+        params = self.get_tts_params()
+        f = wave.open(tts_data.wavout, 'wb')
+        f.setparams((1, 1, 16000, 0, 'NONE', 'not compressed'))
+        f.writeframes(text)
+        f.close()
+        tts_data.phonemes = [
+            {'type': 'phoneme', 'name': text, 'start': 0, 'end': 0},
+            {'type': 'phoneme', 'name': params['id'], 'start': 0, 'end': 0}]
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.api = ScratchTTS()
+        self.api.set_output_dir(self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_parallel_requests(self):
+        errors = []
+
+        def worker(n):
+            for i in range(NUM_REQUESTS):
+                text = 'thread {} request {}'.format(n, i)
+                tts_data = self.api.tts(text, id=text)
+                try:
+                    names = [p['name'] for p in tts_data.phonemes]
+                    self.assertEqual(names, [text, text])
+                    f = wave.open(tts_data.wavout, 'rb')
+                    self.assertEqual(f.readframes(f.getnframes()), text)
+                    f.close()
+                    os.remove(tts_data.wavout)
+                except Exception as ex:
+                    errors.append(ex)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(NUM_THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        # scratch files are removed after each request
+        self.assertEqual(
+            [f for f in os.listdir(self.output_dir) if f != 'emo_cache'], [])
+
+    def test_default_params(self):
+        self.api.tts_params = {'id': 'default'}
+        self.api.tts('hello', id='request')
+        self.assertEqual(self.api.get_tts_params(), {'id': 'default'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import stat
+import shutil
+import tempfile
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.api import festival
+from ttsserver.api.festival import FestivalTTS
+from ttsserver.singleflight import SingleFlight, Cancelled, Timeout
+
+# Stands in for festival. The pipe mode prints the segments and the end
+# markers of the scripts, the control file makes the synthesis die, hang
+# or be slow. The batch mode, the fallback, saves other segments.
+FAKE_FESTIVAL = r'''#!{python}
+import os, re, sys, time, wave
+
+def write_wave(fname):
+    f = wave.open(fname, 'wb')
+    f.setparams((1, 2, 16000, 0, 'NONE', 'not compressed'))
+    f.writeframes('\0\0'*1600)
+    f.close()
+
+def get_mode():
+    with open(os.environ['FAKE_FESTIVAL_CONTROL']) as f:
+        return f.read().strip()
+
+if sys.argv[1] == '-b':
+    script = open(sys.argv[2]).read()
+    write_wave(re.search(r'utt.save.wave utt1 "(.*?)"', script).group(1))
+    with open(re.search(r'utt.save.segs utt1 "(.*?)"', script).group(1), 'w') as f:
+        f.write('#\n0.05 100 pau\n0.1 100 b\n')
+    sys.exit(0)
+
+with open(os.environ['FAKE_FESTIVAL_LOG'], 'a') as f:
+    f.write('{{}} {{}}\n'.format(os.getpid(), os.getppid()))
+for line in iter(sys.stdin.readline, ''):
+    match = re.search(r'utt.save.wave utt1 "(.*?)"', line)
+    if match:
+        mode = get_mode()
+        if mode == 'die':
+            sys.exit(1)
+        elif mode == 'hang':
+            time.sleep(60)
+        elif mode == 'slow':
+            time.sleep(0.3)
+        write_wave(match.group(1))
+        sys.stdout.write('SEG 0.05 h\nSEG 0.1 ax\n')
+    match = re.search(r'\(format t "\\n(DONE-\w+)\\n"\)', line)
+    if match:
+        sys.stdout.write('\n{{}}\n'.format(match.group(1)))
+        sys.stdout.flush()
+'''
+
+def install_fake_festival(bin_dir, env):
+    """
+    Writes the fake festival to bin_dir and puts it first on the PATH of
+    env. Returns the control file and the log of the pids and parent pids
+    of the started workers.
+    """
+    fname = os.path.join(bin_dir, 'festival')
+    with open(fname, 'w') as f:
+        f.write(FAKE_FESTIVAL.format(python=sys.executable))
+    os.chmod(fname, os.stat(fname).st_mode | stat.S_IEXEC)
+    control = os.path.join(bin_dir, 'control')
+    log = os.path.join(bin_dir, 'workers.log')
+    open(control, 'w').close()
+    open(log, 'w').close()
+    env['PATH'] = bin_dir + os.pathsep + env['PATH']
+    env['FAKE_FESTIVAL_CONTROL'] = control
+    env['FAKE_FESTIVAL_LOG'] = log
+    return control, log
+
+
+class CancelledContext(object):
+
+    def check(self):
+        raise Cancelled("The TTS request is cancelled")
+
+
+class TestFestival(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.environ['PATH']
+        self.bin_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+        self.control, self.log = install_fake_festival(self.bin_dir, os.environ)
+        self.api = FestivalTTS()
+        self.api.set_name('festival', 'kal_diphone')
+        self.api.set_output_dir(self.output_dir)
+        self.api.params['voice'] = 'kal_diphone'
+        self.api.create_pool(size=1)
+
+    def tearDown(self):
+        festival.TIMEOUT = 60
+        worker = self.api.pool.workers.get()
+        if worker is not None:
+            worker.close()
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.bin_dir)
+        shutil.rmtree(self.output_dir)
+
+    def set_mode(self, mode):
+        with open(self.control, 'w') as f:
+            f.write(mode)
+
+    def get_workers(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def get_names(self, tts_data):
+        return [phoneme['name'] for phoneme in tts_data.phonemes]
+
+    def test_round_trip(self):
+        for _ in range(2):
+            tts_data = self.api.tts('hello "world"')
+            self.assertEqual(self.get_names(tts_data), ['h', 'ax'])
+            self.assertEqual(tts_data.phonemes[1]['start'], 0.05)
+            self.assertEqual(tts_data.get_duration(), 0.1)
+        # the warm worker is reused
+        self.assertEqual(len(self.get_workers()), 1)
+
+    def test_restart(self):
+        festival.TIMEOUT = 0.5
+        for mode in ['die', 'hang']:
+            self.set_mode(mode)
+            # falls back to running festival for the utterance
+            tts_data = self.api.tts('hello {}'.format(mode))
+            self.assertEqual(self.get_names(tts_data), ['pau', 'b'])
+            self.set_mode('')
+            tts_data = self.api.tts('hello')
+            self.assertEqual(self.get_names(tts_data), ['h', 'ax'])
+        self.assertEqual(len(self.get_workers()), 3)
+
+    def test_cancel(self):
+        self.set_mode('slow')
+        wavout = os.path.join(self.output_dir, 'cancelled.wav')
+        with self.assertRaises(Cancelled):
+            self.api.pool.synth('hello', wavout, CancelledContext())
+        # the worker finishes the cancelled script and stays warm
+        wavout = os.path.join(self.output_dir, 'next.wav')
+        phonemes = self.api.pool.synth('hello', wavout)
+        self.assertEqual([phoneme['name'] for phoneme in phonemes], ['h', 'ax'])
+        self.assertEqual(len(self.get_workers()), 1)
+        # the audio of the cancelled script is removed
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'cancelled.wav')))
+
+    def test_timeout(self):
+        self.set_mode('slow')
+        with self.assertRaises(Timeout):
+            SingleFlight().do('hello', self.api.tts, 'hello', timeout=0.1)
+        self.set_mode('')
+        tts_data = self.api.tts('hi')
+        wavs = [f for f in os.listdir(self.output_dir) if f.endswith('.wav')]
+        self.assertEqual(wavs, [os.path.basename(tts_data.wavout)])
+
+if __name__ == '__main__':
+    unittest.main()
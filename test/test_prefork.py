@@ -0,0 +1,136 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import time
+import signal
+import threading
+import shutil
+import tempfile
+import subprocess
+import requests
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.filelock import FileLock, LOCK_DIR
+from test_startup import get_free_port
+from test_festival import install_fake_festival
+
+
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_excludes_other_processes(self):
+        lock = FileLock(self.dir, 'entry')
+        lock.acquire()
+        script = (
+            "import sys; sys.path.insert(0, {!r});"
+            "from ttsserver.filelock import FileLock;"
+            "print(FileLock({!r}, 'entry').acquire(blocking=False))"
+        ).format(os.path.join(cwd, '..'), self.dir)
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(output.strip(), 'False')
+        lock.release()
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(output.strip(), 'True')
+
+    def test_excludes_other_threads(self):
+        with FileLock(self.dir, u'entr\xe9e'):
+            self.assertFalse(FileLock(self.dir, u'entr\xe9e').acquire(blocking=False))
+        lock = FileLock(self.dir, u'entr\xe9e')
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_lock_per_key(self):
+        lock = FileLock(self.dir, 'entry', stripes=None)
+        lock.acquire()
+        self.assertFalse(FileLock(self.dir, 'entry', stripes=None).acquire(blocking=False))
+        other = FileLock(self.dir, 'other', stripes=None)
+        self.assertTrue(other.acquire(blocking=False))
+        other.release()
+        waiter = FileLock(self.dir, 'entry', stripes=None)
+        thread = threading.Thread(target=waiter.acquire)
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.05)
+        lock.release()
+        thread.join(1)
+        self.assertIsNotNone(waiter.fd)
+        # the waiter holds the file at the path, not the removed one
+        self.assertFalse(FileLock(self.dir, 'entry', stripes=None).acquire(blocking=False))
+        waiter.release()
+        self.assertEqual(os.listdir(os.path.join(self.dir, LOCK_DIR)), [])
+
+
+class TestPrefork(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.env = dict(os.environ, HOME=self.home, BENCH_TTS_LATENCY='0')
+        self.env.pop('ROS_MASTER_URI', None)
+        self.port = get_free_port()
+        self.url = 'http://127.0.0.1:{}/v1.0'.format(self.port)
+        self.proc = None
+
+    def start_server(self, voice_path):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(cwd, '../ttsserver/server.py'),
+             '-p, --port', str(self.port), '--workers', '2', '--max-requests', '3',
+             '--voice_path', voice_path, '--archive-size', '0'],
+            env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        start = time.time()
+        while time.time() - start < 10:
+            try:
+                requests.get(self.url+'/ping', timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.05)
+
+    def tearDown(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        shutil.rmtree(self.home)
+
+    def test_recycle_and_stop(self):
+        self.start_server(os.path.join(cwd, '../bench/voices'))
+        session = requests.Session()
+        for i in range(12):
+            r = session.get(self.url+'/tts', params={
+                'vendor': 'bench', 'voice': 'tone', 'text': 'hello {}'.format(i)})
+            self.assertEqual(r.status_code, 200)
+            self.assertIn('phonemes', r.json()['response'])
+        self.proc.send_signal(signal.SIGTERM)
+        output = self.proc.communicate()[0]
+        self.assertEqual(self.proc.returncode, 0)
+        self.assertIn('recycle it', output)
+        self.assertIn('Server stopped', output)
+
+    def test_festival_pool(self):
+        _, log = install_fake_festival(self.home, self.env)
+        self.start_server(os.path.join(cwd, '../ttsserver/api'))
+        session = requests.Session()
+        for i in range(8):
+            r = session.get(self.url+'/tts', params={
+                'vendor': 'festival', 'voice': 'kal_diphone', 'text': 'hello {}'.format(i)})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(
+                [phoneme['name'] for phoneme in r.json()['response']['phonemes']],
+                ['h', 'ax'])
+        self.proc.send_signal(signal.SIGTERM)
+        self.proc.communicate()
+        with open(log) as f:
+            parents = set(int(line.split()[1]) for line in f)
+        # the festival processes belong to the workers, none to the master
+        self.assertNotIn(self.proc.pid, parents)
+        self.assertGreater(len(parents), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.response_cache import ResponseCache, CachedResponse
+
+
+def make_entry(audio):
+    return CachedResponse({'duration': 1.0}, audio)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_key_ignores_param_order(self):
+        self.assertEqual(
+            ResponseCache.make_key('v', 'a', 'hi', {'x': '1', 'y': '2'}),
+            ResponseCache.make_key('v', 'a', 'hi', {'y': '2', 'x': '1'}))
+
+    def test_lru_eviction(self):
+        size = make_entry('a'*100).size
+        cache = ResponseCache(max_bytes=size*2)
+        cache.put('a', make_entry('a'*100))
+        cache.put('b', make_entry('b'*100))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', make_entry('c'*100))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        stats = cache.get_stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], size*2)
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
+
+    def test_too_large(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.put('a', make_entry('a'*100))
+        self.assertIsNone(cache.get('a'))
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        cache.put(('v', 'a', 'hi', ()), make_entry('a'))
+        cache.put(('v', 'b', 'hi', ()), make_entry('b'))
+        self.assertEqual(cache.invalidate('v', 'a'), 1)
+        self.assertIsNone(cache.get(('v', 'a', 'hi', ())))
+        self.assertEqual(cache.invalidate('v'), 1)
+        self.assertEqual(cache.get_stats()['size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import time
+import threading
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.scheduler import Scheduler, Overloaded
+from ttsserver.jobs import PRIORITY_HIGH, PRIORITY_LOW
+
+
+class TestScheduler(unittest.TestCase):
+
+    def start(self, scheduler, name, vendor='a', voice='v', priority=PRIORITY_HIGH,
+              key=None):
+        """Acquires a slot on a thread and records the order of the grants"""
+        def run():
+            slot = scheduler.acquire(vendor, voice, priority, key)
+            self.order.append(name)
+            self.slots[name] = slot
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        # wait until it is queued or running
+        while len(scheduler.waiting) + scheduler.running < len(self.threads) + 1 + self.held:
+            time.sleep(0.001)
+        self.threads[name] = thread
+        return thread
+
+    def setUp(self):
+        self.order = []
+        self.slots = {}
+        self.threads = {}
+        self.held = 0
+
+    def finish(self, scheduler, name):
+        self.threads[name].join(1)
+        self.assertFalse(self.threads[name].is_alive())
+        scheduler.release(self.slots[name])
+
+    def test_interactive_first(self):
+        scheduler = Scheduler(max_concurrency=1)
+        busy = scheduler.acquire('a', 'v')
+        self.held = 1
+        self.start(scheduler, 'prefetch', priority=PRIORITY_LOW)
+        self.start(scheduler, 'live')
+        scheduler.release(busy)
+        self.finish(scheduler, 'live')
+        self.finish(scheduler, 'prefetch')
+        self.assertEqual(self.order, ['live', 'prefetch'])
+
+    def test_vendor_limit(self):
+        scheduler = Scheduler(max_concurrency=4, vendor_limits={'slow': 1},
+                              voice_limits={('a', 'v'): 2})
+        slow = scheduler.acquire('slow', 'v')
+        scheduler.acquire('a', 'v')
+        self.held = 2
+        # the slow vendor is at its limit, the others go ahead of it
+        self.start(scheduler, 'slow', vendor='slow')
+        self.start(scheduler, 'fast', vendor='b')
+        self.finish(scheduler, 'fast')
+        self.assertEqual(self.order, ['fast'])
+        self.assertEqual(scheduler.get_stats()['waiting'], 1)
+        scheduler.release(slow)
+        self.finish(scheduler, 'slow')
+        self.assertEqual(scheduler.get_stats()['running'], 1)
+
+    def test_background_share(self):
+        scheduler = Scheduler(max_concurrency=2)
+        scheduler.acquire('a', 'v', PRIORITY_LOW)
+        self.assertEqual(scheduler.get_max_background(), 1)
+        self.held = 1
+        self.start(scheduler, 'prefetch', priority=PRIORITY_LOW)
+        self.start(scheduler, 'live')
+        self.finish(scheduler, 'live')
+        self.assertEqual(self.order, ['live'])
+        self.assertEqual(scheduler.get_stats()['waiting_background'], 1)
+
+    def test_overloaded(self):
+        scheduler = Scheduler(max_concurrency=1, max_queue=1)
+        scheduler.acquire('a', 'v')
+        self.held = 1
+        self.start(scheduler, 'queued')
+        with self.assertRaises(Overloaded) as cm:
+            scheduler.acquire('a', 'v')
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+        self.assertEqual(scheduler.get_stats()['rejected'], 1)
+        # the background runs wait instead
+        self.start(scheduler, 'prefetch', priority=PRIORITY_LOW)
+
+    def test_promote(self):
+        scheduler = Scheduler(max_concurrency=1)
+        busy = scheduler.acquire('a', 'v')
+        self.held = 1
+        self.start(scheduler, 'other', priority=PRIORITY_LOW)
+        self.start(scheduler, 'prefetch', priority=PRIORITY_LOW, key='hello')
+        self.assertTrue(scheduler.promote('hello'))
+        self.assertFalse(scheduler.promote('unknown'))
+        scheduler.release(busy)
+        self.finish(scheduler, 'prefetch')
+        self.finish(scheduler, 'other')
+        self.assertEqual(self.order, ['prefetch', 'other'])
+
+
+if __name__ == '__main__':
+    unittest.main()
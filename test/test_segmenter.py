@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver.segmenter import split_segments
+
+
+class TestSegmenter(unittest.TestCase):
+
+    def test_sentences(self):
+        self.assertEqual(
+            split_segments('Hello there. How are you? Pi is 3.14!'),
+            [u'Hello there.', u'How are you?', u'Pi is 3.14!'])
+
+    def test_pause(self):
+        self.assertEqual(
+            split_segments('Hello |pause, 2| there |happy| you'),
+            [u'Hello |pause, 2|', u'there |happy| you'])
+
+    def test_markup(self):
+        self.assertEqual(
+            split_segments('*Hi. there* done. **Strong. one** ok'),
+            [u'*Hi. there* done.', u'**Strong. one** ok'])
+        self.assertEqual(
+            split_segments('<prosody rate="-20%">One. Two.</prosody> Three.'),
+            [u'<prosody rate="-20%">One. Two.</prosody>', u'Three.'])
+        self.assertEqual(
+            split_segments('Hi <mark name="a"/>there. Bye.'),
+            [u'Hi <mark name="a"/>there.', u'Bye.'])
+        self.assertEqual(
+            split_segments('5 * 3 is 15. Yes.'), [u'5 * 3 is 15.', u'Yes.'])
+
+    def test_chinese(self):
+        self.assertEqual(
+            split_segments('你好。今天好吗？'), [u'你好。', u'今天好吗？'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,338 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import json
+import base64
+import wave
+import struct
+import shutil
+import tempfile
+import threading
+import time
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+import ttsserver.server as server
+from ttsserver.ttsbase import TTSBase, LazyVoice
+from ttsserver.response_cache import ResponseCache
+from ttsserver.archive import AudioArchive
+from ttsserver.scheduler import Scheduler
+from ttsserver.jobs import Job, JobQueue, JobStore
+from ttsserver import timeline
+
+
+class ToneTTS(TTSBase):
+
+    count = 0
+
+    def do_tts(self, tts_data):
+        self.count += 1
+        f = wave.open(tts_data.wavout, 'wb')
+        f.setparams((1, 2, 16000, 0, 'NONE', 'not compressed'))
+        f.writeframes(struct.pack('<1600h', *range(1600)))
+        f.close()
+        tts_data.phonemes = [
+            {'type': 'phoneme', 'name': 'AA', 'start': 0.0, 'end': 0.1}]
+
+
+class MemoryTTS(ToneTTS):
+
+    def do_tts(self, tts_data):
+        super(MemoryTTS, self).do_tts(tts_data)
+        tts_data.load_audio(tts_data.wavout)
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.api = ToneTTS()
+        self.api.set_output_dir(self.output_dir)
+        server.VOICES.clear()
+        server.VOICES['test'] = {'tone': self.api}
+        server.response_cache = ResponseCache()
+        self.archive_dir = tempfile.mkdtemp()
+        server.archive = AudioArchive(self.archive_dir)
+        server.scheduler = Scheduler()
+        self.client = server.app.test_client()
+
+    def tearDown(self):
+        server.VOICES.clear()
+        server.archive.flush()
+        shutil.rmtree(self.output_dir)
+        shutil.rmtree(self.archive_dir)
+
+    def get(self, route, text='hello', codec=None, **kwargs):
+        params = {'vendor': 'test', 'voice': 'tone', 'text': text}
+        if codec is not None:
+            params['codec'] = codec
+        return self.client.get(
+            '/v1.0/{}'.format(route), query_string=params, **kwargs)
+
+    def test_tts(self):
+        r = self.get('tts')
+        response = json.loads(r.data)['response']
+        self.assertEqual(len(response['phonemes']), 1)
+        self.assertEqual(base64.b64decode(response['data'])[:4], 'RIFF')
+
+    def test_tts_audio(self):
+        r = self.get('tts/audio')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(r.data[:4], 'RIFF')
+        self.assertEqual(len(r.data), 3244)
+
+    def test_tts_audio_range(self):
+        r = self.get('tts/audio', headers={'Range': 'bytes=0-3'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, 'RIFF')
+        self.assertEqual(r.headers['Content-Range'], 'bytes 0-3/3244')
+        r = self.get('tts/audio', headers={'Range': 'bytes=4000-'})
+        self.assertEqual(r.status_code, 416)
+
+    def test_tts_multipart(self):
+        r = self.get('tts/multipart')
+        self.assertTrue(r.mimetype.startswith('multipart/mixed'))
+        self.assertIn('application/json', r.data)
+        self.assertIn('RIFF', r.data)
+
+    def test_tts_stream(self):
+        r = self.get('tts/stream', text='Hello there. How are you? Fine')
+        self.assertTrue(r.mimetype.startswith('multipart/mixed'))
+        self.assertEqual(r.data.count('RIFF'), 3)
+        responses = [json.loads(part.split('\r\n\r\n', 1)[1].rsplit('\r\n', 1)[0])['response']
+                     for part in r.data.split('--')
+                     if 'Content-Type: application/json' in part]
+        self.assertEqual([response.get('index') for response in responses], [0, 1, 2, None])
+        self.assertEqual(responses[1]['offset'], 0.1)
+        self.assertEqual(responses[1]['phonemes'][0]['start'], 0.1)
+        self.assertAlmostEqual(responses[-1]['duration'], 0.3)
+        self.assertEqual(responses[-1]['segments'], 3)
+        self.assertEqual(self.api.count, 3)
+
+    def test_codec(self):
+        r = self.get('tts', codec='ulaw')
+        response = json.loads(r.data)['response']
+        self.assertEqual(response['codec']['codec'], 'ulaw')
+        self.assertEqual(base64.b64decode(response['data'])[:4], '.snd')
+        r = self.get('tts/audio', headers={'Accept': 'audio/basic'})
+        self.assertEqual(r.mimetype, 'audio/basic')
+        self.assertEqual(len(r.data), response['codec']['size'])
+        entry = server.response_cache.entries.values()[0]
+        self.assertEqual(entry.encodings.keys(), ['ulaw'])
+        self.assertEqual(self.get('tts/audio').mimetype, 'audio/wav')
+        self.assertEqual(self.get('tts', codec='mp3').status_code, 406)
+
+    def test_etag(self):
+        r = self.get('tts')
+        etag = r.headers['ETag']
+        self.assertEqual(self.get('tts', headers={'If-None-Match': etag}).status_code, 304)
+        r = self.get('tts/audio')
+        self.assertEqual(r.headers['ETag'], etag)
+        r = self.get('tts/audio', headers={'If-None-Match': etag})
+        self.assertEqual((r.status_code, r.data), (304, ''))
+        r = self.get('tts', codec='ulaw', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers['ETag'], etag)
+        self.assertEqual(self.api.count, 1)
+
+    def test_binary_timeline(self):
+        response = json.loads(self.get('tts').data)['response']
+        r = self.client.get('/v1.0/tts', query_string={
+            'vendor': 'test', 'voice': 'tone', 'text': 'hello', 'timeline': 'binary'})
+        compact = json.loads(r.data)['response']
+        self.assertNotIn('phonemes', compact)
+        self.assertEqual(compact['data'], response['data'])
+        decoded = timeline.decode(base64.b64decode(compact['timeline']))
+        self.assertEqual(decoded['phonemes'], response['phonemes'])
+        self.assertEqual(decoded['nodes'], response['nodes'])
+        r = self.client.get('/v1.0/tts/multipart', query_string={
+            'vendor': 'test', 'voice': 'tone', 'text': 'hello', 'timeline': 'binary'})
+        self.assertIn(timeline.MIMETYPE, r.data)
+        self.assertEqual(self.api.count, 1)
+
+    def test_tts_audio_unknown_voice(self):
+        r = self.client.get('/v1.0/tts/audio', query_string={
+            'vendor': 'test', 'voice': 'nobody', 'text': 'hello'})
+        self.assertEqual(r.status_code, 500)
+
+    def test_response_cache(self):
+        first = self.get('tts').data
+        self.assertEqual(self.get('tts').data, first)
+        self.assertEqual(self.get('tts/audio').status_code, 200)
+        self.assertEqual(self.api.count, 1)
+        self.get('tts', text='hi')
+        self.assertEqual(self.api.count, 2)
+        stats = json.loads(self.client.get('/v1.0/cache').data)['response']
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        r = self.client.delete('/v1.0/cache', query_string={'voice': 'tone'})
+        self.assertEqual(json.loads(r.data)['response']['invalidated'], 2)
+        self.get('tts')
+        self.assertEqual(self.api.count, 3)
+
+    def test_response_cache_disabled(self):
+        server.response_cache.enabled = False
+        self.get('tts')
+        self.get('tts/audio')
+        self.assertEqual(self.api.count, 2)
+        server.archive.flush()
+        self.assertEqual(os.listdir(self.output_dir), ['emo_cache'])
+
+    def test_batch(self):
+        items = [{'vendor': 'test', 'voice': 'tone', 'text': str(i)}
+                 for i in range(10)]
+        items.insert(3, {'vendor': 'test', 'voice': 'nobody', 'text': 'hi'})
+        items[5]['params'] = {'rate': 2}
+        r = self.client.post('/v1.0/tts/batch', data=json.dumps({'items': items}))
+        results = json.loads(r.data)['response']['results']
+        self.assertEqual(len(results), 11)
+        self.assertEqual(results[3]['response']['error'], "Can't get api")
+        for result in results[:3] + results[4:]:
+            self.assertIn('data', result['response'])
+        self.assertEqual(self.api.count, 10)
+
+    def test_batch_bad_request(self):
+        r = self.client.post('/v1.0/tts/batch', data='{"items": 1}')
+        self.assertEqual(r.status_code, 400)
+        item = {'vendor': 'test', 'voice': 'tone', 'text': 'hi', 'params': 'fast'}
+        for route, payload in [('tts/batch', {'items': [item]}), ('jobs', item),
+                               ('prefetch', {'items': [item]})]:
+            r = self.client.post('/v1.0/'+route, data=json.dumps(payload))
+            self.assertEqual(r.status_code, 400)
+            self.assertIn('params', json.loads(r.data)['response']['error'])
+
+    def test_jobs(self):
+        r = self.client.post('/v1.0/jobs', data=json.dumps(
+            {'vendor': 'test', 'voice': 'tone', 'text': 'hello'}))
+        self.assertEqual(r.status_code, 202)
+        job_id = json.loads(r.data)['response']['id']
+        r = self.client.get('/v1.0/jobs/{}?wait=5'.format(job_id))
+        response = json.loads(r.data)['response']
+        self.assertEqual(response['status'], 'done')
+        self.assertIn('data', response['result']['response'])
+        r = self.client.get('/v1.0/jobs/unknown')
+        self.assertEqual(r.status_code, 404)
+
+    def test_prefetch(self):
+        items = [{'vendor': 'test', 'voice': 'tone', 'text': str(i)}
+                 for i in range(5)]
+        items.append({'vendor': 'test', 'voice': 'nobody', 'text': 'hi'})
+        r = self.client.post('/v1.0/prefetch', data=json.dumps({'items': items}))
+        self.assertEqual(r.status_code, 202)
+        prefetch_id = json.loads(r.data)['response']['id']
+        for job in server.prefetch_queue.get_group(prefetch_id).jobs:
+            job.wait(5)
+        r = self.client.get('/v1.0/prefetch/{}'.format(prefetch_id))
+        response = json.loads(r.data)['response']
+        self.assertEqual(response['status'], 'done')
+        self.assertEqual((response['done'], response['failed']), (5, 1))
+        self.assertEqual(response['errors'][0]['index'], 5)
+        self.assertEqual(self.api.count, 5)
+        server.archive.flush()
+        self.assertEqual(os.listdir(self.output_dir), ['emo_cache'])
+        # the prefetched audio is not served
+        self.assertEqual(server.response_cache.get_stats()['entries'], 0)
+        self.assertEqual(server.archive.size, 0)
+
+    def test_shared_jobs(self):
+        # the jobs run by another worker process are found in the store
+        store = JobStore(os.path.join(self.output_dir, 'jobs.sqlite'))
+        other = JobQueue()
+        other.store = store
+        job_queue, prefetch_queue = server.job_queue, server.prefetch_queue
+        server.job_queue, server.prefetch_queue = JobQueue(), JobQueue()
+        server.job_queue.store = server.prefetch_queue.store = store
+        try:
+            job = other.submit(server.tts_body, 'test', 'tone', 'hello', {})
+            r = self.client.get('/v1.0/jobs/{}?wait=5'.format(job.id))
+            response = json.loads(r.data)['response']
+            self.assertEqual(response['status'], 'done')
+            self.assertIn('data', response['result']['response'])
+            group = other.submit_group(server.prefetch, [
+                ('test', 'tone', 'hi', {}, None), ('test', 'nobody', 'hi', {}, None)])
+            for job in server.prefetch_queue.get_group(group.id).jobs:
+                job.wait(5)
+            r = self.client.get('/v1.0/prefetch/{}'.format(group.id))
+            response = json.loads(r.data)['response']
+            self.assertEqual((response['done'], response['failed']), (1, 1))
+            self.assertEqual(response['errors'][0]['index'], 1)
+            # the job of a process that exited fails
+            job = Job(None)
+            store.add(job)
+            conn = store._connect()
+            # above the largest pid of linux
+            conn.execute('UPDATE jobs SET pid=? WHERE id=?', (2**22+1, job.id))
+            conn.close()
+            r = self.client.get('/v1.0/jobs/{}'.format(job.id))
+            self.assertEqual(json.loads(r.data)['response']['status'], 'failed')
+        finally:
+            server.job_queue, server.prefetch_queue = job_queue, prefetch_queue
+
+    def test_metrics(self):
+        self.get('tts')
+        self.get('tts')
+        r = self.client.get('/v1.0/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('tts_stage_seconds_count{stage="do_tts",vendor="",voice=""}', r.data)
+        self.assertIn('tts_cache_total{cache="response",result="hit"}', r.data)
+        self.assertIn('tts_queue_depth{queue="jobs"} 0.0', r.data)
+
+    def test_overloaded(self):
+        server.scheduler = Scheduler(max_concurrency=1, max_queue=1)
+        busy = server.scheduler.acquire('test', 'tone')
+        queued = threading.Thread(target=self.get, args=('tts', 'queued'))
+        queued.start()
+        while server.scheduler.get_depth() == 0:
+            time.sleep(0.001)
+        r = self.get('tts')
+        self.assertEqual(r.status_code, 503)
+        self.assertGreaterEqual(int(r.headers['Retry-After']), 1)
+        server.scheduler.release(busy)
+        queued.join(5)
+        self.assertEqual(self.get('tts').status_code, 200)
+        r = self.client.get('/v1.0/scheduler')
+        self.assertEqual(json.loads(r.data)['response']['rejected'], 1)
+
+    def test_deadline(self):
+        server.scheduler = Scheduler(max_concurrency=1)
+        busy = server.scheduler.acquire('test', 'tone')
+        r = self.get('tts', headers={'X-TTS-Timeout': '0.1'})
+        self.assertEqual(r.status_code, 504)
+        r = self.get('tts/audio', 'expired', headers={'X-TTS-Timeout': '0'})
+        self.assertEqual(r.status_code, 504)
+        server.scheduler.release(busy)
+        # the timeout is not part of the cache key
+        for timeout in (5, 10):
+            r = self.client.get('/v1.0/tts', query_string={
+                'vendor': 'test', 'voice': 'tone', 'text': 'hi', 'timeout': timeout})
+            self.assertEqual(r.status_code, 200)
+        self.assertEqual(server.response_cache.hits, 1)
+
+    def test_in_memory_audio(self):
+        server.VOICES['test']['memory'] = MemoryTTS()
+        server.VOICES['test']['memory'].set_output_dir(self.output_dir)
+        r = self.client.get('/v1.0/tts', query_string={
+            'vendor': 'test', 'voice': 'memory', 'text': 'hello'})
+        response = json.loads(r.data)['response']
+        self.assertEqual(response['duration'], 0.1)
+        self.assertEqual(base64.b64decode(response['data'])[:4], 'RIFF')
+        self.assertEqual(os.listdir(self.output_dir), ['emo_cache'])
+        server.archive.flush()
+        self.assertEqual(len(os.listdir(server.archive.objects_dir)), 1)
+
+    def test_lazy_voice(self):
+        voice = LazyVoice(ToneTTS)
+        voice.set_name('test', 'lazy')
+        voice.set_output_dir(self.output_dir)
+        server.VOICES['test']['lazy'] = voice
+        self.assertFalse(voice.is_loaded())
+        r = self.client.get('/v1.0/tts', query_string={
+            'vendor': 'test', 'voice': 'lazy', 'text': 'hello'})
+        self.assertIn('RIFF', base64.b64decode(json.loads(r.data)['response']['data']))
+        self.assertEqual(voice.get().voice_name, 'lazy')
+        self.assertEqual(voice.get().count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import time
+import threading
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver import singleflight
+from ttsserver.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def work(self, value):
+        self.calls += 1
+        self.release.wait(5)
+        if value is None:
+            raise ValueError('no value')
+        return value
+
+    def run_callers(self, num, value):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flights.do('key', self.work, value))
+            except ValueError as ex:
+                results.append(ex)
+        threads = [threading.Thread(target=call) for _ in range(num)]
+        for thread in threads:
+            thread.start()
+        while self.flights.get_inflight() == 0 or self.flights.shared < num-1:
+            threading.Event().wait(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce(self):
+        self.assertEqual(self.run_callers(8, 'audio'), ['audio']*8)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flights.get_inflight(), 0)
+
+    def test_error(self):
+        results = self.run_callers(4, None)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(self.calls, 1)
+
+    def test_cancel(self):
+        states = []
+
+        def work():
+            self.release.wait(5)
+            states.append(singleflight.cancelled())
+        with self.assertRaises(singleflight.Timeout):
+            self.flights.do('key', work, timeout=0.05)
+        # the next caller starts a new flight
+        self.assertEqual(self.flights.get_inflight(), 0)
+        self.release.set()
+        self.assertEqual(self.flights.do('key', lambda: 'new'), 'new')
+        while not states:
+            threading.Event().wait(0.01)
+        self.assertEqual(states, [True])
+
+    def test_abort(self):
+        with self.assertRaises(singleflight.Cancelled):
+            self.flights.do('key', self.work, 'audio', abort=lambda: True)
+        self.assertEqual(self.flights.get_inflight(), 0)
+        self.release.set()
+
+    def test_kill_command(self):
+        from ttsserver.ttsbase import TTSContext
+        results = []
+
+        def work():
+            start = time.time()
+            try:
+                TTSContext().run(['sleep', '5'])
+            except singleflight.Cancelled:
+                results.append(time.time() - start)
+        with self.assertRaises(singleflight.Timeout):
+            self.flights.do('key', work, timeout=0.1)
+        while not results:
+            threading.Event().wait(0.01)
+        self.assertLess(results[0], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import subprocess
+import requests
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+# Max seconds from starting the server to answering /ping
+STARTUP_BUDGET = 1.0
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.env = dict(os.environ, HOME=self.home)
+        self.env.pop('ROS_MASTER_URI', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def test_lazy_imports(self):
+        script = (
+            "import sys; sys.path.insert(0, {!r});"
+            "import ttsserver.server as server;"
+            "server.load_voices({!r});"
+            "print([m for m in ['scipy', 'pysptk', 'pinyin', 'pocketsphinx'] if m in sys.modules])"
+        ).format(os.path.join(cwd, '..'), os.path.join(cwd, '../ttsserver/api'))
+        output = subprocess.check_output([sys.executable, '-c', script], env=self.env)
+        self.assertEqual(output.strip(), '[]')
+
+    def test_startup_budget(self):
+        port = get_free_port()
+        start = time.time()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(cwd, '../ttsserver/server.py'),
+             '-p, --port', str(port)],
+            env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            elapsed = None
+            while time.time() - start < 10 and proc.poll() is None:
+                try:
+                    r = requests.get('http://127.0.0.1:{}/v1.0/ping'.format(port), timeout=1)
+                    if r.status_code == 200:
+                        elapsed = time.time() - start
+                        break
+                except requests.ConnectionError:
+                    time.sleep(0.01)
+            self.assertIsNotNone(elapsed, "Server didn't start")
+            self.assertLess(elapsed, STARTUP_BUDGET)
+        finally:
+            proc.kill()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
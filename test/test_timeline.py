@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import json
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver import timeline
+
+
+class TestTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.phonemes = [
+            {'type': 'phoneme', 'name': 'hh', 'start': 0.0, 'end': 0.1},
+            {'type': 'phoneme', 'name': 'ay', 'start': 0.1, 'end': 0.35},
+            {'type': 'phoneme', 'name': 'hh', 'start': 0.35, 'end': 0.5},
+        ]
+        self.response = {
+            'phonemes': self.phonemes,
+            'markers': [{'type': 'marker', 'name': u'你好', 'start': 0.1, 'end': 0.1}],
+            'words': [{'type': 'word', 'name': 'hi', 'start': 0.0, 'end': 0.35,
+                       'value': 'Hi'}],
+            'visemes': [{'type': 'viseme', 'name': 'A-I', 'start': 0.12,
+                         'end': 0.35, 'duration': 0.2}],
+        }
+
+    def test_round_trip(self):
+        data = timeline.encode(self.response)
+        decoded = timeline.decode(data)
+        for key in ['phonemes', 'markers', 'words', 'visemes']:
+            self.assertEqual(decoded[key], self.response[key])
+        self.assertEqual([node['name'] for node in decoded['nodes']],
+                         ['hi', 'hh', u'你好', 'ay', 'hh'])
+        self.assertLess(len(data), len(json.dumps(self.response))/2)
+
+    def test_bad_data(self):
+        data = timeline.encode(self.response)
+        self.assertRaises(timeline.TimelineError, timeline.decode, data[:20])
+        self.assertRaises(timeline.TimelineError, timeline.decode, 'JSON' + data[4:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import unittest
+import os
+import sys
+import io
+import wave
+import base64
+import struct
+import shutil
+import tempfile
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(cwd, '..'))
+
+from ttsserver import transcode
+from ttsserver.client import TTSResponse
+
+
+def make_wav(samples):
+    out = io.BytesIO()
+    f = wave.open(out, 'wb')
+    f.setparams((1, 2, 16000, 0, 'NONE', 'not compressed'))
+    f.writeframes(struct.pack('<{}h'.format(len(samples)), *samples))
+    f.close()
+    return out.getvalue()
+
+
+class TestTranscode(unittest.TestCase):
+
+    def setUp(self):
+        self.wav = make_wav(range(0, 16000, 10))
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ulaw(self):
+        encoding = transcode.encode(self.wav, 'ulaw')
+        self.assertEqual(encoding.mimetype, 'audio/basic')
+        self.assertEqual(encoding.params['sample_rate'], 16000)
+        self.assertEqual(len(encoding.data), encoding.params['size'])
+        self.assertLess(len(encoding.data), len(self.wav))
+        f = wave.open(io.BytesIO(transcode.decode(encoding.data, 'ulaw')))
+        self.assertEqual(f.getparams()[:4], (1, 2, 16000, 1600))
+        samples = struct.unpack('<1600h', f.readframes(1600))
+        # mu-law keeps about 4% of the amplitude
+        self.assertTrue(all(abs(a-b) <= max(16, b*0.04)
+                            for a, b in zip(samples, range(0, 16000, 10))))
+
+    def test_unknown_codec(self):
+        self.assertRaises(transcode.CodecError, transcode.encode, self.wav, 'mp3')
+
+    def test_client_write(self):
+        encoding = transcode.encode(self.wav, 'ulaw')
+        result = TTSResponse()
+        result.response = {
+            'data': base64.b64encode(encoding.data), 'codec': encoding.params}
+        au = os.path.join(self.tmp_dir, 'test.au')
+        wav = os.path.join(self.tmp_dir, 'test.wav')
+        self.assertTrue(result.write(au))
+        self.assertTrue(result.write(wav))
+        with open(au, 'rb') as f:
+            self.assertEqual(f.read(), encoding.data)
+        with open(wav, 'rb') as f:
+            self.assertEqual(f.read(4), 'RIFF')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,30 @@
 #!/usr/bin/env python
 # Copyright (c) 2013-2019 Hanson Robotics, Ltd. 
 import os
+import time
+import uuid
+import Queue
+import select
 import logging
+import threading
 import subprocess
 from collections import defaultdict
 
-from ttsserver.ttsbase import TTSBase, TTSData, BaseVisemes
+from ttsserver.ttsbase import TTSBase, TTSData, BaseVisemes, CANCEL_POLL_INTERVAL
+from ttsserver.singleflight import Cancelled
 
 logger = logging.getLogger('hr.tts.festival')
 
+# Number of warm festival processes per voice, 0 runs festival per utterance
+POOL_SIZE = int(os.environ.get('FESTIVAL_POOL_SIZE', 1))
+# Whether to start the festival processes when the voices are loaded
+PRELOAD = os.environ.get('FESTIVAL_PRELOAD', '1') == '1'
+# Max seconds to wait for festival to load the voice or synthesise
+TIMEOUT = 60
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace('"', '\\"')
+
 class FestivalTTSVisemes(BaseVisemes):
     default_visemes_map = {
         'A-I': ['aa','ae','ah','ao','ax','axr','ih','iy'],
@@ -23,6 +39,178 @@ class FestivalTTSVisemes(BaseVisemes):
         'Sil': ['pau', 'brth']
     }
 
+class FestivalWorker(object):
+    """
+    A festival process reading Scheme from stdin with the voice loaded.
+    Each utterance is written to the audio file and the segments are
+    printed on stdout, followed by an end marker.
+    """
+
+    def __init__(self, voice):
+        self.voice = voice
+        self.devnull = open(os.devnull, 'w')
+        try:
+            self.proc = subprocess.Popen(
+                ['festival', '--pipe'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=self.devnull)
+        except Exception:
+            self.devnull.close()
+            raise
+        self.buf = ''
+        # the end marker of the script a cancelled request left running
+        self.pending = None
+        try:
+            self.call('(voice_{})'.format(voice))
+        except Exception:
+            self.close()
+            raise
+        logger.info("Started festival worker {} pid {}".format(voice, self.proc.pid))
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def call(self, script, context=None):
+        """
+        Runs the script and returns the lines it printed. Raises Cancelled
+        if the request of the context is cancelled, the script keeps
+        running and its output is skipped by the next call.
+        """
+        self.finish()
+        marker = 'DONE-{}'.format(uuid.uuid4().hex)
+        self.proc.stdin.write('{}\n(format t "\\n{}\\n")\n(fflush nil)\n'.format(script, marker))
+        self.proc.stdin.flush()
+        self.pending = marker
+        return self._read(marker, context)
+
+    def finish(self):
+        """Waits for the script a cancelled request left running"""
+        if self.pending is not None:
+            self._read(self.pending)
+
+    def _read(self, marker, context=None):
+        """Returns the lines printed before the marker"""
+        lines = []
+        deadline = time.time() + TIMEOUT
+        while True:
+            while '\n' in self.buf:
+                line, self.buf = self.buf.split('\n', 1)
+                if line == marker:
+                    self.pending = None
+                    return lines
+                lines.append(line)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError("Festival timed out")
+            if context is not None:
+                context.check()
+                remaining = min(remaining, CANCEL_POLL_INTERVAL)
+            ready, _, _ = select.select([self.proc.stdout], [], [], remaining)
+            if ready:
+                data = os.read(self.proc.stdout.fileno(), 4096)
+                if not data:
+                    raise RuntimeError("Festival exited")
+                self.buf += data
+
+    def synth(self, text, wavout, context=None):
+        lines = self.call("""
+(set! utt1 (Utterance Text "{text}"))
+(utt.synth utt1)
+(utt.save.wave utt1 "{audiofile}")
+(mapcar
+  (lambda (seg)
+    (format t "SEG %f %s\\n" (item.feat seg "end") (item.name seg)))
+  (utt.relation.items utt1 'Segment))""".format(
+            text=escape(text), audiofile=escape(wavout)), context)
+        phonemes = []
+        last_tick = 0
+        for line in lines:
+            if not line.startswith('SEG '):
+                continue
+            _, tick, phoneme = line.split(' ', 2)
+            tick = float(tick)
+            phonemes.append({'type': 'phoneme', 'name': phoneme, 'start': last_tick, 'end': tick})
+            last_tick = tick
+        return phonemes
+
+    def close(self):
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+        self.devnull.close()
+
+class FestivalPool(object):
+    """Pool of warm festival workers of one voice. Dead workers are replaced."""
+
+    def __init__(self, voice, size=POOL_SIZE):
+        self.voice = voice
+        self.size = size
+        # None is a slot without a running worker
+        self.workers = Queue.Queue()
+        for i in range(size):
+            self.workers.put(None)
+
+    def start(self):
+        """Starts the workers in the background"""
+        def run():
+            workers = [self.workers.get() for i in range(self.size)]
+            for i, worker in enumerate(workers):
+                if worker is None:
+                    try:
+                        workers[i] = FestivalWorker(self.voice)
+                    except Exception as ex:
+                        logger.error("Can't start festival worker {}: {}".format(self.voice, ex))
+            for worker in workers:
+                self.workers.put(worker)
+        job = threading.Thread(target=run)
+        job.daemon = True
+        job.start()
+
+    def synth(self, text, wavout, context=None):
+        """
+        Synthesises the text. A worker that timed out or failed is killed,
+        one left running by a cancelled request goes back to the pool once
+        it finished the script.
+        """
+        worker = self.workers.get()
+        finishing = False
+        try:
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    logger.warn("Restart festival worker {}".format(self.voice))
+                    worker.close()
+                worker = None
+                worker = FestivalWorker(self.voice)
+            return worker.synth(text, wavout, context)
+        except Cancelled:
+            finishing = True
+            job = threading.Thread(target=self._finish, args=(worker, wavout))
+            job.daemon = True
+            job.start()
+            raise
+        except Exception:
+            if worker is not None and worker.pending is not None:
+                worker.close()
+                worker = None
+            raise
+        finally:
+            if not finishing:
+                self.workers.put(worker)
+
+    def _finish(self, worker, wavout):
+        """Removes the audio of the cancelled script once it is written"""
+        try:
+            worker.finish()
+        except Exception as ex:
+            logger.error("Festival worker error: {}".format(ex))
+            worker.close()
+            worker = None
+        finally:
+            if os.path.isfile(wavout):
+                os.remove(wavout)
+            self.workers.put(worker)
+
 class FestivalTTS(TTSBase):
     def __init__(self):
         super(FestivalTTS, self).__init__()
@@ -35,15 +223,22 @@ class FestivalTTS(TTSBase):
         self.params = {
             "voice": "cmu_us_slt_arctic_hts",
         }
-        self.timing = os.path.join(self.output_dir, 'timing')
-        self.script = os.path.join(self.output_dir, 'tts.scm')
+        self.pool = None
+
+    def create_pool(self, size=POOL_SIZE):
+        if size > 0:
+            self.pool = FestivalPool(self.params['voice'], size)
+
+    def start(self):
+        if self.pool is not None and PRELOAD:
+            self.pool.start()
 
     def get_tts_session_params(self):
         return self.params
 
-    def get_phonemes(self):
+    def get_phonemes(self, timing):
         phonemes = []
-        with open(self.timing) as f:
+        with open(timing) as f:
             lines = f.read().splitlines()
             last_tick = 0
             for line in lines:
@@ -56,8 +251,19 @@ class FestivalTTS(TTSBase):
         return phonemes
 
     def do_tts(self, tts_data):
+        if self.pool is not None:
+            try:
+                tts_data.phonemes = self.pool.synth(
+                    tts_data.text, tts_data.wavout, tts_data.context)
+                return
+            except Cancelled:
+                raise
+            except Exception as ex:
+                logger.error('Festival worker error: {}'.format(ex))
+        timing = tts_data.context.get_scratch_file('timing')
+        script = tts_data.context.get_scratch_file('tts.scm')
         try:
-            with open(self.script, 'w') as f:
+            with open(script, 'w') as f:
                 f.write("""
 (voice_{voice})
 (set! utt1 (Utterance Text "{text}"))
@@ -65,29 +271,35 @@ class FestivalTTS(TTSBase):
 (utt.save.segs utt1 "{timingfile}")
 (utt.save.wave utt1 "{audiofile}")""".format(
                     voice=self.params['voice'],
-                    text=tts_data.text, timingfile=self.timing, audiofile=tts_data.wavout)
+                    text=escape(tts_data.text), timingfile=timing, audiofile=tts_data.wavout)
                 )
-            subprocess.Popen(
-                ['festival', '-b', self.script], stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE).communicate()
+            tts_data.context.run(['festival', '-b', script])
+        except Cancelled:
+            raise
         except Exception as ex:
             import traceback
             logger.error('TTS error: {}'.format(traceback.format_exc()))
             return
 
-        tts_data.phonemes = self.get_phonemes()
-        os.remove(self.timing)
-        os.remove(self.script)
+        tts_data.phonemes = self.get_phonemes(timing)
+
+def create_voice(voice):
+    api = FestivalTTS()
+    api.params['voice'] = voice
+    api.create_pool()
+    api.set_viseme_mapping(FestivalTTSVisemes())
+    return api
 
 def load_voices():
+    """
+    The voices are cheap to create, their festival processes are started
+    by start() when the server starts, so they are not lazy
+    """
     voices = defaultdict(dict)
     for voice in ['cmu_us_slt_arctic_hts', 'lp_diphone', 'pc_diphone', 'kal_diphone', 'rab_diphone']:
         try:
             logger.info("Adding {}:{}".format('festival', voice))
-            api = FestivalTTS()
-            api.params['voice'] = voice
-            voices['festival'][voice] = api
-            api.set_viseme_mapping(FestivalTTSVisemes())
+            voices['festival'][voice] = create_voice(voice)
             logger.info("{}:{} added".format('festival', voice))
         except Exception as ex:
             logger.error(ex)
@@ -0,0 +1,298 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import os
+import time
+import errno
+import Queue
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+import traceback
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+
+from ttsserver.action_parser import ActionParser
+from ttsserver import metrics
+
+logger = logging.getLogger('hr.ttsserver.archive')
+
+DEFAULT_MAX_BYTES = 512*1024*1024
+DEFAULT_QUEUE_SIZE = 64
+INDEX_FILE = 'index.sqlite'
+# Seconds to wait for another process changing the archive
+INDEX_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+"""
+
+def get_notags(text):
+    text = ActionParser().parse(text)
+    root = u'<_root_>{}</_root_>'.format(text)
+    tree = ET.fromstring(root.encode('utf-8'))
+    notags = ET.tostring(tree, encoding='utf8', method='text')
+    notags = notags.strip()
+    if len(notags) > 200:
+        notags = notags[:200]+'...' # prevent filename too long(255)
+    return notags
+
+def file_digest(fname):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(64*1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+class AudioArchive(object):
+    """
+    Archives the served audio in the background. Each distinct audio is
+    stored once under objects/ and the archived entries are hardlinks to
+    it. The oldest entries are removed once the archive is over max_bytes
+    or older than max_age seconds. When the queue is full the audio is
+    not archived.
+
+    The objects and the entries are indexed in a sqlite database, so the
+    server processes share one archive and its budget. Each change is
+    made in a write transaction, one process at a time.
+    """
+
+    def __init__(self, archive_dir, max_bytes=DEFAULT_MAX_BYTES, max_age=None,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        self.archive_dir = archive_dir
+        self.objects_dir = os.path.join(archive_dir, 'objects')
+        self.index_file = os.path.join(archive_dir, INDEX_FILE)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.worker = None
+        self.loaded = threading.Event()
+        self.dropped = 0
+
+    def is_enabled(self):
+        return self.max_bytes > 0
+
+    @property
+    def size(self):
+        """Bytes of the archived audio, of all the server processes"""
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+        finally:
+            conn.close()
+
+    def start(self):
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self._run)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def submit(self, name, text, audio_file=None, owned=False, data=None):
+        """
+        Archives audio_file, or the WAV data in memory, as
+        '<name> - <text without tags>.wav'. If the audio file is owned it
+        is moved to the archive or removed.
+        """
+        if not self.is_enabled():
+            if owned:
+                self._remove(audio_file)
+            return False
+        self.start()
+        try:
+            self.queue.put_nowait((name, text, audio_file, owned, data, time.time()))
+            return True
+        except Queue.Full:
+            self.dropped += 1
+            metrics.inc('tts_archive_dropped_total')
+            logger.warn("Archive queue is full, drop {}".format(audio_file))
+            if owned:
+                self._remove(audio_file)
+            return False
+
+    def flush(self):
+        """Waits until the queued audio is archived"""
+        if self.worker is not None:
+            self.loaded.wait()
+        self.queue.join()
+
+    def get_depth(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        try:
+            self._load()
+        except Exception as ex:
+            logger.error(traceback.format_exc())
+        finally:
+            self.loaded.set()
+        while True:
+            item = self.queue.get()
+            try:
+                with metrics.timer('tts_stage_seconds', stage='archive'):
+                    self._archive(*item)
+            except Exception as ex:
+                logger.error(traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+    def _connect(self):
+        """Returns a new index connection, the changes are in _transaction"""
+        if not os.path.isdir(self.objects_dir):
+            try:
+                os.makedirs(self.objects_dir)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        conn = sqlite3.connect(
+            self.index_file, timeout=INDEX_TIMEOUT, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction, the other processes wait for it"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _load(self):
+        """Indexes the entries archived before the archive had an index"""
+        with self._transaction() as conn:
+            if conn.execute('SELECT COUNT(*) FROM objects').fetchone()[0] == 0:
+                self._import(conn)
+            self._enforce_retention(conn)
+            count = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        logger.info("Archive has {} entries, {} bytes".format(count, self.size))
+
+    def _import(self, conn):
+        objects = set()
+        for fname in os.listdir(self.objects_dir):
+            if fname.endswith('.wav'):
+                objects.add(os.path.splitext(fname)[0])
+        entries = []
+        for fname in os.listdir(self.archive_dir):
+            path = os.path.join(self.archive_dir, fname)
+            if not fname.endswith('.wav') or not os.path.isfile(path):
+                continue
+            try:
+                digest = file_digest(path)
+            except Exception as ex:
+                logger.error(ex)
+                continue
+            if digest not in objects:
+                # archived before the objects/ layout
+                os.link(path, self._get_object(digest))
+                objects.add(digest)
+            entries.append((path, digest, os.path.getmtime(path)))
+        conn.executemany(
+            'INSERT OR REPLACE INTO entries (path, digest, timestamp) VALUES (?, ?, ?)',
+            entries)
+        used = set(digest for _, digest, _ in entries)
+        for digest in objects:
+            if digest in used:
+                conn.execute(
+                    'INSERT OR REPLACE INTO objects (digest, size) VALUES (?, ?)',
+                    (digest, os.path.getsize(self._get_object(digest))))
+            else:
+                self._remove(self._get_object(digest))
+
+    def _get_object(self, digest):
+        return os.path.join(self.objects_dir, digest+'.wav')
+
+    def _archive(self, name, text, audio_file, owned, data, timestamp):
+        try:
+            try:
+                with metrics.timer('tts_stage_seconds', stage='parse'):
+                    notags = get_notags(text)
+            except Exception as ex:
+                logger.error(ex)
+                notags = None
+            if not notags:
+                return
+            if data is not None:
+                digest = hashlib.sha1(data).hexdigest()
+            else:
+                digest = file_digest(audio_file)
+            path = os.path.join(self.archive_dir, '{} - {}.wav'.format(name, notags))
+            with self._transaction() as conn:
+                obj = self._get_object(digest)
+                row = conn.execute(
+                    'SELECT size FROM objects WHERE digest=?', (digest,)).fetchone()
+                if row is None or not os.path.isfile(obj):
+                    if data is not None:
+                        with open(obj+'.tmp', 'wb') as f:
+                            f.write(data)
+                        os.rename(obj+'.tmp', obj)
+                    elif owned:
+                        shutil.move(audio_file, obj)
+                    else:
+                        shutil.copy(audio_file, obj+'.tmp')
+                        os.rename(obj+'.tmp', obj)
+                    conn.execute(
+                        'INSERT OR REPLACE INTO objects (digest, size) VALUES (?, ?)',
+                        (digest, os.path.getsize(obj)))
+                try:
+                    os.link(obj, path)
+                except OSError as ex:
+                    logger.error(ex)
+                    return
+                conn.execute(
+                    'INSERT OR REPLACE INTO entries (path, digest, timestamp) VALUES (?, ?, ?)',
+                    (path, digest, timestamp))
+                self._enforce_retention(conn)
+        finally:
+            if owned:
+                self._remove(audio_file)
+
+    def _enforce_retention(self, conn):
+        now = time.time()
+        size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+        while True:
+            row = conn.execute(
+                'SELECT path, digest, timestamp FROM entries ORDER BY timestamp LIMIT 1').fetchone()
+            if row is None:
+                break
+            path, digest, timestamp = row
+            if size <= self.max_bytes and not (self.max_age and now - timestamp > self.max_age):
+                break
+            conn.execute('DELETE FROM entries WHERE path=?', (path,))
+            self._remove(path)
+            if conn.execute(
+                    'SELECT 1 FROM entries WHERE digest=? LIMIT 1', (digest,)).fetchone() is None:
+                size -= self._remove_object(conn, digest)
+
+    def _remove_object(self, conn, digest):
+        """Removes the object and returns its size"""
+        row = conn.execute('SELECT size FROM objects WHERE digest=?', (digest,)).fetchone()
+        conn.execute('DELETE FROM objects WHERE digest=?', (digest,))
+        self._remove(self._get_object(digest))
+        return row[0] if row else 0
+
+    def _remove(self, fname):
+        try:
+            if os.path.isfile(fname):
+                os.remove(fname)
+        except OSError as ex:
+            logger.error(ex)
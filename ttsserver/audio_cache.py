@@ -0,0 +1,237 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import os
+import json
+import time
+import errno
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from ttsserver import metrics
+
+logger = logging.getLogger('hr.ttsserver.audio_cache')
+
+DEFAULT_MAX_BYTES = 2*1024*1024*1024
+INDEX_FILE = 'index.sqlite'
+# Seconds to wait for another process writing the index
+INDEX_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    meta TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+"""
+
+def make_key(*parts):
+    """Returns the full SHA1 of the parts, the dicts in key order"""
+    sha1 = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        elif not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True)
+        sha1.update(part)
+        sha1.update('\0')
+    return sha1.hexdigest()
+
+class AudioCache(object):
+    """
+    Byte bounded LRU cache of audio files on disk. The entries are stored
+    by key under <cache_dir>/<key[:2]>/<key>.wav and indexed in a sqlite
+    database, so a lookup doesn't touch the directory and the server
+    processes share the index. An entry is written to a temporary file
+    and renamed, so a reader never sees a partial file. The least
+    recently used entries are removed once the cache is over max_bytes,
+    except the pinned ones. A max_bytes of 0 is no limit. name labels
+    the metrics.
+
+    With archive set to a CacheArchive, load() serves the entries packed
+    in it and the cache directory is the overlay the new entries go to.
+    """
+    archive = None
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, name='audio'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.name = name
+        self.index_file = os.path.join(cache_dir, INDEX_FILE)
+        self._local = threading.local()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        conn = self._connect()
+        # the readers don't wait for the writers
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(entries)')]
+        if 'meta' not in columns:
+            # indexed before the entries had metadata
+            with conn:
+                conn.execute('ALTER TABLE entries ADD COLUMN meta TEXT')
+
+    def _connect(self):
+        """Returns the index connection of the thread in this process"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.index_file, timeout=INDEX_TIMEOUT)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key+'.wav')
+
+    def load(self, key):
+        """Returns the audio and the metadata of the entry, None if it is not cached"""
+        if self.archive is not None:
+            entry = self.archive.get(self.cache_dir, key)
+            if entry is not None:
+                return entry
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        path, meta = entry
+        try:
+            with open(path, 'rb') as f:
+                return f.read(), meta
+        except IOError as ex:
+            # evicted by another process
+            logger.warn("Can't read {}: {}".format(path, ex))
+            return None
+
+    def get(self, key):
+        """Returns the file of the entry, None if it is not cached"""
+        entry = self.get_entry(key)
+        return entry and entry[0]
+
+    def get_entry(self, key):
+        """Returns the file and the metadata of the entry, None if it is not cached"""
+        path = self.get_path(key)
+        with self._connect() as conn:
+            row = conn.execute('SELECT meta FROM entries WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.isfile(path):
+                conn.execute('DELETE FROM entries WHERE key=?', (key,))
+                return None
+            conn.execute('UPDATE entries SET atime=? WHERE key=?', (time.time(), key))
+        return path, json.loads(row[0]) if row[0] else {}
+
+    def put(self, key, fname=None, data=None, pinned=False, meta=None):
+        """
+        Stores the audio file, hardlinked if it can be, or the audio data
+        and returns the file of the entry. Without either, the file
+        already written to the path of the entry is indexed. meta is a
+        dict kept with the entry.
+        """
+        path = self.get_path(key)
+        if fname is not None or data is not None:
+            self._write(path, fname, data)
+        size = os.path.getsize(path)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (key, size, atime, pinned, meta) VALUES '
+                '(?, ?, ?, COALESCE((SELECT pinned FROM entries WHERE key=?), ?), ?)',
+                (key, size, time.time(), key, int(pinned), meta and json.dumps(meta)))
+        self.evict()
+        return path
+
+    def _write(self, path, fname, data):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            if data is not None:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+            else:
+                try:
+                    os.link(fname, tmp)
+                except OSError:
+                    shutil.copy(fname, tmp)
+            os.rename(tmp, path)
+        finally:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+    def set_meta(self, key, meta):
+        """Replaces the metadata of the entry. Returns False if it is not cached."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'UPDATE entries SET meta=? WHERE key=?', (json.dumps(meta), key))
+            return cursor.rowcount > 0
+
+    def pin(self, key, pinned=True):
+        """Pins the entry so it is never evicted. Returns False if it is not cached."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'UPDATE entries SET pinned=? WHERE key=?', (int(pinned), key))
+            return cursor.rowcount > 0
+
+    def remove(self, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM entries WHERE key=?', (key,))
+        self._remove_file(self.get_path(key))
+
+    def evict(self):
+        """Removes the least recently used entries over max_bytes"""
+        if not self.max_bytes:
+            return 0
+        removed = []
+        with self._connect() as conn:
+            size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if size <= self.max_bytes:
+                return 0
+            for key, entry_size in conn.execute(
+                    'SELECT key, size FROM entries WHERE pinned=0 ORDER BY atime'):
+                if size <= self.max_bytes:
+                    break
+                removed.append(key)
+                size -= entry_size
+            conn.executemany('DELETE FROM entries WHERE key=?', [(key,) for key in removed])
+        if size > self.max_bytes:
+            logger.warn("Pinned entries of {} are over {} bytes".format(
+                self.cache_dir, self.max_bytes))
+        for key in removed:
+            self._remove_file(self.get_path(key))
+        if removed:
+            metrics.inc('tts_cache_evictions_total', len(removed), cache=self.name)
+            logger.info("Evicted {} entries of {}".format(len(removed), self.cache_dir))
+        return len(removed)
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def iter_entries(self):
+        """Yields the key and the metadata of the entries"""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT key, meta FROM entries ORDER BY key').fetchall()
+        for key, meta in rows:
+            yield key, json.loads(meta) if meta else {}
+
+    def get_stats(self):
+        with self._connect() as conn:
+            count, size, pinned = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(pinned), 0) '
+                'FROM entries').fetchone()
+        return {
+            'entries': count,
+            'size': size,
+            'pinned': pinned,
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,239 @@
+#!/usr/bin/env python2.7
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+"""
+Packs the vendor and emotive speech caches, with the timeline kept with
+each entry, into one indexed file the servers memory map read only.
+
+    python ttsserver/cache_archive.py pack ~/.hr/ttsserver cache.pack
+    python ttsserver/cache_archive.py compact ~/.hr/ttsserver cache.pack --clear
+    python ttsserver/cache_archive.py info cache.pack
+
+The layout, all the values little endian:
+
+    header  '4sBIQI'  magic 'HRCA', version, number of entries n, offset
+                      of the index, length of the namespaces JSON
+    names   JSON list of the namespaces, the cache directories relative
+            to the TTS output directory
+    data    the audio and the metadata JSON of each entry
+    index   n '<H20sQIQI' records sorted by namespace and key: namespace
+            index, SHA1 key, offset and length of the audio, offset and
+            length of the metadata
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import logging
+import binascii
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CWD, '..'))
+
+from ttsserver.audio_cache import AudioCache, INDEX_FILE
+
+logger = logging.getLogger('hr.ttsserver.cache_archive')
+
+MAGIC = 'HRCA'
+VERSION = 1
+HEADER = struct.Struct('<4sBIQI')
+RECORD = struct.Struct('<H20sQIQI')
+# namespace and key, the sort key of the records
+RECORD_KEY = struct.Struct('<H20s')
+COPY_CHUNK_SIZE = 1024*1024
+
+class ArchiveError(Exception):
+    pass
+
+class CacheArchive(object):
+    """
+    Read only, memory mapped cache archive. The entries are looked up by
+    the cache directory, relative to root, and the key.
+    """
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = os.path.realpath(os.path.expanduser(root))
+        with open(path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error) as ex:
+                # such as an empty file
+                raise ArchiveError("Bad cache archive {}: {}".format(path, ex))
+        try:
+            magic, version, self.count, self.index_offset, names_length = \
+                HEADER.unpack_from(self.mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ArchiveError("Unknown cache archive format {} {}".format(magic, version))
+            names = json.loads(self.mm[HEADER.size:HEADER.size+names_length])
+            if self.index_offset + self.count*RECORD.size > len(self.mm):
+                raise ArchiveError("Truncated cache archive {}".format(path))
+        except (struct.error, ValueError) as ex:
+            self.mm.close()
+            raise ArchiveError("Bad cache archive {}: {}".format(path, ex))
+        except ArchiveError:
+            self.mm.close()
+            raise
+        self.namespaces = dict((name, i) for i, name in enumerate(names))
+        # the namespace of each cache directory looked up
+        self.cache_dirs = {}
+        logger.info("Opened cache archive {} with {} entries".format(path, self.count))
+
+    def get_namespace(self, cache_dir):
+        namespace = self.cache_dirs.get(cache_dir)
+        if namespace is None:
+            namespace = os.path.relpath(os.path.realpath(cache_dir), self.root)
+            self.cache_dirs[cache_dir] = namespace
+        return namespace
+
+    def _find(self, namespace, key):
+        """Returns the offset of the record, None if there is none"""
+        ns = self.namespaces.get(namespace)
+        if ns is None:
+            return None
+        target = RECORD_KEY.pack(ns, binascii.unhexlify(key))
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo+hi)//2
+            offset = self.index_offset + mid*RECORD.size
+            record_key = self.mm[offset:offset+RECORD_KEY.size]
+            if record_key < target:
+                lo = mid + 1
+            elif record_key > target:
+                hi = mid
+            else:
+                return offset
+        return None
+
+    def get(self, cache_dir, key):
+        """Returns the audio and the metadata of the entry, None if there is none"""
+        offset = self._find(self.get_namespace(cache_dir), key)
+        if offset is None:
+            return None
+        _, _, audio_offset, audio_size, meta_offset, meta_size = \
+            RECORD.unpack_from(self.mm, offset)
+        meta = self.mm[meta_offset:meta_offset+meta_size]
+        return self.mm[audio_offset:audio_offset+audio_size], json.loads(meta) if meta else {}
+
+    def iter_entries(self):
+        """Yields the namespace, key, audio offset and size and metadata of the entries"""
+        names = dict((i, name) for name, i in self.namespaces.items())
+        for i in range(self.count):
+            ns, key, audio_offset, audio_size, meta_offset, meta_size = \
+                RECORD.unpack_from(self.mm, self.index_offset + i*RECORD.size)
+            meta = self.mm[meta_offset:meta_offset+meta_size]
+            yield (names[ns], binascii.hexlify(key), audio_offset, audio_size,
+                   json.loads(meta) if meta else {})
+
+    def close(self):
+        self.mm.close()
+
+def find_caches(root):
+    """Returns the namespace and the directory of the caches under root"""
+    caches = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if INDEX_FILE in filenames:
+            caches.append((os.path.relpath(dirpath, root), dirpath))
+    return sorted(caches)
+
+def write_archive(root, output, base=None):
+    """
+    Packs the caches under root into output, written to a temporary file
+    and renamed. The entries of the base archive are kept unless the
+    caches have the same key. Returns the overlay entries packed.
+    """
+    root = os.path.realpath(os.path.expanduser(root))
+    entries = {}  # (namespace, key) -> (source, location, meta)
+    if base is not None:
+        for namespace, key, offset, size, meta in base.iter_entries():
+            entries[(namespace, key)] = ('base', (offset, size), meta)
+    packed = []
+    for namespace, cache_dir in find_caches(root):
+        cache = AudioCache(cache_dir, max_bytes=0)
+        for key, meta in cache.iter_entries():
+            path = cache.get_path(key)
+            if os.path.isfile(path):
+                entries[(namespace, key)] = ('file', path, meta)
+                packed.append((cache, key))
+    names = sorted(set(namespace for namespace, _ in entries))
+    name_index = dict((name, i) for i, name in enumerate(names))
+    names_json = json.dumps(names)
+    records = []
+    tmp = '{}.{}.tmp'.format(output, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+            f.write(names_json)
+            for (namespace, key), (source, location, meta) in sorted(entries.items()):
+                audio_offset = f.tell()
+                if source == 'base':
+                    offset, size = location
+                    for start in range(offset, offset+size, COPY_CHUNK_SIZE):
+                        f.write(base.mm[start:min(start+COPY_CHUNK_SIZE, offset+size)])
+                else:
+                    with open(location, 'rb') as audio:
+                        for chunk in iter(lambda: audio.read(COPY_CHUNK_SIZE), b''):
+                            f.write(chunk)
+                audio_size = f.tell() - audio_offset
+                meta_json = json.dumps(meta) if meta else ''
+                meta_offset = f.tell()
+                f.write(meta_json)
+                records.append(RECORD.pack(
+                    name_index[namespace], binascii.unhexlify(key),
+                    audio_offset, audio_size, meta_offset, len(meta_json)))
+            index_offset = f.tell()
+            records.sort(key=lambda record: record[:RECORD_KEY.size])
+            f.write(''.join(records))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, len(records), index_offset, len(names_json)))
+            f.flush()
+            os.fsync(f.fileno())
+        # the servers keep the archive they have mapped
+        os.rename(tmp, output)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+    logger.info("Packed {} entries into {}".format(len(records), output))
+    return packed
+
+def main():
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser('HR TTS Cache Archive')
+    subparsers = parser.add_subparsers(dest='command')
+    pack_parser = subparsers.add_parser(
+        'pack', help='Pack the caches of the TTS output directory into a new archive')
+    pack_parser.add_argument('root', help='TTS output directory')
+    pack_parser.add_argument('archive', help='Archive file')
+    compact_parser = subparsers.add_parser(
+        'compact', help='Merge the caches of the TTS output directory into the archive')
+    compact_parser.add_argument('root', help='TTS output directory')
+    compact_parser.add_argument('archive', help='Archive file')
+    compact_parser.add_argument(
+        '--clear', action='store_true',
+        help='Remove the merged entries from the caches')
+    info_parser = subparsers.add_parser('info', help='Show the entries of the archive')
+    info_parser.add_argument('archive', help='Archive file')
+    option = parser.parse_args()
+
+    if option.command == 'info':
+        archive = CacheArchive(option.archive, '.')
+        counts = {}
+        for namespace, _, _, size, _ in archive.iter_entries():
+            count, total = counts.get(namespace, (0, 0))
+            counts[namespace] = (count+1, total+size)
+        for namespace, (count, total) in sorted(counts.items()):
+            print '{:<40} {:>8} entries {:>12} bytes'.format(namespace, count, total)
+        return
+    base = None
+    if option.command == 'compact' and os.path.isfile(option.archive):
+        base = CacheArchive(option.archive, option.root)
+    packed = write_archive(option.root, option.archive, base)
+    if base is not None:
+        base.close()
+    if option.command == 'compact' and option.clear:
+        for cache, key in packed:
+            cache.remove(key)
+        logger.info("Removed {} entries from the caches".format(len(packed)))
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,71 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2013-2019 Hanson Robotics, Ltd. 
 
+import os
 import sys
+import time
+import hashlib
+import random
 import requests
+from requests.adapters import HTTPAdapter
+import json
 import base64
 import logging
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from ttsserver import transcode
+from ttsserver import timeline
 
 DEFAULT_HOST = 'localhost'
 DEFAULT_PORT = 10001
+ASYNC_WORKERS = 4
+JOB_POLL_WAIT = 10
+STREAM_CHUNK_SIZE = 64*1024
+# Number of pooled keep-alive connections to the server
+POOL_SIZE = 8
+# Number of times an idempotent request is retried
+RETRIES = 2
+# Base and max seconds of the jittered exponential backoff between retries
+BACKOFF = 0.1
+MAX_BACKOFF = 2
+RETRY_STATUS = (502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
+PING_TIMEOUT = 2
+TIMEOUT_HEADER = 'X-TTS-Timeout'
+CACHE_SIZE = 256*1024*1024
 
 logger = logging.getLogger('hr.ttserver.client')
 
+def read_parts(r):
+    """
+    Yields the content type and the body of the parts of a streamed
+    multipart response. Every part must have a Content-Length.
+    """
+    boundary = '--' + r.headers['Content-Type'].split('boundary=')[1]
+    chunks = r.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+    buf = ''
+    while True:
+        while '\r\n\r\n' not in buf:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            buf += chunk
+        header, buf = buf.split('\r\n\r\n', 1)
+        lines = header.strip().split('\r\n')
+        if lines[0] != boundary:
+            raise ValueError("Bad multipart boundary {}".format(lines[0]))
+        headers = dict(line.split(': ', 1) for line in lines[1:])
+        length = int(headers['Content-Length'])
+        while len(buf) < length:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError("Truncated multipart response")
+            buf += chunk
+        yield headers['Content-Type'], buf[:length]
+        buf = buf[length:]
+
 class TTSResponse(object):
 
     def __init__(self):
@@ -23,11 +78,23 @@ class TTSResponse(object):
             return self.response.get('duration', 0)
         return 0
 
+    def get_codec(self):
+        if self.response and 'codec' in self.response:
+            return self.response['codec']['codec']
+        return 'wav'
+
     def write(self, wavfile):
+        """
+        Writes the audio to wavfile. The audio in another codec is decoded
+        to WAV unless wavfile has the extension of the codec.
+        """
         if self.response:
             data = self.response['data']
             data = base64.b64decode(data)
+            codec = self.get_codec()
             try:
+                if not wavfile.endswith(transcode.get_extension(codec)):
+                    data = transcode.decode(data, codec)
                 with open(wavfile, 'wb') as f:
                     f.write(data)
                 logger.info("Write to file {}".format(wavfile))
@@ -46,14 +113,167 @@ class TTSResponse(object):
         return "<TTSResponse params {}, duration {}>".format(
             self.params, self.get_duration())
 
+class DiskCache(object):
+    """
+    Size bounded (in bytes) LRU cache of the server responses on disk. Each
+    entry is a file with the ETag on the first line followed by the body.
+    """
+
+    def __init__(self, cache_dir, max_bytes=CACHE_SIZE):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # name -> size, least recently used first
+        self.size = 0
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif os.path.isfile(path):
+                files.append((os.path.getmtime(path), name, os.path.getsize(path)))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    @staticmethod
+    def make_key(route, params):
+        params = dict((k, v) for k, v in params.items() if k != 'timeout')
+        key = json.dumps([route, sorted(params.items())])
+        return hashlib.sha1(key).hexdigest()
+
+    def get(self, key):
+        """Returns the ETag and the body, None if it is not cached"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries[key] = self.entries.pop(key)
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, 'rb') as f:
+                etag = f.readline().rstrip('\n')
+                body = f.read()
+            os.utime(path, None)
+            return etag, body
+        except (IOError, OSError) as ex:
+            logger.error(ex)
+            self._remove(key)
+
+    def put(self, key, etag, body):
+        path = os.path.join(self.cache_dir, key)
+        tmp = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(etag + '\n')
+                f.write(body)
+            os.rename(tmp, path)
+        except (IOError, OSError) as ex:
+            logger.error(ex)
+            return
+        size = len(etag) + 1 + len(body)
+        with self.lock:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            evicted = []
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                name, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(name)
+        for name in evicted:
+            self._unlink(name)
+
+    def _remove(self, key):
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+        self._unlink(key)
+
+    def _unlink(self, name):
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
 class Client(object):
 
     VERSION = 'v1.0'
 
-    def __init__(self, host=None, port=None):
+    def __init__(self, host=None, port=None, retries=RETRIES, backoff=BACKOFF,
+                 deadline=None, cache_dir=None, cache_size=CACHE_SIZE):
+        """
+        The idempotent requests are retried up to retries times, waiting a
+        random time up to backoff*2^attempt seconds, and given up after
+        deadline seconds in total. With cache_dir the responses are cached
+        on disk, up to cache_size bytes, and revalidated with the server.
+        """
         self.host = host or DEFAULT_HOST
         self.port = port or DEFAULT_PORT
         self.root_url = 'http://{}:{}/{}'.format(self.host, self.port, Client.VERSION)
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.cache = cache_dir and DiskCache(cache_dir, cache_size)
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # the session keeps the connections alive and is shared by the threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def get_backoff(self, attempt, r=None):
+        """Returns the seconds to wait before the retry attempt"""
+        if r is not None and r.headers.get('Retry-After', '').isdigit():
+            return float(r.headers['Retry-After'])
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff*2**attempt))
+
+    def request(self, method, route, **kwargs):
+        """
+        Sends the request on the pooled session. The idempotent requests
+        are retried on connection errors and on 502, 503 and 504 until the
+        retries or the deadline run out, by default the timeout of the call.
+        The server is told the timeout of each attempt so it can give up on
+        the TTS when the client does.
+        """
+        url = '{}/{}'.format(self.root_url, route)
+        timeout = kwargs.pop('timeout', None)
+        headers = dict(kwargs.pop('headers', None) or {})
+        # without a deadline the timeout of the call bounds the retries
+        deadline = self.deadline or timeout
+        deadline = deadline and time.time() + deadline
+        retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        attempt = 0
+        while True:
+            attempt_timeout = timeout
+            if deadline:
+                remaining = deadline - time.time()
+                attempt_timeout = min(timeout or remaining, remaining)
+            if attempt_timeout:
+                headers[TIMEOUT_HEADER] = '{:.3f}'.format(max(attempt_timeout, 0))
+            error = None
+            try:
+                r = self.session.request(method, url, timeout=attempt_timeout,
+                                         headers=headers, **kwargs)
+                if r.status_code not in RETRY_STATUS:
+                    return r
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                r, error = None, ex
+            attempt += 1
+            delay = self.get_backoff(attempt, r)
+            # a timeout or a 504 is not retried past the deadline either
+            if attempt > retries or (deadline and time.time() + delay >= deadline):
+                if error is not None:
+                    raise error
+                return r
+            logger.warn("Retry {} {} in {:.2f} seconds, {}".format(
+                method, route, delay, error or r.status_code))
+            if r is not None:
+                r.close()
+            time.sleep(delay)
 
     def tts(self, text, **kwargs):
         params = {
@@ -63,24 +283,166 @@ class Client(object):
         timeout = kwargs.get('timeout')
         result = TTSResponse()
         try:
-            r = requests.get(
-                '{}/tts'.format(self.root_url), params=params, timeout=timeout)
-            if r.status_code == 200:
-                response = r.json().get('response')
+            body = self.get_body('tts', params, timeout)
+            if body is not None:
+                response = json.loads(body).get('response')
+                if 'timeline' in response:
+                    # asked for with timeline='binary'
+                    response.update(timeline.decode(
+                        base64.b64decode(response.pop('timeline'))))
                 result.response = response
                 result.params = params
+        except Exception as ex:
+            logger.error("TTS Error {}".format(ex))
+        return result
+
+    def get_body(self, route, params, timeout=None):
+        """
+        Returns the response body, from the disk cache if the server says
+        it is still current or can't be reached. None on error.
+        """
+        key = cached = None
+        headers = {}
+        if self.cache:
+            key = DiskCache.make_key(route, params)
+            cached = self.cache.get(key)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+        try:
+            r = self.request('GET', route, params=params, headers=headers,
+                             timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            if cached is None:
+                raise
+            logger.warn("Use the cached response, {}".format(ex))
+            return cached[1]
+        if r.status_code == 304 and cached is not None:
+            return cached[1]
+        if r.status_code != 200:
+            logger.error("Error code: {}".format(r.status_code))
+            return None
+        etag = r.headers.get('ETag')
+        if self.cache and etag:
+            self.cache.put(key, etag, r.content)
+        return r.content
+
+    def tts_audio(self, text, wavfile, **kwargs):
+        """Streams the raw WAV audio to wavfile without the timeline"""
+        params = {
+            'text': text,
+        }
+        params.update(kwargs)
+        timeout = kwargs.get('timeout')
+        try:
+            r = self.request(
+                'GET', 'tts/audio', params=params, timeout=timeout, stream=True)
+            if r.status_code == 200:
+                with open(wavfile, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=64*1024):
+                        f.write(chunk)
+                logger.info("Write to file {}".format(wavfile))
+                return True
             else:
                 logger.error("Error code: {}".format(r.status_code))
         except Exception as ex:
             logger.error("TTS Error {}".format(ex))
+        return False
+
+    def tts_stream(self, text, **kwargs):
+        """
+        Synthesises the text sentence by sentence. Yields the TTSResponse of
+        each sentence as soon as it is received, with the timeline moved by
+        the offset of the sentence in the text.
+        """
+        params = {
+            'text': text,
+        }
+        params.update(kwargs)
+        timeout = kwargs.get('timeout')
+        r = self.request(
+            'GET', 'tts/stream', params=params, timeout=timeout, stream=True)
+        if r.status_code != 200:
+            logger.error("Error code: {}".format(r.status_code))
+            return
+        response = None
+        for content_type, data in read_parts(r):
+            if content_type == 'application/json':
+                response = json.loads(data).get('response')
+                if 'error' in response:
+                    logger.error("TTS Error {}".format(response['error']))
+                    return
+            elif content_type.startswith('audio/') and response is not None:
+                result = TTSResponse()
+                result.response = dict(response, data=base64.b64encode(data))
+                result.params = params
+                yield result
+
+    def job_tts(self, text, **kwargs):
+        """Runs the TTS as a server job and waits for the result"""
+        params = dict(kwargs)
+        timeout = params.pop('timeout', None)
+        job = {
+            'vendor': params.pop('vendor', None),
+            'voice': params.pop('voice', None),
+            'text': text,
+            'params': params,
+        }
+        result = TTSResponse()
+        deadline = timeout and time.time() + timeout
+        try:
+            r = self.request('POST', 'jobs', json=job, timeout=timeout)
+            if r.status_code != 202:
+                logger.error("Error code: {}".format(r.status_code))
+                return result
+            job_id = r.json()['response']['id']
+            while True:
+                wait = JOB_POLL_WAIT
+                if deadline:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        logger.error("TTS job {} timed out".format(job_id))
+                        return result
+                    wait = min(wait, JOB_POLL_WAIT)
+                r = self.request(
+                    'GET', 'jobs/{}'.format(job_id), params={'wait': wait},
+                    timeout=wait+5)
+                if r.status_code != 200:
+                    logger.error("Error code: {}".format(r.status_code))
+                    return result
+                response = r.json()['response']
+                if response['status'] == 'done':
+                    result.response = response['result']['response']
+                    result.params = dict(kwargs, text=text)
+                    return result
+                if response['status'] == 'failed':
+                    logger.error("TTS job failed {}".format(response.get('error')))
+                    return result
+        except Exception as ex:
+            logger.error("TTS Error {}".format(ex))
+        return result
+
+    def _run_async(self, text, callback, kwargs):
+        result = self.job_tts(text, **kwargs)
+        if callback is not None:
+            try:
+                callback(result)
+            except Exception as ex:
+                logger.exception(ex)
         return result
 
     def asynctts(self, text, callback, **kwargs):
-        pass
+        """
+        Runs the TTS in the background and calls callback with the
+        TTSResponse. Returns the AsyncResult of the TTSResponse.
+        """
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(ASYNC_WORKERS)
+        return self.pool.apply_async(self._run_async, (text, callback, kwargs))
 
     def ping(self):
         try:
-            r = requests.get('{}/ping'.format(self.root_url))
+            r = self.request('GET', 'ping', timeout=PING_TIMEOUT)
             response = r.json().get('response')
             if response['message'] == 'pong':
                 return True
@@ -9,51 +9,15 @@ import os
 import sys
 import argparse
 from optparse import OptionParser
+from params import DEFAULT_PARAMS, PRESET_EMO_PARAMS, resolve_params
 
-DEFAULT_PARAMS = {
-    'chunk_size': 1024,
-    'semitones': 1.0,
-    'cutfreq': 4000,
-    'gain': 3.0,
-    'qfactor': 1.0,
-    'speed': 8.5,
-    'depth': 60,
-    'tempo': 1.0,
-    'intensity': 3.0,
-    'parameter_control': 1.0,
-}
-
-PRESET_EMO_PARAMS = {
-    'happy': {
-        'semitones': 1.5,
-        'tempo': 1.1,
-    },
-    'sad': {
-        'semitones': -1.5,
-        'gain': 0.25,
-        'cutfreq': 3500.0,
-        'tempo': 0.95,
-    },
-    'happy_tensed': {
-        'semitones': 2.0,
-        'tempo': 1.18,
-    },
-    'afraid': {
-        'tempo': 1.05
-    },
-}
-
-def emotive_speech(fname,ofile,emotion,**kwargs):
+def emotive_transformer(fname,emotion,check=None,**kwargs):
     """
-    A Caller Module
-    Parameter:  fname
-                ofile
-                emotion
-    Returns: output
+    Analyses the speech and returns the sox Transformer that gives it
+    the emotion. check is called between the analysis steps, it can
+    raise to stop the analysis.
     """
-    params = {}
-    params.update(DEFAULT_PARAMS)
-    params.update(kwargs)
+    params = resolve_params(emotion, **kwargs)
     chunk_size = int(params['chunk_size'])
     semitones = float(params['semitones'])
     cutfreq = float(params['cutfreq'])
@@ -64,21 +28,42 @@ def emotive_speech(fname,ofile,emotion,**kwargs):
     tempo = float(params['tempo'])
     intensity = float(params['intensity'])
     parameter_control = float(params['parameter_control'])
+    check = check or (lambda: None)
 
     fs, x = prep.wave_file_read(fname)
+    check()
     time_stamps = bp.process_variables(x, fs, chunk_size)[0]
     consecutive_blocks = bp.process_variables(x, fs, chunk_size)[1]
+    check()
     fundamental_frequency_in_blocks = bp.batch_analysis(x, fs, chunk_size)[0]
+    check()
     voiced_samples = bp.batch_analysis(x, fs, chunk_size)[1]
+    check()
     rms = bp.batch_analysis(x, fs, chunk_size)[2]
+    check()
     selected_inflect_block = bp.batch_preprocess(
         fundamental_frequency_in_blocks,
         voiced_samples,
         rms)
-    output = bp.batch_synthesis(
+    return bp.batch_synthesis(
         fs,consecutive_blocks,time_stamps,selected_inflect_block,
         emotion,semitones,cutfreq,gain,qfactor,speed,depth,
         tempo,intensity,parameter_control)
+
+def get_sox_command(transformer,fname,ofile):
+    """Returns the sox command the transformer runs to build ofile"""
+    return (['sox'] + transformer.globals + transformer.input_format + [fname] +
+            transformer.output_format + [ofile] + transformer.effects)
+
+def emotive_speech(fname,ofile,emotion,**kwargs):
+    """
+    A Caller Module
+    Parameter:  fname
+                ofile
+                emotion
+    Returns: output
+    """
+    output = emotive_transformer(fname, emotion, **kwargs)
     output.build(fname, ofile)
     return output
 
@@ -0,0 +1,48 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+"""
+The emotive speech params, apart from the DSP so they load fast
+"""
+
+DEFAULT_PARAMS = {
+    'chunk_size': 1024,
+    'semitones': 1.0,
+    'cutfreq': 4000,
+    'gain': 3.0,
+    'qfactor': 1.0,
+    'speed': 8.5,
+    'depth': 60,
+    'tempo': 1.0,
+    'intensity': 3.0,
+    'parameter_control': 1.0,
+}
+
+PRESET_EMO_PARAMS = {
+    'happy': {
+        'semitones': 1.5,
+        'tempo': 1.1,
+    },
+    'sad': {
+        'semitones': -1.5,
+        'gain': 0.25,
+        'cutfreq': 3500.0,
+        'tempo': 0.95,
+    },
+    'happy_tensed': {
+        'semitones': 2.0,
+        'tempo': 1.18,
+    },
+    'afraid': {
+        'tempo': 1.05
+    },
+}
+
+def resolve_params(emotion,**kwargs):
+    """
+    Returns the DSP params of the emotion, the defaults updated with the
+    preset of the emotion and then with the params given in kwargs
+    """
+    params = {}
+    params.update(DEFAULT_PARAMS)
+    params.update(PRESET_EMO_PARAMS.get(emotion, {}))
+    params.update((k, v) for k, v in kwargs.items() if k in DEFAULT_PARAMS)
+    return dict((k, float(v)) for k, v in params.items())
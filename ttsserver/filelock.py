@@ -0,0 +1,89 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import os
+import errno
+import fcntl
+import zlib
+import hashlib
+
+# Number of lock files in a lock directory. The keys share them so the
+# lock files don't pile up next to the cache entries.
+LOCK_STRIPES = 64
+LOCK_DIR = '.locks'
+
+class FileLock(object):
+    """
+    Lock on a key of a directory shared by the server processes, such as
+    a cache entry. It is held with flock, so it is released when the
+    process dies, and it excludes the other threads of the process too.
+
+    With stripes None the key has a lock file of its own, so the keys held
+    for long don't hold up the others. The file is removed on release.
+    """
+
+    def __init__(self, directory, key, stripes=LOCK_STRIPES):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if stripes is None:
+            name = hashlib.sha1(key).hexdigest()
+        else:
+            name = zlib.crc32(key) % stripes
+        self.lock_dir = os.path.join(directory, LOCK_DIR)
+        self.path = os.path.join(self.lock_dir, '{}.lock'.format(name))
+        self.remove = stripes is None
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        if self.fd is not None:
+            raise RuntimeError("Lock {} is already acquired".format(self.path))
+        try:
+            os.makedirs(self.lock_dir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as ex:
+                os.close(fd)
+                if ex.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            if not self.remove or self._is_current(fd):
+                break
+            # the holder removed the file, lock the one at the path now
+            os.close(fd)
+        self.fd = fd
+        return True
+
+    def _is_current(self, fd):
+        """Returns True if the file locked is the one at the path"""
+        try:
+            stat = os.stat(self.path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                os.close(fd)
+                raise
+            return False
+        locked = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino) == (locked.st_dev, locked.st_ino)
+
+    def release(self):
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            if self.remove:
+                # removed while locked, so no one else holds it
+                try:
+                    os.remove(self.path)
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
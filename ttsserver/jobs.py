@@ -0,0 +1,366 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import os
+import time
+import uuid
+import errno
+import Queue
+import sqlite3
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger('hr.ttsserver.jobs')
+
+# Lower value runs first
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 10
+# Seconds to wait for another process changing the job store
+STORE_TIMEOUT = 30
+# Seconds between the reads of a job run by another process
+STORE_POLL_INTERVAL = 0.1
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    group_id TEXT,
+    position INTEGER,
+    pid INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    finished REAL,
+    error TEXT,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS groups (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_group ON jobs (group_id);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+"""
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno != errno.ESRCH
+    return True
+
+class Job(object):
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, func, args=(), kwargs=None, priority=PRIORITY_HIGH):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.priority = priority
+        self.status = Job.QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._done = threading.Event()
+
+    def run(self):
+        self.status = Job.RUNNING
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self.status = Job.DONE
+        except Exception as ex:
+            logger.error(traceback.format_exc())
+            self.error = str(ex)
+            self.status = Job.FAILED
+        finally:
+            self.finished = time.time()
+            self._done.set()
+
+    def is_finished(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.is_finished()
+
+    def to_dict(self):
+        job = {
+            'id': self.id,
+            'status': self.status,
+            'created': self.created,
+            'finished': self.finished,
+        }
+        if self.error is not None:
+            job['error'] = self.error
+        return job
+
+    def __repr__(self):
+        return "<Job id {}, status {}>".format(self.id, self.status)
+
+class JobGroup(object):
+    """Tracks the progress of a set of jobs"""
+
+    def __init__(self, jobs):
+        self.id = uuid.uuid4().hex
+        self.jobs = jobs
+        self.created = time.time()
+
+    def is_finished(self):
+        return all(job.is_finished() for job in self.jobs)
+
+    def get_finished_time(self):
+        if self.is_finished():
+            return max([job.finished for job in self.jobs] or [self.created])
+
+    def to_dict(self):
+        counts = dict((status, 0) for status in [
+            Job.QUEUED, Job.RUNNING, Job.DONE, Job.FAILED])
+        for job in self.jobs:
+            counts[job.status] += 1
+        group = {
+            'id': self.id,
+            'status': Job.DONE if self.is_finished() else Job.RUNNING,
+            'total': len(self.jobs),
+            'created': self.created,
+            'finished': self.get_finished_time(),
+            'errors': [{'index': i, 'error': job.error}
+                       for i, job in enumerate(self.jobs) if job.error is not None],
+        }
+        group.update(counts)
+        return group
+
+class StoredJob(Job):
+    """A job read from the JobStore, run by another process"""
+
+    def __init__(self, store, row):
+        self.store = store
+        (self.id, self.status, self.created, self.finished, self.error,
+         self.result) = row
+
+    def is_finished(self):
+        return self.status in (Job.DONE, Job.FAILED)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.is_finished():
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(STORE_POLL_INTERVAL)
+            job = self.store.load(self.id)
+            if job is None:
+                break
+            self.status, self.finished = job.status, job.finished
+            self.error, self.result = job.error, job.result
+        return self.is_finished()
+
+    def __repr__(self):
+        return "<StoredJob id {}, status {}>".format(self.id, self.status)
+
+class JobStore(object):
+    """
+    Keeps the state of the jobs in a sqlite database, so the server
+    processes report the jobs run by each other. A job that was not
+    finished by its process, which exited since, is failed.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        conn = self._connect()
+        try:
+            # the jobs of the previous server are gone
+            conn.execute('DELETE FROM jobs')
+            conn.execute('DELETE FROM groups')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.fname, timeout=STORE_TIMEOUT, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(STORE_SCHEMA)
+        return conn
+
+    def add(self, job):
+        """Adds the job of this process"""
+        conn = self._connect()
+        try:
+            conn.execute(
+                'INSERT INTO jobs VALUES (?, NULL, NULL, ?, ?, ?, ?, ?, ?)',
+                (job.id, os.getpid(), job.status, job.created, job.finished,
+                 job.error, job.result))
+        finally:
+            conn.close()
+
+    def save(self, job):
+        conn = self._connect()
+        try:
+            conn.execute(
+                'UPDATE jobs SET status=?, finished=?, error=?, result=? WHERE id=?',
+                (job.status, job.finished, job.error, job.result, job.id))
+        finally:
+            conn.close()
+
+    def save_group(self, group):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT INTO groups VALUES (?, ?)', (group.id, group.created))
+            for position, job in enumerate(group.jobs):
+                conn.execute('UPDATE jobs SET group_id=?, position=? WHERE id=?',
+                             (group.id, position, job.id))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _select(self, conn, where, args):
+        jobs = []
+        for row in conn.execute(
+                'SELECT id, pid, status, created, finished, error, result FROM jobs '
+                'WHERE {} ORDER BY position'.format(where), args).fetchall():
+            row = list(row)
+            pid = row.pop(1)
+            if row[1] in (Job.QUEUED, Job.RUNNING) and not is_running(pid):
+                row[1], row[3] = Job.FAILED, time.time()
+                row[4] = "The server process of the job exited"
+                conn.execute(
+                    'UPDATE jobs SET status=?, finished=?, error=? WHERE id=?',
+                    (row[1], row[3], row[4], row[0]))
+            jobs.append(StoredJob(self, row))
+        return jobs
+
+    def load(self, job_id):
+        conn = self._connect()
+        try:
+            jobs = self._select(conn, 'id=?', (job_id,))
+        finally:
+            conn.close()
+        return jobs[0] if jobs else None
+
+    def load_group(self, group_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                'SELECT created FROM groups WHERE id=?', (group_id,)).fetchone()
+            if row is None:
+                return None
+            group = JobGroup(self._select(conn, 'group_id=?', (group_id,)))
+        finally:
+            conn.close()
+        group.id, group.created = group_id, row[0]
+        return group
+
+    def purge(self, ttl):
+        expired = time.time() - ttl
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM jobs WHERE finished < ?', (expired,))
+            conn.execute('DELETE FROM groups WHERE created < ? AND id NOT IN '
+                         '(SELECT group_id FROM jobs WHERE group_id IS NOT NULL)',
+                         (expired,))
+        finally:
+            conn.close()
+
+class JobQueue(object):
+    """
+    Runs the jobs on a pool of worker threads, lowest priority value
+    first, and keeps the finished jobs for ttl seconds. With a JobStore
+    the jobs run by the other processes of the store are found too.
+    """
+
+    def __init__(self, num_workers=2, ttl=300):
+        self.num_workers = num_workers
+        self.ttl = ttl
+        self.queue = Queue.PriorityQueue()
+        self.jobs = {}
+        self.groups = {}
+        self.lock = threading.Lock()
+        self.workers = []
+        self.sequence = 0
+        self.store = None
+
+    def start(self):
+        with self.lock:
+            while len(self.workers) < self.num_workers:
+                worker = threading.Thread(target=self._run)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def _run(self):
+        while True:
+            _, _, job = self.queue.get()
+            if self.store is not None:
+                job.status = Job.RUNNING
+                self._save(job)
+            job.run()
+            self._save(job)
+            self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        priority = kwargs.pop('priority', PRIORITY_HIGH)
+        job = Job(func, args, kwargs, priority)
+        self.purge_expired()
+        with self.lock:
+            self.jobs[job.id] = job
+            # the sequence keeps the jobs of the same priority in order
+            self.sequence += 1
+            sequence = self.sequence
+        if self.store is not None:
+            self.store.add(job)
+        self.queue.put((priority, sequence, job))
+        if not self.workers:
+            self.start()
+        return job
+
+    def _save(self, job):
+        if self.store is None:
+            return
+        try:
+            self.store.save(job)
+        except Exception as ex:
+            logger.error("Can't save job {}: {}".format(job.id, ex))
+
+    def submit_group(self, func, args_list, priority=PRIORITY_HIGH):
+        """Submits a job for each args in args_list as one group"""
+        jobs = [self.submit(func, *args, priority=priority) for args in args_list]
+        group = JobGroup(jobs)
+        with self.lock:
+            self.groups[group.id] = group
+        if self.store is not None:
+            self.store.save_group(group)
+        return group
+
+    def get_group(self, group_id):
+        self.purge_expired()
+        with self.lock:
+            group = self.groups.get(group_id)
+        if group is None and self.store is not None:
+            group = self.store.load_group(group_id)
+        return group
+
+    def get(self, job_id):
+        self.purge_expired()
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.load(job_id)
+        return job
+
+    def purge_expired(self):
+        now = time.time()
+        with self.lock:
+            expired = [id for id, job in self.jobs.items()
+                       if job.finished is not None and now - job.finished > self.ttl]
+            for id in expired:
+                del self.jobs[id]
+            expired = [id for id, group in self.groups.items()
+                       if group.is_finished() and now - group.get_finished_time() > self.ttl]
+            for id in expired:
+                del self.groups[id]
+        if self.store is not None:
+            self.store.purge(self.ttl)
+
+    def get_depth(self):
+        return self.queue.qsize()
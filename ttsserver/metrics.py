@@ -0,0 +1,142 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger('hr.ttsserver.metrics')
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Number of recent samples the quantiles are computed from
+WINDOW = 1024
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, escape(v)) for k, v in labels))
+
+def escape(value):
+    if value is None:
+        return ''
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    return repr(float(value))
+
+class Summary(object):
+    """Count, sum and quantiles over a sliding window of observations"""
+
+    def __init__(self, window=WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.samples.append(value)
+            self.count += 1
+            self.sum += value
+
+    def get_quantiles(self, quantiles=QUANTILES):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return [(q, float('nan')) for q in quantiles]
+        return [(q, samples[min(int(q*len(samples)), len(samples)-1)])
+                for q in quantiles]
+
+class Registry(object):
+    """
+    Holds the summaries, counters and gauges and renders them in the
+    Prometheus text format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.summaries = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                summary = self.summaries[key] = Summary()
+        summary.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, func, **labels):
+        """Registers func to be called for the gauge value when rendered"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = func
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time()-start, **labels)
+
+    def _header(self, lines, name, type):
+        if name in self.help:
+            lines.append('# HELP {} {}'.format(name, self.help[name]))
+        lines.append('# TYPE {} {}'.format(name, type))
+
+    def render(self):
+        with self.lock:
+            summaries = sorted(self.summaries.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+        lines = []
+        last_name = None
+        for (name, labels), summary in summaries:
+            if name != last_name:
+                self._header(lines, name, 'summary')
+                last_name = name
+            for q, value in summary.get_quantiles():
+                lines.append('{}{} {}'.format(
+                    name, format_labels(labels+(('quantile', q),)), format_value(value)))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(summary.sum)))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), summary.count))
+        for (name, labels), value in counters:
+            if name != last_name:
+                self._header(lines, name, 'counter')
+                last_name = name
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        for (name, labels), func in gauges:
+            if name != last_name:
+                self._header(lines, name, 'gauge')
+                last_name = name
+            try:
+                value = func()
+            except Exception as ex:
+                logger.error(ex)
+                continue
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+registry.describe('tts_stage_seconds', 'Time spent in each stage of the TTS requests')
+registry.describe('tts_cache_total', 'Cache lookups by cache and result')
+registry.describe('tts_cache_evictions_total', 'Entries evicted from the disk caches')
+registry.describe('tts_queue_depth', 'Number of queued jobs')
+registry.describe('tts_inflight', 'Number of TTS requests being served')
+
+observe = registry.observe
+inc = registry.inc
+gauge = registry.gauge
+timer = registry.timer
@@ -0,0 +1,196 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+"""
+Pre-forking WSGI server. The master binds the socket and forks the
+workers, which accept on the shared socket and serve the requests with
+threads. Whatever is loaded before run(), like the voices, is shared by
+the workers copy-on-write.
+
+SIGTERM and SIGINT stop the workers gracefully, SIGHUP recycles them.
+A worker is also recycled after max_requests requests.
+"""
+import os
+import time
+import errno
+import random
+import signal
+import socket
+import logging
+import threading
+from werkzeug.serving import ThreadedWSGIServer
+from werkzeug.wsgi import ClosingIterator
+
+logger = logging.getLogger('hr.ttsserver.prefork')
+
+# Seconds a stopping worker waits for its requests to finish
+GRACEFUL_TIMEOUT = 30
+# Share of max_requests added at random so the workers don't recycle at once
+MAX_REQUESTS_JITTER = 0.1
+# Seconds to wait before replacing a worker that failed
+RESPAWN_DELAY = 1
+BACKLOG = 128
+
+def close_connection(start_response):
+    """Tells the client not to send more requests on the connection"""
+    def _start_response(status, headers, exc_info=None):
+        headers = [(k, v) for k, v in headers if k.lower() != 'connection']
+        return start_response(status, headers+[('Connection', 'close')], exc_info)
+    return _start_response
+
+class Worker(object):
+    """Serves the requests of the shared socket in a forked process"""
+
+    def __init__(self, app, sock, max_requests=0, graceful_timeout=GRACEFUL_TIMEOUT):
+        self.app = app
+        self.sock = sock
+        self.max_requests = max_requests
+        if max_requests:
+            self.max_requests += random.randint(0, int(max_requests*MAX_REQUESTS_JITTER))
+        self.graceful_timeout = graceful_timeout
+        self.requests = 0
+        self.active = 0
+        self.cond = threading.Condition()
+        self.server = None
+        self.stopping = False
+
+    def __call__(self, environ, start_response):
+        with self.cond:
+            self.requests += 1
+            self.active += 1
+            recycle = self.max_requests and self.requests >= self.max_requests
+        if recycle:
+            logger.info("Worker {} served {} requests, recycle it".format(
+                os.getpid(), self.requests))
+            self.stop()
+        if self.stopping:
+            start_response = close_connection(start_response)
+        try:
+            result = self.app(environ, start_response)
+        except Exception:
+            self._done()
+            raise
+        # the request is active until its response is sent
+        return ClosingIterator(result, self._done)
+
+    def _done(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def stop(self, *args):
+        """Stops accepting the requests"""
+        if self.stopping:
+            return
+        self.stopping = True
+        # shutdown waits for serve_forever, which may run in this thread
+        stopper = threading.Thread(target=self.server.shutdown)
+        stopper.daemon = True
+        stopper.start()
+
+    def run(self):
+        host = self.sock.getsockname()[0]
+        self.server = ThreadedWSGIServer(host, 0, self, fd=self.sock.fileno())
+        # the other workers may accept the connection first
+        self.server.socket.setblocking(0)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.stop)
+        self.server.serve_forever()
+        deadline = time.time() + self.graceful_timeout
+        with self.cond:
+            while self.active > 0 and time.time() < deadline:
+                self.cond.wait(min(1, max(0, deadline-time.time())))
+            if self.active > 0:
+                logger.warn("Worker {} exits with {} requests in progress".format(
+                    os.getpid(), self.active))
+
+class PreforkServer(object):
+
+    def __init__(self, app, host, port, workers, max_requests=0,
+                 graceful_timeout=GRACEFUL_TIMEOUT, on_worker_start=None):
+        """on_worker_start is called in each worker before it serves"""
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.on_worker_start = on_worker_start
+        self.sock = None
+        self.workers = set()
+        self.stopping = False
+
+    def bind(self):
+        """Binds the socket and returns its port"""
+        if self.sock is None:
+            family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((self.host, self.port))
+            self.sock.listen(BACKLOG)
+        return self.sock.getsockname()[1]
+
+    def spawn(self):
+        pid = os.fork()
+        if pid != 0:
+            self.workers.add(pid)
+            return pid
+        status = 0
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            random.seed()
+            if self.on_worker_start is not None:
+                self.on_worker_start()
+            Worker(self.app, self.sock, self.max_requests, self.graceful_timeout).run()
+        except BaseException:
+            logger.exception("Worker {} failed".format(os.getpid()))
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except OSError as ex:
+                if ex.errno != errno.ESRCH:
+                    raise
+
+    def stop(self, *args):
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def reload(self, *args):
+        logger.info("Recycle the workers")
+        self.signal_workers(signal.SIGTERM)
+
+    def run(self):
+        port = self.bind()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        logger.info("Serve on {}:{} with {} workers".format(
+            self.host, port, self.num_workers))
+        for _ in range(self.num_workers):
+            self.spawn()
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                if ex.errno == errno.ECHILD:
+                    break
+                raise
+            if pid not in self.workers:
+                continue
+            self.workers.discard(pid)
+            if self.stopping:
+                continue
+            if status != 0:
+                logger.error("Worker {} exited with status {}".format(pid, status))
+                time.sleep(RESPAWN_DELAY)
+            logger.info("Replace worker {}".format(pid))
+            self.spawn()
+        self.sock.close()
+        logger.info("Server stopped")
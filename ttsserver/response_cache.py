@@ -0,0 +1,151 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import json
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from ttsserver import transcode
+from ttsserver import timeline
+
+logger = logging.getLogger('hr.ttsserver.response_cache')
+json_encode = json.JSONEncoder().encode
+
+DEFAULT_MAX_BYTES = 64*1024*1024
+
+class CachedResponse(object):
+    """
+    A fully serialised TTS response. body is the /tts JSON with the base64
+    audio and audio is the raw WAV.
+    encodings holds the audio encoded in the other codecs. etag is the
+    strong ETag of the key and the audio.
+    """
+    TIMELINE_KEYS = ['phonemes', 'markers', 'words', 'visemes', 'nodes']
+
+    def __init__(self, response, audio, key=None):
+        self.response = response
+        self.audio = audio
+        self.key = key
+        sha1 = hashlib.sha1(repr(key))
+        sha1.update(audio)
+        self.etag = sha1.hexdigest()
+        self.encodings = {}
+        self.lock = threading.Lock()
+        full_response = dict(response)
+        full_response['data'] = base64.b64encode(audio)
+        self.body = json_encode({'response': full_response})
+        self.size = len(self.audio) + len(self.body)
+        self._binary_timeline = None
+
+    def get_binary_timeline(self):
+        """Returns the timeline in the compact binary encoding"""
+        if self._binary_timeline is None:
+            self._binary_timeline = timeline.encode(self.response)
+        return self._binary_timeline
+
+    def get_compact_response(self):
+        """Returns the response with the binary timeline instead of the lists"""
+        response = dict((k, v) for k, v in self.response.items()
+                        if k not in CachedResponse.TIMELINE_KEYS)
+        response['timeline'] = base64.b64encode(self.get_binary_timeline())
+        return response
+
+class ResponseCache(object):
+    """Size bounded (in bytes) LRU cache of the TTS responses"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, enabled=True):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(vendor, voice, text, params):
+        return (vendor, voice, text, tuple(sorted(params.items())))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            logger.info("Response is too large to cache {}".format(entry.size))
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            entry.key = key
+            self.entries[key] = entry
+            self.size += entry.size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    @staticmethod
+    def get_etag(entry, codec):
+        if codec == 'wav':
+            return entry.etag
+        return '{}-{}'.format(entry.etag, codec)
+
+    def get_encoding(self, entry, codec):
+        """
+        Returns the audio of the entry encoded in the codec. The encoding
+        is kept with the entry and counts toward the cache size.
+        """
+        if codec == 'wav':
+            encoding = transcode.encode(entry.audio, codec)
+            encoding.etag = entry.etag
+            return encoding
+        with entry.lock:
+            encoding = entry.encodings.get(codec)
+            if encoding is not None:
+                return encoding
+            encoding = transcode.encode(entry.audio, codec)
+            encoding.etag = self.get_etag(entry, codec)
+            with self.lock:
+                entry.encodings[codec] = encoding
+                entry.size += len(encoding.data)
+                if self.entries.get(entry.key) is entry:
+                    self.size += len(encoding.data)
+                    self._evict()
+        return encoding
+
+    def invalidate(self, vendor=None, voice=None):
+        """Removes the entries of the vendor and/or voice, or everything"""
+        with self.lock:
+            keys = [key for key in self.entries
+                    if (vendor is None or key[0] == vendor) and
+                       (voice is None or key[1] == voice)]
+            for key in keys:
+                self.size -= self.entries.pop(key).size
+        logger.info("Invalidated {} cached responses {}:{}".format(
+            len(keys), vendor, voice))
+        return len(keys)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,190 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import math
+import time
+import logging
+import itertools
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from ttsserver.jobs import PRIORITY_HIGH
+from ttsserver import singleflight
+
+logger = logging.getLogger('hr.ttsserver.scheduler')
+
+# Seconds between the checks of a waiting run for cancellation
+POLL_INTERVAL = 0.1
+# Weight of the latest run in the average run time
+RUN_TIME_WEIGHT = 0.2
+
+class Overloaded(Exception):
+    """Too many interactive runs are waiting"""
+
+    def __init__(self, msg, retry_after):
+        super(Overloaded, self).__init__(msg)
+        self.retry_after = retry_after
+
+class Slot(object):
+
+    def __init__(self, seq, vendor, voice, priority, key):
+        self.seq = seq
+        self.vendor = vendor
+        self.voice = voice
+        self.priority = priority
+        self.key = key
+        self.granted = False
+        self.background = False
+        self.started = None
+
+    def is_interactive(self):
+        return self.priority <= PRIORITY_HIGH
+
+class Scheduler(object):
+    """
+    Limits the TTS runs at a time, overall and per vendor and voice. The
+    waiting runs get a slot lowest priority value first, then in arrival
+    order, and a run held back by its vendor or voice limit doesn't hold
+    up the others. The background runs, with a priority value above
+    PRIORITY_HIGH, take at most max_background slots so the interactive
+    runs always find one soon. An interactive run is turned away with
+    Overloaded when max_queue of them are already waiting. A limit of 0
+    or None is no limit.
+    """
+
+    def __init__(self, max_concurrency=16, max_queue=64, max_background=None,
+                 vendor_limits=None, voice_limits=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_background = max_background
+        self.vendor_limits = vendor_limits or {}  # vendor -> limit
+        self.voice_limits = voice_limits or {}  # (vendor, voice) -> limit
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.running = 0
+        self.running_background = 0
+        self.running_by_vendor = defaultdict(int)
+        self.running_by_voice = defaultdict(int)
+        self.sequence = itertools.count()
+        self.run_time = None  # average seconds a slot is held
+        self.rejected = 0
+
+    def get_max_background(self):
+        if self.max_background is not None:
+            return self.max_background
+        if self.max_concurrency:
+            return max(1, self.max_concurrency//2)
+
+    def _is_full(self):
+        return bool(self.max_concurrency) and self.running >= self.max_concurrency
+
+    def _can_run(self, slot):
+        max_background = self.get_max_background()
+        if not slot.is_interactive() and max_background and \
+                self.running_background >= max_background:
+            return False
+        limit = self.vendor_limits.get(slot.vendor)
+        if limit and self.running_by_vendor[slot.vendor] >= limit:
+            return False
+        limit = self.voice_limits.get((slot.vendor, slot.voice))
+        if limit and self.running_by_voice[(slot.vendor, slot.voice)] >= limit:
+            return False
+        return True
+
+    def _dispatch(self):
+        granted = False
+        for slot in sorted(self.waiting, key=lambda slot: (slot.priority, slot.seq)):
+            if self._is_full():
+                break
+            if self._can_run(slot):
+                slot.granted = True
+                slot.background = not slot.is_interactive()
+                slot.started = time.time()
+                self.running += 1
+                self.running_background += slot.background
+                self.running_by_vendor[slot.vendor] += 1
+                self.running_by_voice[(slot.vendor, slot.voice)] += 1
+                granted = True
+        if granted:
+            self.waiting = [slot for slot in self.waiting if not slot.granted]
+            self.cond.notify_all()
+
+    def _get_waiting(self, interactive):
+        return len([slot for slot in self.waiting if slot.is_interactive() == interactive])
+
+    def get_retry_after(self):
+        """Returns the seconds the waiting interactive runs may take"""
+        slots = self.max_concurrency or max(self.running, 1)
+        seconds = (self._get_waiting(True)+1)*(self.run_time or 1.0)/slots
+        return max(1, int(math.ceil(seconds)))
+
+    def acquire(self, vendor, voice, priority=PRIORITY_HIGH, key=None):
+        """
+        Waits for a slot and returns it. Raises Overloaded if the queue is
+        full and singleflight.Cancelled if the callers have gone away.
+        """
+        with self.cond:
+            slot = Slot(next(self.sequence), vendor, voice, priority, key)
+            if slot.is_interactive() and self.max_queue and \
+                    self._get_waiting(True) >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded("Too many requests are waiting",
+                                 self.get_retry_after())
+            self.waiting.append(slot)
+            self._dispatch()
+            while not slot.granted:
+                self.cond.wait(POLL_INTERVAL)
+                if not slot.granted and singleflight.cancelled():
+                    self.waiting.remove(slot)
+                    raise singleflight.Cancelled("All the callers have gone away")
+            return slot
+
+    def release(self, slot):
+        with self.cond:
+            self.running -= 1
+            self.running_background -= slot.background
+            self.running_by_vendor[slot.vendor] -= 1
+            self.running_by_voice[(slot.vendor, slot.voice)] -= 1
+            run_time = time.time() - slot.started
+            if self.run_time is None:
+                self.run_time = run_time
+            else:
+                self.run_time += RUN_TIME_WEIGHT*(run_time-self.run_time)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, vendor, voice, priority=PRIORITY_HIGH, key=None):
+        slot = self.acquire(vendor, voice, priority, key)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def promote(self, key):
+        """Moves the waiting runs of the key to the interactive lane"""
+        with self.cond:
+            promoted = False
+            for slot in self.waiting:
+                if slot.key == key and not slot.is_interactive():
+                    slot.priority = PRIORITY_HIGH
+                    promoted = True
+            if promoted:
+                logger.info("Promoted {}".format(key))
+                self._dispatch()
+            return promoted
+
+    def get_depth(self, interactive=True):
+        with self.cond:
+            return self._get_waiting(interactive)
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                'running': self.running,
+                'running_background': self.running_background,
+                'waiting': self._get_waiting(True),
+                'waiting_background': self._get_waiting(False),
+                'rejected': self.rejected,
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'max_background': self.get_max_background(),
+            }
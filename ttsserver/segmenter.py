@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import re
+
+SENTENCE_END = re.compile(u'[.!?;。！？；]+', re.UNICODE)
+MARK = re.compile(u'\\|([^\\|]+)\\|', re.UNICODE)
+TAG = re.compile(u'<(/?)[^<>]*?(/?)>', re.UNICODE)
+
+def split_segments(text):
+    """
+    Splits the marked up text into segments that can be synthesised on
+    their own, at the end of the sentences and after the |pause| marks.
+    It never splits inside the |mark|, the *emphasis*, **strong** and the
+    XML elements.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    segments = []
+    start = 0
+    pos = 0
+    depth = 0  # XML element depth
+    emphasis = False
+    # a sentence ended inside the markup, split after the markup closes
+    pending = False
+    while pos < len(text):
+        ch = text[pos]
+        boundary = False
+        if ch == '|':
+            match = MARK.match(text, pos)
+            if match:
+                pos = match.end()
+                boundary = depth == 0 and not emphasis and \
+                    match.group(1).strip().startswith('pause')
+            else:
+                pos += 1
+        elif ch == '<':
+            match = TAG.match(text, pos)
+            if match:
+                if match.group(1):
+                    depth = max(depth-1, 0)
+                    boundary = pending and depth == 0 and not emphasis
+                elif not match.group(2):
+                    depth += 1
+                pos = match.end()
+            else:
+                pos += 1
+        elif ch == '*':
+            while pos < len(text) and text[pos] == '*':
+                pos += 1
+            # an unmatched * is not markup
+            if emphasis or '*' in text[pos:]:
+                emphasis = not emphasis
+                boundary = pending and depth == 0 and not emphasis
+        else:
+            match = SENTENCE_END.match(text, pos)
+            if match:
+                pos = match.end()
+                boundary = pos == len(text) or text[pos].isspace() or \
+                    text[pos] in u'<*|' or ord(text[pos]) > 0x2e7f
+                if boundary and (depth > 0 or emphasis):
+                    boundary = False
+                    pending = True
+            else:
+                if not ch.isspace():
+                    pending = False
+                pos += 1
+        if boundary:
+            pending = False
+            segment = text[start:pos].strip()
+            if segment:
+                segments.append(segment)
+            start = pos
+    segment = text[start:].strip()
+    if segment:
+        segments.append(segment)
+    return segments
@@ -6,19 +6,38 @@ import os
 import sys
 import logging
 import datetime as dt
-import subprocess
+import socket
+import select
+import xmlrpclib
 from collections import defaultdict
-import xml.etree.ElementTree as ET
 CWD = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, os.path.join(CWD, '..'))
 
 from flask import Flask, request, Response
-from action_parser import ActionParser
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.http import quote_etag
+from ttsserver.ttsbase import get_duration, get_wav_params, LazyVoice, TTSBase, OnlineTTS
+from ttsserver.response_cache import ResponseCache, CachedResponse
+from ttsserver.jobs import JobQueue, JobStore, PRIORITY_HIGH, PRIORITY_LOW
+from ttsserver import metrics
+from ttsserver import transcode
+from ttsserver import timeline
+from ttsserver.archive import AudioArchive
+from ttsserver.segmenter import split_segments
+from ttsserver.singleflight import SingleFlight
+from ttsserver.prefork import PreforkServer, GRACEFUL_TIMEOUT
+from ttsserver.scheduler import Scheduler, Overloaded
+from ttsserver.audio_cache import AudioCache
+from ttsserver.cache_archive import CacheArchive
+from ttsserver import singleflight
 import json
-import wave
 import time
+import io
 import base64
-import shutil
+import uuid
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 
 try:
     import colorlog
@@ -32,29 +51,68 @@ logger = logging.getLogger('hr.tts.server')
 SERVER_LOG_DIR = os.path.expanduser('~/.hr/log/ttsserver')
 TTS_TMP_OUTPUT_DIR = os.path.expanduser('~/.hr/ttsserver/tmp')
 DEFAULT_TTS_OUTPUT_DIR = os.path.expanduser('~/.hr/ttsserver')
-if os.path.isdir(TTS_TMP_OUTPUT_DIR):
-    shutil.rmtree(TTS_TMP_OUTPUT_DIR)
-if not os.path.isdir(TTS_TMP_OUTPUT_DIR):
-    os.makedirs(TTS_TMP_OUTPUT_DIR)
 VOICES = {}
+WARM_UP_WORKERS = 4
+ROS_MASTER_TIMEOUT = 1
 KEEP_AUDIO = False
+response_cache = ResponseCache()
+archive = AudioArchive(TTS_TMP_OUTPUT_DIR)
+BATCH_WORKERS = 4
+batch_pool = None
+batch_pool_lock = threading.Lock()
+batch_pending = 0
+job_queue = JobQueue()
+MAX_JOB_WAIT = 30
+JOB_STORE_FILE = 'jobs.sqlite'
+prefetch_queue = JobQueue(num_workers=1)
+# the TTS runs by priority, the batch and prefetch runs are low priority
+scheduler = Scheduler()
+inflight = 0
+# the TTS runs in flight by request
+flights = SingleFlight()
+inflight_lock = threading.Lock()
+metrics.gauge('tts_inflight', lambda: inflight)
+metrics.gauge('tts_inflight_renders', lambda: flights.get_inflight())
+metrics.gauge('tts_queue_depth', lambda: batch_pending, queue='batch')
+metrics.gauge('tts_queue_depth', lambda: job_queue.get_depth(), queue='jobs')
+metrics.gauge('tts_queue_depth', lambda: prefetch_queue.get_depth(), queue='prefetch')
+metrics.gauge('tts_queue_depth', lambda: archive.get_depth(), queue='archive')
+metrics.gauge('tts_queue_depth', lambda: scheduler.get_depth(True), queue='interactive')
+metrics.gauge('tts_queue_depth', lambda: scheduler.get_depth(False), queue='background')
+STREAM_CHUNK_SIZE = 64*1024
+# Number of sentences synthesised ahead of the one being streamed
+STREAM_LOOKAHEAD = 1
 counter = 0
-parser = ActionParser()
+counter_lock = threading.Lock()
 
 def next_count():
     global counter
-    counter += 1
-    return str(counter).zfill(4)
+    with counter_lock:
+        counter += 1
+        return str(counter).zfill(4)
 
-def init_logging():
-    run_id = None
+def get_run_id():
+    """
+    Returns the run id from the ROS parameter server, None if ROS is not
+    running. Asks the master directly as running rosparam takes seconds.
+    """
+    master_uri = os.environ.get('ROS_MASTER_URI')
+    if not master_uri:
+        return None
+    timeout = socket.getdefaulttimeout()
+    socket.setdefaulttimeout(ROS_MASTER_TIMEOUT)
     try:
-        run_id = subprocess.check_output(
-            'rosparam get /run_id'.split(), stderr=subprocess.STDOUT).strip()
-    except subprocess.CalledProcessError as ex:
-        run_id = None
-    except OSError as ex:
-        run_id = None
+        code, _, run_id = xmlrpclib.ServerProxy(master_uri).getParam(
+            '/ttsserver', '/run_id')
+        if code == 1:
+            return run_id
+    except Exception as ex:
+        pass
+    finally:
+        socket.setdefaulttimeout(timeout)
+
+def init_logging():
+    run_id = get_run_id()
     ROS_LOG_DIR = os.environ.get('ROS_LOG_DIR', os.path.expanduser('~/.hr/log'))
     server_log_dir = SERVER_LOG_DIR
     if run_id is not None:
@@ -102,6 +160,45 @@ def load_voices(voice_path):
             except ImportError as ex:
                 logger.error(ex)
 
+def warm_up_voices(workers=WARM_UP_WORKERS, start=False):
+    """
+    Creates the voices that are loaded on first use, in parallel, and
+    starts them with start
+    """
+    lazy_voices = [api for engine in VOICES.values() for api in engine.values()
+                   if isinstance(api, LazyVoice) and not api.is_loaded()]
+    if not lazy_voices:
+        return
+    start_time = time.time()
+    pool = ThreadPool(workers)
+    try:
+        for result in [pool.apply_async(api.get) for api in lazy_voices]:
+            try:
+                voice = result.get()
+                if start:
+                    voice.start()
+            except Exception as ex:
+                logger.error(ex)
+    finally:
+        pool.close()
+        pool.join()
+    logger.info("Warmed up {} voices in {:.2f} seconds".format(
+        len(lazy_voices), time.time()-start_time))
+
+def start_voices():
+    """Starts the processes of the loaded voices in this server process"""
+    for engine in VOICES.values():
+        for api in engine.values():
+            if isinstance(api, LazyVoice):
+                if not api.is_loaded():
+                    continue
+                api = api.get()
+            try:
+                api.start()
+            except Exception as ex:
+                logger.error("Can't start voice {}:{}: {}".format(
+                    api.vendor_name, api.voice_name, ex))
+
 VERSION = 'v1.0'
 ROOT = '/{}'.format(VERSION)
 
@@ -109,104 +206,722 @@ def get_api(vendor, voice):
     api = None
     try:
         api = VOICES.get(vendor).get(voice)
+        if isinstance(api, LazyVoice):
+            api = api.get()
     except Exception:
         logger.error("Can't get api {}:{}".format(vendor, voice))
     return api
 
-@app.route(ROOT + '/tts')
-def _tts():
-    logger.info("Start TTS")
+def get_audio_override(nodes):
+    """Returns the audio file given by the embedded marker |audio, filepath|"""
+    audio_nodes = [node for node in nodes if node['type']=='marker' and node['name'].startswith('audio')]
+    if audio_nodes:
+        audio_node_name = audio_nodes[0]['name']
+        if ',' in audio_node_name:
+            name, filepath = audio_node_name.split(',', 1)
+            filepath = filepath.strip()
+            filepath = os.path.expanduser(filepath)
+            if os.path.isfile(filepath):
+                return filepath
+            else:
+                raise Exception("Audio file %s doesn't exist", filepath)
+
+def synthesize(vendor, voice, text, params, priority=PRIORITY_HIGH, key=None):
+    """
+    Runs the TTS when the scheduler gives it a slot and returns the
+    response without the audio data, the TTS data and the audio file
+    given by the |audio, filepath| marker. The TTS data is None if the
+    TTS failed.
+    """
+    global inflight
+    response = {}
+    api = get_api(vendor, voice)
+    if not api:
+        response['error'] = "Can't get api"
+        logger.error("Can't get api {}:{}".format(vendor, voice))
+        return response, None, None
+    with metrics.timer('tts_stage_seconds', stage='queue'):
+        slot = scheduler.acquire(vendor, voice, priority, key)
+    with inflight_lock:
+        inflight += 1
+    try:
+        with metrics.timer('tts_stage_seconds', stage='synthesize',
+                           vendor=vendor, voice=voice):
+            tts_data = api.tts(text, **params)
+    finally:
+        with inflight_lock:
+            inflight -= 1
+        scheduler.release(slot)
+    if tts_data is None:
+        response['error'] = "No TTS data"
+        logger.error("No TTS data {}:{}".format(vendor, voice))
+        return response, None, None
+    response['phonemes'] = tts_data.phonemes
+    response['markers'] = tts_data.markers
+    response['words'] = tts_data.words
+    response['visemes'] = tts_data.visemes
+    response['nodes'] = tts_data.get_nodes()
+    # overwrite audio by the embedded marker |audio, filepath|
+    override = get_audio_override(response['nodes'])
+    try:
+        if override:
+            logger.warn('Overwrite audio output with %s', override)
+            response['duration'] = get_duration(override)
+            response['params'] = get_wav_params(override)
+        else:
+            response['duration'] = tts_data.get_duration()
+            response['params'] = tts_data.get_audio_params()
+    except Exception as ex:
+        logger.error(ex)
+    return response, tts_data, override
+
+def read_tts_audio(tts_data, override):
+    """Returns the WAV data to serve, None if there is no audio"""
+    if override:
+        with open(override, 'rb') as f:
+            return f.read()
+    return tts_data.get_audio()
+
+def release(text, tts_data, override=None, archived=True):
+    """Archives the served audio and removes the TTS output"""
+    if tts_data is None:
+        return
+    name = '{}-{}'.format(next_count(), time.time())
+    if KEEP_AUDIO:
+        tts_data.write()
+    if not archived:
+        logger.info("Don't archive the audio of the cancelled or prefetched TTS")
+    elif override:
+        archive.submit(name, text, override)
+    elif tts_data.audio is not None:
+        archive.submit(name, text, data=tts_data.audio)
+    elif os.path.isfile(tts_data.wavout):
+        # the archive removes the TTS output once it is archived
+        archive.submit(name, text, tts_data.wavout, owned=not KEEP_AUDIO)
+        return
+    if not KEEP_AUDIO and os.path.isfile(tts_data.wavout):
+        os.remove(tts_data.wavout)
+        logger.info("Removed file {}".format(tts_data.wavout))
+
+def get_request_params():
     vendor = request.args.get('vendor')
     voice = request.args.get('voice')
     text = request.args.get('text')
     params = request.args.to_dict()
-    for p in ['vendor', 'voice', 'text']:
-        params.pop(p)
-    response = {}
+    for p in ['vendor', 'voice', 'text', 'codec', 'timeline', 'timeout']:
+        params.pop(p, None)
+    return vendor, voice, text, params
+
+def get_deadline():
+    """
+    Returns the time the client gives up on the request, from the
+    X-TTS-Timeout header or the timeout param in seconds, None if it
+    waits for the response.
+    """
+    timeout = request.headers.get('X-TTS-Timeout', type=float)
+    if timeout is None:
+        timeout = request.args.get('timeout', type=float)
+    if timeout is not None:
+        return time.time() + timeout
+
+def get_disconnected():
+    """
+    Returns the function telling if the client has closed the connection,
+    None if the server can't tell.
+    """
+    sock = getattr(request.environ.get('wsgi.input'), '_sock', None)
+    if sock is None:
+        return None
+
+    def disconnected():
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            # a closed connection is readable with no data
+            return bool(readable) and sock.recv(1, socket.MSG_PEEK) == ''
+        except (socket.error, select.error, ValueError):
+            return True
+    return disconnected
+
+def get_codec():
+    """Returns the codec asked for by the codec param or the Accept header"""
+    codec = request.args.get('codec')
+    if codec is None:
+        return transcode.negotiate(request.accept_mimetypes)
+    codec = codec.lower()
+    if codec not in transcode.CODECS:
+        raise transcode.CodecError("Unknown codec {}".format(codec))
+    return codec
+
+def is_binary_timeline():
+    """Whether the request asks for the compact binary timeline"""
+    return request.args.get('timeline') == 'binary'
+
+@app.errorhandler(Overloaded)
+def _overloaded(ex):
+    logger.warn(ex)
+    response = error_response({'error': str(ex)}, 503)
+    response.headers['Retry-After'] = str(ex.retry_after)
+    return response
+
+@app.errorhandler(singleflight.Timeout)
+def _deadline_exceeded(ex):
+    logger.warn(ex)
+    return error_response({'error': 'Deadline exceeded'}, 504)
+
+@app.errorhandler(singleflight.Cancelled)
+def _cancelled(ex):
+    logger.info(ex)
+    # nobody reads it, the client has closed the connection
+    return error_response({'error': str(ex)}, 499)
+
+@app.errorhandler(transcode.CodecError)
+def _codec_error(ex):
+    logger.error(ex)
+    return error_response({'error': str(ex)}, 406)
+
+def render(key, vendor, voice, text, params, priority=PRIORITY_HIGH, served=True):
+    """
+    Runs the TTS and returns the response and the response entry with the
+    audio, which is cached. The entry is None if the TTS failed. The
+    audio that is not served, such as a prefetch, is neither archived nor
+    kept in the response cache.
+    """
+    singleflight.check_cancelled()
+    response, tts_data, override = synthesize(
+        vendor, voice, text, params, priority, key)
+    if tts_data is None:
+        return response, None
+    try:
+        audio = read_tts_audio(tts_data, override)
+        if audio is None:
+            return response, None
+        with metrics.timer('tts_stage_seconds', stage='serialise'):
+            entry = CachedResponse(response, audio, key)
+    finally:
+        # the callers have given up, the audio is cached for their retries
+        release(text, tts_data, override,
+                archived=served and not singleflight.cancelled())
+    if response_cache.enabled and served:
+        response_cache.put(key, entry)
+    return response, entry
+
+def get_cached_response(vendor, voice, text, params, priority=PRIORITY_HIGH,
+                        deadline=None, abort=None, served=True):
+    """
+    Returns the response and the cached response entry, running the TTS
+    on a cache miss. The identical requests in flight share one TTS run,
+    an interactive request moves a queued low priority run ahead.
+    The entry is None if the TTS failed. With served False the TTS only
+    fills the vendor and emotive speech caches.
+
+    Raises singleflight.Timeout past the deadline and Cancelled once
+    abort() returns True. The TTS run is cancelled when all its callers
+    have given up.
+    """
+    key = ResponseCache.make_key(vendor, voice, text, params)
+    if response_cache.enabled:
+        entry = response_cache.get(key)
+        metrics.inc('tts_cache_total', cache='response',
+                    result='miss' if entry is None else 'hit')
+        if entry is not None:
+            return entry.response, entry
+    timeout = None
+    if deadline is not None:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            raise singleflight.Timeout("Deadline passed before the TTS of {}".format(key))
+    if priority == PRIORITY_HIGH:
+        scheduler.promote(key)
+    return flights.do(key, render, key, vendor, voice, text, params, priority,
+                      served=served, timeout=timeout, abort=abort)
+
+def get_audio(vendor, voice, text, params, codec='wav', deadline=None, abort=None):
+    """
+    Returns the response, the audio in the codec to serve as an open file
+    and its encoding. The audio is None if the TTS failed.
+    """
+    response, entry = get_cached_response(
+        vendor, voice, text, params, deadline=deadline, abort=abort)
+    if entry is None:
+        return response, None, None
+    encoding = response_cache.get_encoding(entry, codec)
+    return response, io.BytesIO(encoding.data), encoding
+
+def add_codec(response, encoding):
+    """Returns the response with the codec params of the encoded audio"""
+    if encoding.codec == 'wav':
+        return response
+    return dict(response, codec=encoding.params)
+
+def read_audio(f, start=0, stop=None):
+    """Yields the audio between start and stop in chunks and closes it"""
+    try:
+        f.seek(start)
+        remaining = None if stop is None else stop - start
+        while remaining is None or remaining > 0:
+            size = STREAM_CHUNK_SIZE
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            chunk = f.read(size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+def get_size(f):
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    return size
+
+def error_response(response, status=500):
+    return Response(json_encode({'response': response}), status=status,
+                    mimetype='application/json')
+
+def get_body(entry, codec='wav', binary_timeline=False):
+    """
+    Returns the serialised /tts response with the audio in the codec and
+    optionally the binary timeline
+    """
+    if codec == 'wav' and not binary_timeline:
+        return entry.body
+    encoding = response_cache.get_encoding(entry, codec)
+    with metrics.timer('tts_stage_seconds', stage='serialise'):
+        if binary_timeline:
+            response = add_codec(entry.get_compact_response(), encoding)
+        else:
+            response = add_codec(entry.response, encoding)
+        response['data'] = base64.b64encode(encoding.data)
+        return json_encode({'response': response})
+
+def tts_body(vendor, voice, text, params, codec='wav', priority=PRIORITY_HIGH):
+    response, entry = get_cached_response(vendor, voice, text, params, priority)
+    if entry is None:
+        return json_encode({'response': response})
+    return get_body(entry, codec)
+
+def not_modified(etag):
+    """Returns the 304 response if the client has the same version"""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+@app.route(ROOT + '/tts')
+def _tts():
+    logger.info("Start TTS")
+    vendor, voice, text, params = get_request_params()
+    codec = get_codec()
+    binary_timeline = is_binary_timeline()
+    response, entry = get_cached_response(
+        vendor, voice, text, params, deadline=get_deadline(), abort=get_disconnected())
+    if entry is None:
+        return Response(json_encode({'response': response}),
+                        mimetype='application/json')
+    etag = ResponseCache.get_etag(entry, codec)
+    if binary_timeline:
+        etag += '-binary'
+    response = not_modified(etag)
+    if response is None:
+        response = Response(get_body(entry, codec, binary_timeline),
+                            mimetype='application/json')
+        response.set_etag(etag)
+    logger.info("End TTS")
+    return response
+
+def get_item_params(item):
+    """
+    Returns the TTS params of a batch, job or prefetch item, None if they
+    are not a dict
+    """
+    params = item.get('params')
+    if params is None:
+        return {}
+    if not isinstance(params, dict):
+        return None
+    return dict((k, unicode(v)) for k, v in params.items())
+
+def get_batch_pool():
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is None:
+            batch_pool = ThreadPool(BATCH_WORKERS)
+        return batch_pool
+
+def run_batch_group(items):
+    """Runs the batch items of one voice in order, on the same warm engine"""
+    global batch_pending
+    results = []
+    for index, item in items:
+        with batch_pool_lock:
+            batch_pending -= 1
+        try:
+            params = get_item_params(item)
+            body = tts_body(item.get('vendor'), item.get('voice'), item.get('text'),
+                            params, priority=PRIORITY_LOW)
+        except Exception as ex:
+            logger.exception(ex)
+            body = json_encode({'response': {'error': str(ex)}})
+        results.append((index, body))
+    return results
+
+@app.route(ROOT + '/tts/batch', methods=['POST'])
+def _tts_batch():
+    """
+    Runs a list of {vendor, voice, text, params} items concurrently, one
+    task per voice, and returns the /tts responses in the same order.
+    An item that fails has an error in its response.
+    """
+    global batch_pending
+    logger.info("Start TTS batch")
+    payload = request.get_json(force=True, silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return error_response({'error': 'Expect a list of items'}, 400)
+    if any(get_item_params(item) is None for item in items):
+        return error_response({'error': 'Expect the params of the items as an object'}, 400)
+    groups = defaultdict(list)
+    for index, item in enumerate(items):
+        groups[(item.get('vendor'), item.get('voice'))].append((index, item))
+    pool = get_batch_pool()
+    with batch_pool_lock:
+        batch_pending += len(items)
+    tasks = [pool.apply_async(run_batch_group, (group,)) for group in groups.values()]
+    bodies = [None]*len(items)
+    for task in tasks:
+        for index, body in task.get():
+            bodies[index] = body
+    logger.info("End TTS batch {} items".format(len(items)))
+    return Response('{{"response": {{"results": [{}]}}}}'.format(','.join(bodies)),
+                    mimetype='application/json')
+
+@app.route(ROOT + '/jobs', methods=['POST'])
+def _submit_job():
+    """Queues a {vendor, voice, text, params} TTS job and returns its id"""
+    item = request.get_json(force=True, silent=True)
+    if not isinstance(item, dict):
+        return error_response({'error': 'Expect a TTS item'}, 400)
+    params = get_item_params(item)
+    if params is None:
+        return error_response({'error': 'Expect the params as an object'}, 400)
+    job = job_queue.submit(
+        tts_body, item.get('vendor'), item.get('voice'), item.get('text'), params)
+    logger.info("Submitted TTS job {}".format(job.id))
+    return Response(json_encode({'response': job.to_dict()}), status=202,
+                    mimetype='application/json')
+
+@app.route(ROOT + '/jobs/<job_id>', methods=['GET'])
+def _get_job(job_id):
+    """
+    Returns the job status and the /tts response once the job is done.
+    The wait param long-polls the job for up to MAX_JOB_WAIT seconds.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return error_response({'error': 'No such job'}, 404)
+    wait = request.args.get('wait', type=float)
+    if wait:
+        job.wait(min(wait, MAX_JOB_WAIT))
+    status = json_encode(job.to_dict())
+    if job.status == job.DONE:
+        # the result is already serialised
+        status = '{}, "result": {}}}'.format(status[:-1], job.result)
+    return Response('{{"response": {}}}'.format(status),
+                    mimetype='application/json')
+
+def prefetch(vendor, voice, text, params, pin=None):
+    """
+    Renders the text into the caches at low priority. A request for the
+    same text while it is being prefetched waits for the prefetch instead
+    of running the TTS again. With pin True or False the vendor audio is
+    pinned in or unpinned from the vendor cache.
+    """
     api = get_api(vendor, voice)
-    if api:
-        tts_data = api.tts(text, **params)
-        if tts_data is None:
-            response['error'] = "No TTS data"
-            logger.error("No TTS data {}:{}".format(vendor, voice))
+    if not api:
+        raise Exception("Can't get api {}:{}".format(vendor, voice))
+    response, entry = get_cached_response(
+        vendor, voice, text, params, PRIORITY_LOW, served=False)
+    if entry is None:
+        raise Exception(response.get('error', 'No TTS data'))
+    if pin is not None and isinstance(api, OnlineTTS):
+        if not api.pin(text, params, pin):
+            logger.warn("Can't pin {}, it is not in the vendor cache".format(text))
+
+@app.route(ROOT + '/prefetch', methods=['POST'])
+def _prefetch():
+    """
+    Renders a list of {vendor, voice, text, params, pin} items into the
+    caches in the background and returns the id to query the progress.
+    """
+    payload = request.get_json(force=True, silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return error_response({'error': 'Expect a list of items'}, 400)
+    args_list = []
+    for item in items:
+        params = get_item_params(item)
+        if params is None:
+            return error_response({'error': 'Expect the params of the items as an object'}, 400)
+        args_list.append((item.get('vendor'), item.get('voice'), item.get('text'),
+                          params, item.get('pin')))
+    group = prefetch_queue.submit_group(prefetch, args_list, priority=PRIORITY_LOW)
+    logger.info("Prefetch {} items {}".format(len(items), group.id))
+    return Response(json_encode({'response': group.to_dict()}), status=202,
+                    mimetype='application/json')
+
+@app.route(ROOT + '/prefetch/<prefetch_id>', methods=['GET'])
+def _get_prefetch(prefetch_id):
+    group = prefetch_queue.get_group(prefetch_id)
+    if group is None:
+        return error_response({'error': 'No such prefetch'}, 404)
+    return Response(json_encode({'response': group.to_dict()}),
+                    mimetype='application/json')
+
+@app.route(ROOT + '/tts/audio')
+def _tts_audio():
+    """
+    Streams the audio as it is, in the codec negotiated by the codec
+    param or the Accept header. The timeline is available from
+    /tts/multipart.
+    """
+    logger.info("Start TTS audio")
+    vendor, voice, text, params = get_request_params()
+    response, audio, encoding = get_audio(
+        vendor, voice, text, params, get_codec(), get_deadline(), get_disconnected())
+    if audio is None:
+        return error_response(response)
+    cached = not_modified(encoding.etag)
+    if cached is not None:
+        audio.close()
+        return cached
+    size = get_size(audio)
+    status = 200
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'X-TTS-Duration': str(response['duration']),
+        'X-TTS-Codec': encoding.codec,
+        'ETag': quote_etag(encoding.etag),
+    }
+    start, stop = 0, None
+    if request.range is not None:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            audio.close()
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return Response(status=416, headers=headers)
+        start, stop = byte_range
+        status = 206
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop-1, size)
+        headers['Content-Length'] = str(stop-start)
+
+    def generate():
+        for chunk in read_audio(audio, start, stop):
+            yield chunk
+        logger.info("End TTS audio")
+
+    return Response(generate(), status=status, headers=headers,
+                    mimetype=encoding.mimetype, direct_passthrough=True)
+
+@app.route(ROOT + '/tts/multipart')
+def _tts_multipart():
+    """
+    Streams a multipart/mixed response, the timeline as JSON followed by
+    the audio in the negotiated codec. With timeline=binary the JSON has
+    no timeline and is followed by the binary timeline.
+    """
+    logger.info("Start TTS multipart")
+    vendor, voice, text, params = get_request_params()
+    codec = get_codec()
+    binary_timeline = is_binary_timeline()
+    response, entry = get_cached_response(
+        vendor, voice, text, params, deadline=get_deadline(), abort=get_disconnected())
+    if entry is None:
+        return error_response(response)
+    encoding = response_cache.get_encoding(entry, codec)
+    # the timeline and the audio of the same version
+    etag = encoding.etag + '-multipart'
+    if binary_timeline:
+        etag += '-binary'
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    boundary = uuid.uuid4().hex
+
+    def generate():
+        yield '--{}\r\nContent-Type: application/json\r\n\r\n'.format(boundary)
+        if binary_timeline:
+            compact = dict((k, v) for k, v in response.items()
+                           if k not in CachedResponse.TIMELINE_KEYS)
+            yield json_encode({'response': add_codec(compact, encoding)})
+            binary = entry.get_binary_timeline()
+            yield '\r\n--{}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                boundary, timeline.MIMETYPE, len(binary))
+            yield binary
         else:
-            response['phonemes'] = tts_data.phonemes
-            response['markers'] = tts_data.markers
-            response['words'] = tts_data.words
-            response['visemes'] = tts_data.visemes
-            response['nodes'] = tts_data.get_nodes()
-            # overwrite audio by the embedded marker |audio, filepath|
-            audio_nodes = [node for node in response['nodes'] if node['type']=='marker' and node['name'].startswith('audio')]
-            if audio_nodes:
-                audio_node_name = audio_nodes[0]['name']
-                if ',' in audio_node_name:
-                    name, filepath = audio_node_name.split(',', 1)
-                    filepath = filepath.strip()
-                    filepath = os.path.expanduser(filepath)
-                    if os.path.isfile(filepath):
-                        try:
-                            shutil.copy(filepath, tts_data.wavout)
-                            logger.warn('Overwrite audio output with %s', filepath)
-                        except Exception as ex:
-                            logger.exception(ex)
-                            raise ex
-                    else:
-                        raise Exception("Audio file %s doesn't exist", filepath)
-            response['duration'] = tts_data.get_duration()
+            yield json_encode({'response': add_codec(response, encoding)})
+        yield '\r\n--{}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+            boundary, encoding.mimetype, len(encoding.data))
+        for chunk in read_audio(io.BytesIO(encoding.data)):
+            yield chunk
+        yield '\r\n--{}--\r\n'.format(boundary)
+        logger.info("End TTS multipart")
+
+    return Response(generate(), direct_passthrough=True, headers={'ETag': quote_etag(etag)},
+                    mimetype='multipart/mixed; boundary={}'.format(boundary))
+
+def get_encoded_response(vendor, voice, text, params, codec='wav', deadline=None,
+                         abort=None):
+    """Returns the response and the encoded audio, None if the TTS failed"""
+    response, entry = get_cached_response(
+        vendor, voice, text, params, deadline=deadline, abort=abort)
+    if entry is None:
+        return response, None
+    return response, response_cache.get_encoding(entry, codec)
+
+def shift_timeline(response, offset):
+    """Returns a copy of the response with the timeline moved by offset seconds"""
+    shifted = dict(response)
+    for key in ['phonemes', 'markers', 'words', 'visemes', 'nodes']:
+        items = []
+        for item in response.get(key, []):
+            item = dict(item)
+            item['start'] += offset
+            item['end'] += offset
+            items.append(item)
+        shifted[key] = items
+    shifted['offset'] = offset
+    return shifted
+
+def multipart(boundary, content_type, data):
+    return '--{}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n{}\r\n'.format(
+        boundary, content_type, len(data), data)
+
+@app.route(ROOT + '/tts/stream')
+def _tts_stream():
+    """
+    Splits the text into sentences and streams a multipart/mixed response
+    with the timeline JSON and the audio of each sentence as soon as it
+    is synthesised, while the next sentence is being synthesised. The
+    timeline is moved by the offset of the sentence in the utterance. The
+    last part is the JSON with the total duration. The timeout applies to
+    each sentence.
+    """
+    logger.info("Start TTS stream")
+    start_time = time.time()
+    vendor, voice, text, params = get_request_params()
+    codec = get_codec()
+    deadline = get_deadline()
+    timeout = deadline and deadline - start_time
+    disconnected = get_disconnected()
+    segments = split_segments(text or '')
+    results = Queue.Queue(STREAM_LOOKAHEAD)
+    cancelled = threading.Event()
 
-            if tts_data.wavout:
-                logger.info("TTS file {}".format(tts_data.wavout))
+    def abort():
+        return cancelled.is_set() or (disconnected is not None and disconnected())
+
+    def produce():
+        for segment in segments:
+            try:
+                response, encoding = get_encoded_response(
+                    vendor, voice, segment, params, codec,
+                    timeout and time.time() + timeout, abort)
+            except Exception as ex:
+                logger.exception(ex)
+                response, encoding = {'error': str(ex)}, None
+            while not cancelled.is_set():
                 try:
-                    with open(tts_data.wavout, 'rb') as f:
-                        raw = f.read()
-                        response['data'] = base64.b64encode(raw)
-                    f = wave.open(tts_data.wavout, 'rb')
-                    response['params'] = f.getparams()
-                except Exception as ex:
-                    logger.error(ex)
-                    f = None
-                finally:
-                    if f:
-                        f.close()
-                    if os.path.isfile(tts_data.wavout):
-                        timestamp = time.time()
-                        num = next_count()
-                        notags = None
-                        try:
-                            text = parser.parse(text)
-                            root = u'<_root_>{}</_root_>'.format(text)
-                            tree = ET.fromstring(root.encode('utf-8'))
-                            notags = ET.tostring(tree, encoding='utf8', method='text')
-                            notags = notags.strip()
-                            if len(notags) > 200:
-                                notags = notags[:200]+'...' # prevent filename too long(255)
-                            tmp_file = '{}-{} - {}.wav'.format(num, timestamp, notags)
-                        except Exception as ex:
-                            logger.error(ex)
-                            tmp_file = '{}-{} - {}.wav'.format(num, timestamp, os.path.splitext(
-                                os.path.basename(tts_data.wavout))[0])
-                        tmp_file = os.path.join(TTS_TMP_OUTPUT_DIR, tmp_file)
-                        try:
-                            if notags:
-                                shutil.copy(tts_data.wavout, tmp_file)
-                        except IOError as err:
-                            logger.error(err)
-                        if not KEEP_AUDIO:
-                            os.remove(tts_data.wavout)
-                            logger.info("Removed file {}".format(tts_data.wavout))
-    else:
-        response['error'] = "Can't get api"
-        logger.error("Can't get api {}:{}".format(vendor, voice))
-    logger.info("End TTS")
-    return Response(json_encode({'response': response}),
+                    results.put((response, encoding), timeout=1)
+                    break
+                except Queue.Full:
+                    pass
+            if encoding is None or cancelled.is_set():
+                break
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    boundary = uuid.uuid4().hex
+
+    def generate():
+        offset = 0
+        try:
+            for index in range(len(segments)):
+                response, encoding = results.get()
+                if encoding is None:
+                    yield multipart(boundary, 'application/json',
+                                    json_encode({'response': response}))
+                    break
+                if index == 0:
+                    metrics.observe('tts_stage_seconds', time.time()-start_time,
+                                    stage='first_segment')
+                shifted = add_codec(shift_timeline(response, offset), encoding)
+                shifted['index'] = index
+                yield multipart(boundary, 'application/json',
+                                json_encode({'response': shifted}))
+                yield multipart(boundary, encoding.mimetype, encoding.data)
+                offset += response.get('duration', 0)
+            else:
+                yield multipart(boundary, 'application/json', json_encode(
+                    {'response': {'duration': offset, 'segments': len(segments)}}))
+            yield '--{}--\r\n'.format(boundary)
+        finally:
+            cancelled.set()
+            logger.info("End TTS stream")
+
+    return Response(generate(), direct_passthrough=True,
+                    mimetype='multipart/mixed; boundary={}'.format(boundary))
+
+@app.route(ROOT + '/cache', methods=['GET'])
+def _cache_stats():
+    stats = response_cache.get_stats()
+    stats['coalesced'] = flights.shared
+    return Response(json_encode({'response': stats}),
+                    mimetype='application/json')
+
+@app.route(ROOT + '/scheduler', methods=['GET'])
+def _scheduler_stats():
+    return Response(json_encode({'response': scheduler.get_stats()}),
                     mimetype='application/json')
 
+@app.route(ROOT + '/cache', methods=['DELETE'])
+def _cache_invalidate():
+    """Invalidates the cached responses of the vendor and/or voice"""
+    count = response_cache.invalidate(
+        request.args.get('vendor'), request.args.get('voice'))
+    return Response(json_encode({'response': {'invalidated': count}}),
+                    mimetype='application/json')
+
+@app.route(ROOT + '/metrics', methods=['GET'])
+def _metrics():
+    return Response(metrics.registry.render(),
+                    mimetype='text/plain; version=0.0.4')
+
 @app.route(ROOT + '/ping', methods=['GET'])
 def _ping():
     return Response(json_encode({'response': {'code': 0, 'message': 'pong'}}),
                     mimetype="application/json")
 
+def parse_limit(value):
+    """Parses a NAME=LIMIT option"""
+    import argparse
+    name, sep, limit = value.rpartition('=')
+    if not sep or not name or not limit.isdigit():
+        raise argparse.ArgumentTypeError("Expect NAME=LIMIT, got {}".format(value))
+    return name, int(limit)
+
+def start_background_threads():
+    """Starts the background threads of the server process"""
+    start_voices()
+    job_queue.start()
+    prefetch_queue.start()
+    if archive.is_enabled():
+        archive.start()
+
 def main():
+    global KEEP_AUDIO, BATCH_WORKERS
     init_logging()
     cwd = os.path.dirname(os.path.realpath(__file__))
     import argparse
@@ -223,25 +938,142 @@ def main():
         '--tts-output-dir',
         dest='tts_output_dir', default=DEFAULT_TTS_OUTPUT_DIR,
         help='TTS wave data save directory')
+    parser.add_argument(
+        '--response-cache-size',
+        dest='response_cache_size', default=64, type=int,
+        help='Response cache size in MB')
+    parser.add_argument(
+        '--no-response-cache',
+        dest='response_cache', action='store_false',
+        help='Disable the in-memory response cache')
+    parser.add_argument(
+        '--batch-workers',
+        dest='batch_workers', default=BATCH_WORKERS, type=int,
+        help='Number of workers running the batch TTS')
+    parser.add_argument(
+        '--job-workers',
+        dest='job_workers', default=job_queue.num_workers, type=int,
+        help='Number of workers running the TTS jobs')
+    parser.add_argument(
+        '--job-ttl',
+        dest='job_ttl', default=job_queue.ttl, type=int,
+        help='Seconds to keep the finished TTS jobs')
+    parser.add_argument(
+        '--vendor-cache-size',
+        dest='vendor_cache_size', default=OnlineTTS.cache_size//(1024*1024), type=int,
+        help='Max size in MB of the vendor audio cache of each vendor, 0 for no limit')
+    parser.add_argument(
+        '--emotive-cache-size',
+        dest='emotive_cache_size', default=TTSBase.emo_cache_size//(1024*1024), type=int,
+        help='Max size in MB of the emotive speech cache of each vendor, 0 for no limit')
+    parser.add_argument(
+        '--cache-archive',
+        dest='cache_archive', default=None,
+        help='Cache archive packed from the TTS output directory to serve the cache hits from')
+    parser.add_argument(
+        '--archive-size',
+        dest='archive_size', default=archive.max_bytes//(1024*1024), type=int,
+        help='Max size in MB of the served audio archive, 0 disables it')
+    parser.add_argument(
+        '--archive-age',
+        dest='archive_age', default=None, type=int,
+        help='Max age in seconds of the archived audio')
+    parser.add_argument(
+        '--warm-up',
+        dest='warm_up', action='store_true',
+        help='Load the voices in the background at startup instead of on first use')
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency', default=scheduler.max_concurrency, type=int,
+        help='Max TTS runs at a time, 0 for no limit')
+    parser.add_argument(
+        '--max-queue',
+        dest='max_queue', default=scheduler.max_queue, type=int,
+        help='Max interactive TTS runs waiting, more are turned away with 503')
+    parser.add_argument(
+        '--vendor-limit',
+        dest='vendor_limits', default=[], type=parse_limit, action='append',
+        metavar='VENDOR=LIMIT', help='Max TTS runs of the vendor at a time')
+    parser.add_argument(
+        '--voice-limit',
+        dest='voice_limits', default=[], type=parse_limit, action='append',
+        metavar='VENDOR:VOICE=LIMIT', help='Max TTS runs of the voice at a time')
+    parser.add_argument(
+        '--workers',
+        dest='workers', default=1, type=int,
+        help='Number of server processes, more than one runs the pre-forking server')
+    parser.add_argument(
+        '--max-requests',
+        dest='max_requests', default=0, type=int,
+        help='Requests a worker process serves before it is replaced, 0 for no limit')
+    parser.add_argument(
+        '--graceful-timeout',
+        dest='graceful_timeout', default=GRACEFUL_TIMEOUT, type=int,
+        help='Seconds a stopping worker process waits for its requests')
     parser.add_argument(
         '--voice_path', default=os.path.join(cwd, 'api'), dest='voice_path',
         help='Voice path')
 
     option = parser.parse_args()
 
-    global KEEP_AUDIO
     KEEP_AUDIO = option.keep_audio
+    BATCH_WORKERS = option.batch_workers
     tts_output_dir = os.path.expanduser(option.tts_output_dir)
+    response_cache.max_bytes = option.response_cache_size*1024*1024
+    response_cache.enabled = option.response_cache
+    job_queue.num_workers = option.job_workers
+    job_queue.ttl = option.job_ttl
+    prefetch_queue.ttl = option.job_ttl
+    archive.max_bytes = option.archive_size*1024*1024
+    OnlineTTS.cache_size = option.vendor_cache_size*1024*1024
+    TTSBase.emo_cache_size = option.emotive_cache_size*1024*1024
+    if option.cache_archive:
+        # mapped before the workers fork so they share it
+        AudioCache.archive = CacheArchive(
+            os.path.expanduser(option.cache_archive), tts_output_dir)
+    archive.max_age = option.archive_age
+    scheduler.max_concurrency = option.max_concurrency
+    scheduler.max_queue = option.max_queue
+    scheduler.vendor_limits = dict(option.vendor_limits)
+    for name, limit in option.voice_limits:
+        if ':' not in name:
+            parser.error("Expect VENDOR:VOICE=LIMIT, got {}={}".format(name, limit))
+        scheduler.voice_limits[tuple(name.split(':', 1))] = limit
 
     load_voices(option.voice_path)
     if len(VOICES) == 0:
         logger.warn("No any voice is loaded")
 
     for name, engine in VOICES.items():
-        for voice in engine.values():
+        for voice_name, voice in engine.items():
+            voice.set_name(name, voice_name)
             voice.set_output_dir(os.path.join(tts_output_dir, name))
 
-    app.run(host='0.0.0.0', debug=False, use_reloader=False, port=option.port)
+    # keep the client connections alive between the requests
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    if option.workers > 1:
+        # the workers share the voices loaded before the fork, the voice
+        # processes such as festival are started by each worker after it
+        warm_up_voices()
+        # any worker may be polled for the jobs of the others
+        if not os.path.isdir(tts_output_dir):
+            os.makedirs(tts_output_dir)
+        job_queue.store = prefetch_queue.store = JobStore(
+            os.path.join(tts_output_dir, JOB_STORE_FILE))
+        server = PreforkServer(
+            app, '0.0.0.0', option.port, option.workers,
+            max_requests=option.max_requests,
+            graceful_timeout=option.graceful_timeout,
+            on_worker_start=start_background_threads)
+        server.run()
+        return
+    if option.warm_up:
+        warm_up = threading.Thread(target=warm_up_voices, kwargs={'start': True})
+        warm_up.daemon = True
+        warm_up.start()
+    start_background_threads()
+    app.run(host='0.0.0.0', debug=False, use_reloader=False, port=option.port,
+            threaded=True)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,135 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import sys
+import time
+import logging
+import threading
+
+logger = logging.getLogger('hr.ttsserver.singleflight')
+
+_local = threading.local()
+# Seconds between the checks of the abort function of a caller
+POLL_INTERVAL = 0.1
+
+class Timeout(Exception):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+class Call(object):
+    """A computation in flight and the callers waiting for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+        # when the last caller gives up, None if one waits for the result
+        self.deadline = None
+        self.bounded = True
+
+    def add_waiter(self, deadline):
+        self.waiters += 1
+        if deadline is None:
+            self.bounded = False
+            self.deadline = None
+        elif self.bounded and (self.deadline is None or deadline > self.deadline):
+            self.deadline = deadline
+
+def current():
+    """Returns the call of the flight running on this thread, None outside a flight"""
+    return getattr(_local, 'call', None)
+
+def cancelled():
+    """Returns True if every caller of the current flight has given up"""
+    call = current()
+    return call is not None and call.cancelled.is_set()
+
+def check_cancelled():
+    if cancelled():
+        raise Cancelled("All the callers have gone away")
+
+class SingleFlight(object):
+    """
+    Runs one computation per key at a time. The callers of a key that is
+    already in flight wait for the result of the first call instead of
+    computing it again, and get its exception if it failed. The
+    computation runs on its own thread, when every caller has given up it
+    is marked as cancelled, see cancelled(), and the next caller starts
+    a new one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Returns the result of func(*args, **kwargs), or of the call of the
+        same key in flight. Raises Timeout if the result is not ready
+        within timeout seconds, and Cancelled if abort() returns True
+        while waiting, such as when the client has gone away.
+        """
+        timeout = kwargs.pop('timeout', None)
+        abort = kwargs.pop('abort', None)
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.shared += 1
+            call.add_waiter(deadline)
+        if leader:
+            worker = threading.Thread(
+                target=self._run, args=(key, call, func, args, kwargs))
+            worker.daemon = True
+            worker.start()
+        try:
+            while not call.done.wait(self._get_wait(deadline, abort)):
+                if deadline is not None and time.time() >= deadline:
+                    raise Timeout("Timed out waiting for {}".format(key))
+                if abort is not None and abort():
+                    raise Cancelled("The caller has gone away")
+        finally:
+            with self.lock:
+                call.waiters -= 1
+                if call.waiters == 0 and not call.done.is_set():
+                    logger.info("Cancel {}".format(key))
+                    call.cancelled.set()
+                    self._forget(key, call)
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    @staticmethod
+    def _get_wait(deadline, abort):
+        wait = None
+        if deadline is not None:
+            wait = max(0, deadline - time.time())
+        if abort is not None:
+            wait = POLL_INTERVAL if wait is None else min(wait, POLL_INTERVAL)
+        return wait
+
+    def _run(self, key, call, func, args, kwargs):
+        _local.call = call
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception:
+            call.exc_info = sys.exc_info()
+        finally:
+            _local.call = None
+            with self.lock:
+                self._forget(key, call)
+            call.done.set()
+
+    def _forget(self, key, call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    def get_inflight(self):
+        with self.lock:
+            return len(self.calls)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+"""
+Compact binary encoding of the TTS timeline. All the values are little
+endian.
+
+    header  '4sBB'  magic 'HRTL', version, number of tracks
+    names   'H'     number of names, then 'H' length and UTF-8 bytes of
+                    each name
+    track   'BI'    kind, number of items n, then
+            'nH'    name index of each item
+            'nf'    start of each item
+            'nf'    end of each item
+            'nf'    duration of each item, visemes only
+            'I'     length of the JSON of the extra item fields,
+                    [[index, {field: value}], ...], then the JSON
+
+The nodes are not sent, they are the markers, words and phonemes merged.
+"""
+import json
+import struct
+
+MAGIC = 'HRTL'
+VERSION = 1
+MIMETYPE = 'application/x-hr-timeline'
+# track kind -> (response key, item type)
+TRACKS = [
+    ('phonemes', 'phoneme'),
+    ('markers', 'marker'),
+    ('words', 'word'),
+    ('visemes', 'viseme'),
+]
+VISEMES = 3
+FIELDS = set(['type', 'name', 'start', 'end'])
+# float32 keeps about 7 significant digits
+PRECISION = 6
+
+class TimelineError(Exception):
+    pass
+
+def merge_nodes(markers, words, phonemes):
+    typeorder = {'marker': 1, 'word': 2, 'phoneme': 3}
+    items = markers+words+phonemes
+    return sorted(items, key=lambda x: (x['start'], typeorder[x['type']]))
+
+def encode(response):
+    """Encodes the timeline of the response"""
+    names = []
+    name_index = {}
+    tracks = []
+    for kind, (key, _) in enumerate(TRACKS):
+        items = response.get(key) or []
+        fields = FIELDS | set(['duration']) if kind == VISEMES else FIELDS
+        indexes = []
+        extras = []
+        for i, item in enumerate(items):
+            name = item['name']
+            if not isinstance(name, unicode):
+                name = name.decode('utf-8')
+            if name not in name_index:
+                name_index[name] = len(names)
+                names.append(name)
+            indexes.append(name_index[name])
+            extra = dict((k, v) for k, v in item.items() if k not in fields)
+            if extra:
+                extras.append([i, extra])
+        tracks.append((kind, items, indexes, extras))
+    if len(names) > 0xffff:
+        raise TimelineError("Too many names {}".format(len(names)))
+    chunks = [struct.pack('<4sBB', MAGIC, VERSION, len(tracks)),
+              struct.pack('<H', len(names))]
+    for name in names:
+        name = name.encode('utf-8')
+        chunks.append(struct.pack('<H', len(name)))
+        chunks.append(name)
+    for kind, items, indexes, extras in tracks:
+        n = len(items)
+        chunks.append(struct.pack('<BI', kind, n))
+        chunks.append(struct.pack('<{}H'.format(n), *indexes))
+        chunks.append(struct.pack('<{}f'.format(n), *[item['start'] for item in items]))
+        chunks.append(struct.pack('<{}f'.format(n), *[item['end'] for item in items]))
+        if kind == VISEMES:
+            chunks.append(struct.pack('<{}f'.format(n), *[item['duration'] for item in items]))
+        extras = json.dumps(extras) if extras else ''
+        chunks.append(struct.pack('<I', len(extras)))
+        chunks.append(extras)
+    return ''.join(chunks)
+
+def decode(data):
+    """Decodes the timeline into the phonemes, markers, words, visemes and nodes"""
+    def unpack(fmt):
+        values = struct.unpack_from(fmt, data, offset[0])
+        offset[0] += struct.calcsize(fmt)
+        return values
+
+    def unpack_times(n):
+        return [round(value, PRECISION) for value in unpack('<{}f'.format(n))]
+
+    offset = [0]
+    try:
+        magic, version, num_tracks = unpack('<4sBB')
+        if magic != MAGIC or version != VERSION:
+            raise TimelineError("Unknown timeline format {} {}".format(magic, version))
+        names = []
+        for _ in range(unpack('<H')[0]):
+            length = unpack('<H')[0]
+            names.append(data[offset[0]:offset[0]+length].decode('utf-8'))
+            offset[0] += length
+        timeline = dict((key, []) for key, _ in TRACKS)
+        for _ in range(num_tracks):
+            kind, n = unpack('<BI')
+            key, type = TRACKS[kind]
+            indexes = unpack('<{}H'.format(n))
+            starts = unpack_times(n)
+            ends = unpack_times(n)
+            items = [{'type': type, 'name': names[index], 'start': start, 'end': end}
+                     for index, start, end in zip(indexes, starts, ends)]
+            if kind == VISEMES:
+                for item, duration in zip(items, unpack_times(n)):
+                    item['duration'] = duration
+            length = unpack('<I')[0]
+            if length:
+                for i, extra in json.loads(data[offset[0]:offset[0]+length]):
+                    items[i].update(extra)
+                offset[0] += length
+            timeline[key] = items
+    except (struct.error, IndexError, ValueError) as ex:
+        raise TimelineError("Bad timeline {}".format(ex))
+    timeline['nodes'] = merge_nodes(
+        timeline['markers'], timeline['words'], timeline['phonemes'])
+    return timeline
@@ -0,0 +1,130 @@
+# Copyright (c) 2013-2019 Hanson Robotics, Ltd.
+import io
+import wave
+import sunau
+import audioop
+import logging
+import subprocess
+
+logger = logging.getLogger('hr.ttsserver.transcode')
+
+# codec -> mimetype, file extension
+CODECS = {
+    'wav': ('audio/wav', '.wav'),
+    'ulaw': ('audio/basic', '.au'),
+    'flac': ('audio/flac', '.flac'),
+    'opus': ('audio/ogg', '.opus'),
+}
+# The mimetypes accepted for each codec, in the order of preference
+ACCEPT = [
+    ('audio/wav', 'wav'),
+    ('audio/x-wav', 'wav'),
+    ('audio/wave', 'wav'),
+    ('audio/flac', 'flac'),
+    ('audio/x-flac', 'flac'),
+    ('audio/ogg', 'opus'),
+    ('audio/opus', 'opus'),
+    ('audio/basic', 'ulaw'),
+    ('audio/x-mulaw', 'ulaw'),
+]
+OPUS_BITRATE = 32  # kbps
+
+class CodecError(Exception):
+    pass
+
+class Encoding(object):
+    """The audio in a codec and its parameters"""
+
+    def __init__(self, codec, data, params):
+        self.codec = codec
+        self.data = data
+        self.params = params
+        self.mimetype = CODECS[codec][0]
+        self.etag = None
+
+def negotiate(accept_mimetypes):
+    """Returns the codec of the best match of the Accept header"""
+    best = accept_mimetypes.best_match([mimetype for mimetype, _ in ACCEPT])
+    return dict(ACCEPT).get(best, 'wav')
+
+def get_extension(codec):
+    return CODECS[codec][1]
+
+def run(cmd, data):
+    try:
+        proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    except OSError as ex:
+        raise CodecError("Can't run {}: {}".format(cmd[0], ex))
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise CodecError("{} failed: {}".format(cmd[0], err.strip()))
+    return out
+
+def encode(wav_data, codec):
+    """Encodes the WAV data and returns the Encoding"""
+    if codec not in CODECS:
+        raise CodecError("Unknown codec {}".format(codec))
+    f = wave.open(io.BytesIO(wav_data), 'rb')
+    try:
+        nchannels, sampwidth, framerate, nframes, _, _ = f.getparams()
+        if codec == 'ulaw':
+            frames = f.readframes(nframes)
+    finally:
+        f.close()
+    params = {
+        'codec': codec,
+        'channels': nchannels,
+        'sample_rate': framerate,
+    }
+    if codec == 'wav':
+        data = wav_data
+        params['sample_width'] = sampwidth
+    elif codec == 'ulaw':
+        if sampwidth == 1:
+            # 8 bit WAV is unsigned
+            frames = audioop.bias(frames, 1, -128)
+        out = io.BytesIO()
+        au = sunau.open(out, 'wb')
+        au.setnchannels(nchannels)
+        au.setsampwidth(sampwidth)
+        au.setframerate(framerate)
+        au.setcomptype('ULAW', '')
+        au.writeframes(frames)
+        au.close()
+        data = out.getvalue()
+    elif codec == 'flac':
+        data = run(['sox', '-t', 'wav', '-', '-t', 'flac', '-'], wav_data)
+    elif codec == 'opus':
+        data = run(['opusenc', '--quiet', '--bitrate', str(OPUS_BITRATE), '-', '-'],
+                   wav_data)
+        params['sample_rate'] = 48000
+        params['bitrate'] = OPUS_BITRATE*1000
+    params['size'] = len(data)
+    return Encoding(codec, data, params)
+
+def decode(data, codec):
+    """Decodes the audio in the codec to WAV data"""
+    if codec == 'wav':
+        return data
+    if codec == 'ulaw':
+        au = sunau.open(io.BytesIO(data), 'rb')
+        try:
+            nchannels, sampwidth, framerate, nframes, _, _ = au.getparams()
+            frames = au.readframes(nframes)
+        finally:
+            au.close()
+        out = io.BytesIO()
+        f = wave.open(out, 'wb')
+        f.setnchannels(nchannels)
+        f.setsampwidth(sampwidth)
+        f.setframerate(framerate)
+        f.writeframes(frames)
+        f.close()
+        return out.getvalue()
+    if codec == 'flac':
+        return run(['sox', '-t', 'flac', '-', '-t', 'wav', '-'], data)
+    if codec == 'opus':
+        return run(['opusdec', '--quiet', '-', '-'], data)
+    raise CodecError("Unknown codec {}".format(codec))
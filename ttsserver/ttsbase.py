@@ -4,36 +4,59 @@
 from __future__ import division
 import os
 import re
+import sys
+import time
 import logging
-import hashlib
-import pinyin
-from scipy.io import wavfile
-import shutil
 import yaml
 import xml.etree.ElementTree as ET
 import uuid
 import traceback
 import subprocess
+import threading
+import wave
+import io
+import base64
+import hashlib
 
-try:
-    from audio2phoneme import audio2phoneme
-except ImportError as ex:
-    pass
 from ttsserver.visemes import BaseVisemes
-from espp.emotivespeech import emotive_speech
+from ttsserver import metrics
+from ttsserver.timeline import merge_nodes
+from ttsserver import timeline
+from ttsserver.filelock import FileLock
+from ttsserver import audio_cache
+from ttsserver.audio_cache import AudioCache, make_key
+from ttsserver import singleflight
 
 CWD = os.path.dirname(os.path.realpath(__file__))
 logger = logging.getLogger('hr.ttsserver.ttsbase')
 
 ILLEGAL_CHARS = re.compile(r"""[/]""")
+# Seconds between the checks of a running command or vendor call for
+# cancellation
+CANCEL_POLL_INTERVAL = 0.05
+
+def get_wav_params(wav):
+    """Returns the params of the WAV file or file object"""
+    f = wave.open(wav, 'rb')
+    try:
+        return f.getparams()
+    finally:
+        f.close()
 
 def get_duration(wav_fname):
     if os.path.isfile(wav_fname):
-        try:
-            duration = float(subprocess.check_output('sox --i -D %s' % wav_fname, shell=True))
-            return duration
-        except Exception as ex:
-            logger.error(ex)
+        with metrics.timer('tts_stage_seconds', stage='duration'):
+            try:
+                params = get_wav_params(wav_fname)
+                return params[3]/params[2]
+            except Exception as ex:
+                pass
+            # not a plain WAV file
+            try:
+                duration = float(subprocess.check_output('sox --i -D %s' % wav_fname, shell=True))
+                return duration
+            except Exception as ex:
+                logger.error(ex)
     return 0.0
 
 def is_xml(text):
@@ -63,24 +86,177 @@ def strip_xmltag(text):
             notags = notags.encode('utf-8')
     return notags
 
+class TTSContext(object):
+    """
+    Per request state. Anything a request writes or changes goes here so
+    one voice can serve parallel requests.
+    """
+    def __init__(self, params=None, scratch_dir='.'):
+        self.id = str(uuid.uuid1())
+        self.params = {}
+        if params:
+            self.params.update(params)
+        self.scratch_dir = scratch_dir
+        self.scratch_files = []
+        # the flight of the request, cancelled when all its callers give up
+        self.call = singleflight.current()
+        # the key of the cache entry do_tts added, its timeline is added
+        # once it is complete
+        self.cache_fill = None
+
+    def get_remaining(self):
+        """Returns the seconds until the callers give up, None if they wait"""
+        if self.call is None or self.call.deadline is None:
+            return None
+        return self.call.deadline - time.time()
+
+    def is_cancelled(self):
+        if self.call is None:
+            return False
+        remaining = self.get_remaining()
+        return self.call.cancelled.is_set() or (remaining is not None and remaining <= 0)
+
+    def check(self):
+        """Raises singleflight.Cancelled if the request is cancelled"""
+        if self.is_cancelled():
+            raise singleflight.Cancelled("The TTS request is cancelled")
+
+    def run(self, cmd, data=None):
+        """
+        Runs the command and returns its exit code, stdout and stderr. It is
+        killed if the request is cancelled.
+        """
+        proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE if data is not None else None,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = ['', '']
+
+        def communicate():
+            output[:] = proc.communicate(data)
+
+        thread = threading.Thread(target=communicate)
+        thread.daemon = True
+        thread.start()
+        while thread.is_alive():
+            thread.join(CANCEL_POLL_INTERVAL)
+            if thread.is_alive() and self.is_cancelled():
+                proc.kill()
+                thread.join()
+                raise singleflight.Cancelled("Killed {}, the TTS request is cancelled".format(cmd[0]))
+        return proc.returncode, output[0], output[1]
+
+    def get_scratch_file(self, name):
+        fname = os.path.join(self.scratch_dir, '{}-{}'.format(self.id, name))
+        self.scratch_files.append(fname)
+        return fname
+
+    def cleanup(self):
+        for fname in self.scratch_files:
+            if os.path.isfile(fname):
+                os.remove(fname)
+        del self.scratch_files[:]
+
+    def __repr__(self):
+        return "<TTSContext id {}, params {}>".format(self.id, self.params)
+
 # User data class to store information
 class TTSData:
-    def __init__(self, text=None, wavout=None):
+    def __init__(self, text=None, wavout=None, context=None):
         self.text = text
         self.wavout = wavout
+        self.context = context or TTSContext()
         self.phonemes = []
         self.markers = []
         self.words = []
         self.visemes = []
+        # WAV data in memory. When set it takes over the wavout file.
+        self.audio = None
+        self.audio_params = None
+        # seconds of the audio when it is known without reading it
+        self.duration = None
+        # the timeline was restored from a cache
+        self.from_cache = False
+
+    def set_audio(self, audio):
+        self.audio = audio
+        self.duration = None
+        try:
+            self.audio_params = get_wav_params(io.BytesIO(audio))
+        except Exception as ex:
+            logger.error("Invalid WAV data {}".format(ex))
+            self.audio_params = None
+        if self.wavout and os.path.isfile(self.wavout):
+            os.remove(self.wavout)
+
+    def load_audio(self, fname):
+        """Reads the audio into memory"""
+        with open(fname, 'rb') as f:
+            self.set_audio(f.read())
+
+    def get_audio(self):
+        if self.audio is not None:
+            return self.audio
+        if self.wavout and os.path.isfile(self.wavout):
+            with open(self.wavout, 'rb') as f:
+                return f.read()
+
+    def open_audio(self):
+        if self.audio is not None:
+            return io.BytesIO(self.audio)
+        return open(self.wavout, 'rb')
+
+    def has_audio(self):
+        return self.audio is not None or bool(
+            self.wavout and os.path.isfile(self.wavout))
+
+    def get_audio_params(self):
+        if self.audio is not None:
+            return self.audio_params
+        return get_wav_params(self.wavout)
+
+    def write(self, fname=None):
+        """
+        Writes the audio in memory to fname, the wavout by default, for
+        the code that needs a file and returns the file name.
+        """
+        if fname is None:
+            fname = self.wavout
+        if self.audio is not None:
+            with open(fname, 'wb') as f:
+                f.write(self.audio)
+            if fname == self.wavout:
+                self.audio = None
+                self.audio_params = None
+        return fname
 
     def get_duration(self):
+        if self.duration is not None:
+            return self.duration
+        if self.audio is not None:
+            if self.audio_params is None:
+                return 0.0
+            return self.audio_params[3]/self.audio_params[2]
         return get_duration(self.wavout)
 
     def get_nodes(self):
-        typeorder = {'marker': 1, 'word': 2, 'phoneme': 3}
-        items = self.markers+self.words+self.phonemes
-        items = sorted(items, key=lambda x: (x['start'], typeorder[x['type']]))
-        return items
+        return merge_nodes(self.markers, self.words, self.phonemes)
+
+    def get_sidecar(self):
+        """Returns the timeline and the duration to keep with the cached audio"""
+        data = timeline.encode({
+            'phonemes': self.phonemes, 'markers': self.markers,
+            'words': self.words, 'visemes': self.visemes})
+        return {'timeline': base64.b64encode(data), 'duration': self.get_duration()}
+
+    def load_sidecar(self, sidecar):
+        """Restores the timeline and the duration kept with the cached audio"""
+        data = timeline.decode(base64.b64decode(sidecar['timeline']))
+        self.phonemes = data['phonemes']
+        self.markers = data['markers']
+        self.words = data['words']
+        self.visemes = data['visemes']
+        self.duration = sidecar['duration']
+        self.from_cache = True
 
     def __repr__(self):
         return "<TTSData wavout {}, text {}>".format(self.wavout, self.text)
@@ -92,23 +268,57 @@ class TTSException(Exception):
         return self.msg
 
 class TTSBase(object):
+    # Max size in bytes of the emotive speech cache of a vendor
+    emo_cache_size = audio_cache.DEFAULT_MAX_BYTES
+
     def __init__(self):
         self.output_dir = '.'
         self.emo_cache_dir = '.' # emotive speech cache dir
+        self.emo_cache = None
         self.viseme_mapping = None
-        self.tts_params = {}
+        self.vendor_name = None
+        self.voice_name = None
+        self._local = threading.local()
+        self._tts_params = {}
+
+    # The TTS params of the request being served by the current thread, or
+    # the voice defaults outside of a request
+    @property
+    def tts_params(self):
+        context = getattr(self._local, 'context', None)
+        if context is not None:
+            return context.params
+        return self._tts_params
+
+    @tts_params.setter
+    def tts_params(self, params):
+        context = getattr(self._local, 'context', None)
+        if context is not None:
+            context.params = params
+        else:
+            self._tts_params = params
 
     def set_output_dir(self, output_dir):
         self.output_dir = os.path.expanduser(output_dir)
         self.emo_cache_dir = os.path.join(self.output_dir, 'emo_cache')
         if not os.path.isdir(self.output_dir):
             os.makedirs(self.output_dir)
-        if not os.path.isdir(self.emo_cache_dir):
-            os.makedirs(self.emo_cache_dir)
+        self.emo_cache = AudioCache(self.emo_cache_dir, self.emo_cache_size, name='emotive')
+
+    def set_name(self, vendor, voice):
+        self.vendor_name = vendor
+        self.voice_name = voice
 
     def set_viseme_mapping(self, mapping):
         self.viseme_mapping = mapping
 
+    def start(self):
+        """
+        Starts the processes the voice keeps running. It is called in each
+        process serving the voice, after the prefork server forks.
+        """
+        pass
+
     def get_tts_params(self):
         return self.tts_params
 
@@ -116,12 +326,14 @@ class TTSBase(object):
         self.tts_params = {}
         self.tts_params.update(params)
 
-    def get_emo_cache_file(self, text, params):
-        if isinstance(text, unicode):
-            text = text.encode('utf-8')
-        hashcode = hashlib.sha1(text+str(params)).hexdigest()[:40]
-        filename = os.path.join(self.emo_cache_dir, hashcode+'.wav')
-        return filename
+    def get_emo_cache_id(self, tts_data, emotion, params):
+        """
+        Returns the emotive speech cache key of the TTS audio, made of the
+        audio, the voice and the DSP params the emotion resolves to
+        """
+        from espp.params import resolve_params
+        return make_key(self.vendor_name, self.voice_name, tts_data.get_audio(),
+                        emotion, resolve_params(**dict(params, emotion=emotion)))
 
     def get_cache_file(self, text):
         raise NotImplementedError("get_cache_file is not implemented")
@@ -132,46 +344,153 @@ class TTSBase(object):
     def do_tts(self, tts_data):
         raise NotImplementedError("do_tts is not implemented")
 
-    def _adjust_phonemes_timing(self, phonemes, ratio):
-        for p in phonemes:
-            p['start'] = p['start']*ratio
-            p['end'] = p['end']*ratio
+    def _adjust_timing(self, items, ratio):
+        for item in items:
+            item['start'] = item['start']*ratio
+            item['end'] = item['end']*ratio
+            if 'duration' in item:
+                item['duration'] = item['duration']*ratio
+
+    def fill_cache(self, tts_data):
+        """Called with the TTS data once its timeline is complete"""
+        pass
 
     def tts(self, text, wavout=None, **kwargs):
+        context = TTSContext(kwargs, self.output_dir)
+        self._local.context = context
+        # the caller wants the audio in this file
+        write_wavout = wavout is not None
+        done = False
         try:
             if wavout is None:
-                id = str(uuid.uuid1())
-                wavout = os.path.join(self.output_dir, id+'.wav')
+                wavout = os.path.join(self.output_dir, context.id+'.wav')
             if isinstance(wavout, unicode):
                 wavout = wavout.encode('utf-8')
             if isinstance(text, unicode):
                 text = text.encode('utf8')
-            tts_data = TTSData(text, wavout)
+            tts_data = TTSData(text, wavout, context)
             self.set_tts_params(**kwargs)
-            self.do_tts(tts_data)
+            with metrics.timer('tts_stage_seconds', stage='do_tts',
+                               vendor=self.vendor_name, voice=self.voice_name):
+                self.do_tts(tts_data)
+            context.check()
+            if self.viseme_mapping is not None and not tts_data.from_cache:
+                with metrics.timer('tts_stage_seconds', stage='visemes'):
+                    tts_data.visemes = self.viseme_mapping.get_visemes(tts_data.phonemes)
+            self.fill_cache(tts_data)
             emotion = kwargs.get('emotion')
-            orig_duration = tts_data.get_duration()
             if emotion is not None:
-                cache_file = self.get_emo_cache_file(text, kwargs)
+                emo_lock = None
                 try:
-                    ofile = '{}/emo_tmp.wav'.format(os.path.dirname(tts_data.wavout))
-                    if os.path.isfile(cache_file):
-                        shutil.copy(cache_file, ofile)
+                    cache_id = self.get_emo_cache_id(tts_data, emotion, kwargs)
+                    # the other server processes wait for the one rendering it
+                    emo_lock = FileLock(self.emo_cache_dir, cache_id, stripes=None)
+                    emo_lock.acquire()
+                    entry = self.emo_cache.load(cache_id)
+                    if entry is not None:
+                        metrics.inc('tts_cache_total', cache='emotive', result='hit')
+                        audio, meta = entry
+                        tts_data.set_audio(audio)
+                        # the key has no markup, the timeline of this
+                        # text is scaled as the emotive speech was
+                        tts_data.duration = meta['duration']
+                        self._adjust_timing(tts_data.phonemes, meta['ratio'])
+                        self._adjust_timing(tts_data.visemes, meta['ratio'])
                         logger.info("Get cached emotive speech tts for {} {}".format(
-                            text, cache_file))
+                            text, cache_id))
                     else:
-                        emotive_speech(tts_data.wavout, ofile, **kwargs)
-                        shutil.copy(ofile, cache_file)
-                    shutil.move(ofile, tts_data.wavout)
-                    emo_duration = tts_data.get_duration()
-                    self._adjust_phonemes_timing(tts_data.phonemes, emo_duration/orig_duration)
+                        metrics.inc('tts_cache_total', cache='emotive', result='miss')
+                        orig_duration = tts_data.get_duration()
+                        ifile = tts_data.wavout
+                        if tts_data.audio is not None:
+                            ifile = tts_data.write(context.get_scratch_file('emo_in.wav'))
+                        ofile = context.get_scratch_file('emo.wav')
+                        # scipy and pysptk are slow to import, only the
+                        # emotive speech needs them
+                        from espp.emotivespeech import emotive_transformer, get_sox_command
+                        with metrics.timer('tts_stage_seconds', stage='emotive_speech',
+                                           emotion=emotion):
+                            transformer = emotive_transformer(
+                                ifile, check=context.check, **kwargs)
+                            code, _, err = context.run(
+                                get_sox_command(transformer, ifile, ofile))
+                            if code != 0:
+                                raise TTSException("sox failed: {}".format(err.strip()))
+                        tts_data.load_audio(ofile)
+                        ratio = tts_data.get_duration()/orig_duration
+                        self._adjust_timing(tts_data.phonemes, ratio)
+                        self._adjust_timing(tts_data.visemes, ratio)
+                        # the hits need neither the DSP nor the duration of the audio
+                        meta = {'duration': tts_data.get_duration(), 'ratio': ratio}
+                        self.emo_cache.put(cache_id, ofile, meta=meta)
+                except singleflight.Cancelled:
+                    raise
                 except Exception as ex:
                     logger.error(traceback.format_exc())
-            if self.viseme_mapping is not None:
-                tts_data.visemes = self.viseme_mapping.get_visemes(tts_data.phonemes)
+                finally:
+                    if emo_lock is not None:
+                        emo_lock.release()
+            if write_wavout:
+                tts_data.write()
+            done = True
             return tts_data
+        except singleflight.Cancelled as ex:
+            metrics.inc('tts_cancelled_total', vendor=self.vendor_name, voice=self.voice_name)
+            logger.info("Cancelled TTS {}: {}".format(text, ex))
         except Exception as ex:
             logger.error(traceback.format_exc())
+        finally:
+            # the audio of a failed request is not served
+            if not done and not write_wavout and wavout and os.path.isfile(wavout):
+                os.remove(wavout)
+            context.cleanup()
+            self._local.context = None
+
+class LazyVoice(object):
+    """
+    Stands in for a voice in the voices of a plugin and creates it by
+    calling factory when it is first used, so that loading the plugins is
+    fast. The name and the output dir are passed on to the voice.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.api = None
+        self.lock = threading.Lock()
+        self.vendor_name = None
+        self.voice_name = None
+        self.output_dir = None
+
+    def set_name(self, vendor, voice):
+        self.vendor_name = vendor
+        self.voice_name = voice
+        if self.api is not None:
+            self.api.set_name(vendor, voice)
+
+    def set_output_dir(self, output_dir):
+        self.output_dir = output_dir
+        if self.api is not None:
+            self.api.set_output_dir(output_dir)
+
+    def is_loaded(self):
+        return self.api is not None
+
+    def get(self):
+        """Returns the voice, creating it on the first call"""
+        if self.api is None:
+            with self.lock:
+                if self.api is None:
+                    with metrics.timer('tts_stage_seconds', stage='load_voice',
+                                       vendor=self.vendor_name, voice=self.voice_name):
+                        api = self.factory()
+                    if self.vendor_name is not None:
+                        api.set_name(self.vendor_name, self.voice_name)
+                    if self.output_dir is not None:
+                        api.set_output_dir(self.output_dir)
+                    logger.info("Loaded voice {}:{}".format(
+                        self.vendor_name, self.voice_name))
+                    self.api = api
+        return self.api
 
 
 class Numb_Visemes(BaseVisemes):
@@ -207,7 +526,7 @@ class NumbTTS(TTSBase):
         text = tts_data.text
         fname = '{}.wav'.format(os.path.join(self.output_dir, text.strip()))
         if os.path.isfile(fname):
-            shutil.copy(fname, tts_data.wavout)
+            tts_data.load_audio(fname)
             try:
                 tts_data.phonemes = self.get_phonemes(fname)
             except Exception as ex:
@@ -221,6 +540,7 @@ class NumbTTS(TTSBase):
                 phonemes = yaml.load(f)
             logger.info("Get timing info from file")
         else:
+            from audio2phoneme import audio2phoneme
             phonemes = [
                 {'type': 'phoneme', 'name': phoneme[0],
                     'start': phoneme[1], 'end': phoneme[2]}
@@ -231,45 +551,161 @@ class NumbTTS(TTSBase):
         return phonemes
 
 class OnlineTTS(TTSBase):
+    # Max size in bytes of the vendor audio cache of a vendor
+    cache_size = audio_cache.DEFAULT_MAX_BYTES
 
     def __init__(self):
         super(OnlineTTS, self).__init__()
         self.cache_dir =  os.path.expanduser('{}/cache'.format(self.output_dir))
+        self.cache = None
 
     def set_output_dir(self, output_dir):
         super(OnlineTTS, self).set_output_dir(output_dir)
         self.cache_dir =  os.path.expanduser('{}/cache'.format(self.output_dir))
-        if not os.path.isdir(self.cache_dir):
-            os.makedirs(self.cache_dir)
+        self.cache = AudioCache(self.cache_dir, self.cache_size, name='vendor')
+
+    def get_cache_id(self, text, params=None):
+        """Returns the cache key of the text with the TTS params of the request"""
+        if params is None:
+            params = self.get_tts_params()
+        return make_key(self.voice_name, text, params)
+
+    def get_cache_file(self, text):
+        return self.cache.get_path(self.get_cache_id(text))
+
+    def pin(self, text, params, pinned=True):
+        """Pins the cached audio of the text so it is never evicted"""
+        return self.cache.pin(self.get_cache_id(text, params), pinned)
 
-    def get_cache_id(self, text):
+    def get_legacy_cache_file(self, text):
+        """Returns the file the text was cached to before the cache was indexed"""
         if isinstance(text, unicode):
             text = text.encode('utf-8')
         suffix = hashlib.sha1(text+str(self.get_tts_params())).hexdigest()[:6]
-        text = strip_xmltag(text)
-        text = ILLEGAL_CHARS.sub('_', text)
-        return text[:200]+'-'+suffix
-
-    def get_cache_file(self, text):
-        cache_id = self.get_cache_id(text)
-        filename = os.path.join(self.cache_dir, cache_id+'.wav')
-        return filename
+        text = ILLEGAL_CHARS.sub('_', strip_xmltag(text))
+        return os.path.join(self.cache_dir, '{}-{}.wav'.format(text[:200], suffix))
+
+    def has_legacy_voice(self):
+        """
+        Whether the TTS params tell the voice. The legacy cache files of
+        all the voices of the vendor are in one directory, named by the
+        text and the params only.
+        """
+        return self.get_tts_params().get('voice') == self.voice_name
+
+    def import_legacy(self, text, cache_id):
+        """
+        Links the legacy cache file of the text, if there is one, into the
+        cache. Returns the entry, None if there is none.
+        """
+        if not self.has_legacy_voice():
+            return None
+        try:
+            fname = self.get_legacy_cache_file(text)
+            if not os.path.isfile(fname):
+                return None
+            self.cache.put(cache_id, fname)
+        except Exception as ex:
+            logger.warn("Can't import the legacy cache file of {}: {}".format(text, ex))
+            return None
+        logger.info("Imported the legacy cache file {}".format(fname))
+        return self.cache.load(cache_id)
 
     def offline_tts(self, tts_data):
-        cache_file = self.get_cache_file(tts_data.text)
-        if os.path.isfile(cache_file):
-            shutil.copy(cache_file, tts_data.wavout)
+        cache_id = self.get_cache_id(tts_data.text)
+        entry = self.cache.load(cache_id)
+        if entry is None:
+            entry = self.import_legacy(tts_data.text, cache_id)
+        if entry is not None:
+            audio, meta = entry
+            tts_data.set_audio(audio)
+            if 'timeline' in meta:
+                tts_data.load_sidecar(meta)
             logger.info("Get offline tts")
         else:
-            raise TTSException("Offline tts failed, no such file {}".format(
-                    self.get_cache_file(tts_data.text)))
+            raise TTSException("Offline tts failed, {} is not cached".format(
+                    tts_data.text))
 
     def do_tts(self, tts_data):
+        cache_id = self.get_cache_id(tts_data.text)
+        # the other server processes wait for the one rendering the text,
+        # the other texts don't, the vendor call can be slow
+        with FileLock(self.cache_dir, cache_id, stripes=None):
+            try:
+                self.offline_tts(tts_data)
+                metrics.inc('tts_cache_total', cache='vendor', result='hit')
+            except Exception as ex:
+                logger.exception(ex)
+                metrics.inc('tts_cache_total', cache='vendor', result='miss')
+                with metrics.timer('tts_stage_seconds', stage='online_tts',
+                                   vendor=self.vendor_name, voice=self.voice_name):
+                    self.call_online_tts(tts_data)
+                if self.store(cache_id, tts_data):
+                    tts_data.context.cache_fill = cache_id
+
+    def store(self, cache_id, tts_data):
+        """Adds the audio of the online TTS to the cache, returns True if it is added"""
+        try:
+            if tts_data.audio is not None:
+                self.cache.put(cache_id, data=tts_data.audio)
+            elif tts_data.wavout and os.path.isfile(tts_data.wavout):
+                self.cache.put(cache_id, tts_data.wavout)
+            elif os.path.isfile(self.cache.get_path(cache_id)):
+                # written by online_tts to get_cache_file
+                self.cache.put(cache_id)
+            else:
+                return False
+            return True
+        except Exception as ex:
+            logger.error("Can't cache {}: {}".format(tts_data.text, ex))
+            return False
+
+    def fill_cache(self, tts_data):
+        """
+        Keeps the timeline with the audio cached by do_tts, so a hit needs
+        no text processing
+        """
+        if tts_data.context.cache_fill is None:
+            return
         try:
-            self.offline_tts(tts_data)
+            self.cache.set_meta(tts_data.context.cache_fill, tts_data.get_sidecar())
         except Exception as ex:
-            logger.exception(ex)
-            self.online_tts(tts_data)
+            logger.error("Can't cache the timeline of {}: {}".format(tts_data.text, ex))
+
+    def call_online_tts(self, tts_data):
+        """
+        Runs online_tts. In a request that can be cancelled it runs on its
+        own thread and the request stops waiting for the vendor once it is
+        cancelled. online_tts can use tts_data.context.get_remaining() as
+        the timeout of the vendor call.
+        """
+        context = tts_data.context
+        if context.call is None:
+            return self.online_tts(tts_data)
+        exc_info = []
+        abandoned = threading.Event()
+
+        def run():
+            self._local.context = context
+            try:
+                self.online_tts(tts_data)
+            except Exception:
+                exc_info.extend(sys.exc_info())
+            finally:
+                self._local.context = None
+                if abandoned.is_set() and os.path.isfile(tts_data.wavout):
+                    os.remove(tts_data.wavout)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        while thread.is_alive():
+            thread.join(CANCEL_POLL_INTERVAL)
+            if thread.is_alive() and context.is_cancelled():
+                abandoned.set()
+                raise singleflight.Cancelled("Gave up the online TTS, the request is cancelled")
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
 
     def online_tts(self, tts_data):
         return NotImplemented
@@ -315,6 +751,7 @@ class ChineseTTSBase(OnlineTTS):
         regexp = re.compile("""^(?P<initial>b|p|m|f|d|t|n|l|g|k|h|j|q|x|zh|ch|sh|r|z|c|s|y|w*)(?P<final>\w+)$""")
         if self.is_ssml(txt):
             txt = self.strip_tag(txt)
+        import pinyin
         pys = pinyin.get(txt, delimiter=' ')
         pys = self.nonchinese2pinyin(pys)
         pys = pys.strip().split(' ')
@@ -350,6 +787,8 @@ class ChineseTTSBase(OnlineTTS):
 
     def do_tts(self, tts_data):
         super(ChineseTTSBase, self).do_tts(tts_data)
+        if tts_data.from_cache:
+            return
         duration = tts_data.get_duration()
         tts_data.phonemes = self.get_phonemes(tts_data.text, duration)
 